@@ -0,0 +1,186 @@
+"""Utilization analytics of a project's staff on dense hour matrices.
+
+Hours are read with ``values_list`` in primary key chunks straight into a
+matrix with one row per employee and one column per day of the project
+window, so no model instances are built. The day matrix is where the
+rows are many: it is a NumPy array folded into weeks with whole-array
+operations when NumPy is installed, and lists of lists otherwise. The
+weekly figures derived from it (utilization, moving averages, burn-down)
+are a few numbers per employee and are computed on plain lists either way.
+"""
+import datetime
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+
+import models
+import pagination
+import reporting
+
+
+class HoursMatrix(object):
+    """Hours of ``employees`` (row order) on each day from ``start`` to
+    ``end`` inclusive."""
+
+    def __init__(self, employees, start, end):
+        self.employees = list(employees)
+        self.rows = dict((pk, i) for i, pk in enumerate(self.employees))
+        self.start = start
+        self.days = (end - start).days + 1
+        if numpy is not None:
+            self.hours = numpy.zeros((len(self.employees), self.days), dtype=numpy.int64)
+        else:
+            self.hours = [[0] * self.days for pk in self.employees]
+
+    def add(self, rows):
+        """Adds ``(employee_id, date, hours)`` rows, dated inside the window."""
+        if not rows:
+            return
+        origin = self.start.toordinal()
+        if numpy is None:
+            for pk, date, hours in rows:
+                self.hours[self.rows[pk]][date.toordinal() - origin] += hours
+            return
+        employee_ids, dates, hours = zip(*rows)
+        numpy.add.at(self.hours,
+                     (numpy.array([self.rows[pk] for pk in employee_ids]),
+                      numpy.array([date.toordinal() - origin for date in dates])),
+                     numpy.array(hours))
+
+    def load(self, queryset, chunk_size=5000):
+        """Adds the rows of a ``(pk, employee_id, date, hours)`` values_list
+        ``queryset``, ``chunk_size`` rows per query."""
+        chunk = []
+        for row in pagination.iterate(queryset, chunk_size, key=itemgetter(0)):
+            chunk.append(row[1:])
+            if len(chunk) >= chunk_size:
+                self.add(chunk)
+                chunk = []
+        self.add(chunk)
+        return self
+
+    def _by_week(self, values):
+        # pad to whole Monday to Sunday weeks and fold the days of each week
+        before = self.start.weekday()
+        if numpy is None:
+            weeks = len(self.mondays())
+            result = []
+            for row in values:
+                sums = [0] * weeks
+                for day, value in enumerate(row):
+                    sums[(before + day) // 7] += value
+                result.append(sums)
+            return result
+        after = -(before + self.days) % 7
+        padded = numpy.pad(values, ((0, 0), (before, after)), 'constant')
+        return padded.reshape(values.shape[0], -1, 7).sum(axis=2).tolist()
+
+    def mondays(self):
+        first = self.start - datetime.timedelta(days=self.start.weekday())
+        weeks = (self.start.weekday() + self.days + 6) // 7
+        return [first + datetime.timedelta(weeks=i) for i in range(weeks)]
+
+    def weekly(self):
+        """Hours per employee and week as lists, ``mondays()`` being the columns."""
+        return self._by_week(self.hours)
+
+    def working_days(self):
+        """Monday to Friday days of the window falling in each week."""
+        if numpy is None:
+            weekdays = [[int((self.start.weekday() + day) % 7 < 5) for day in range(self.days)]]
+        else:
+            weekdays = (numpy.arange(self.days) + self.start.weekday()) % 7
+            weekdays = (weekdays < 5).astype(numpy.int64)[numpy.newaxis, :]
+        return self._by_week(weekdays)[0]
+
+
+def moving_average(values, window):
+    """Mean of each run of ``window`` columns of the ``values`` rows,
+    ending at every column from the ``window``-th on."""
+    result = []
+    for row in values:
+        sums = [0]
+        for value in row:
+            sums.append(sums[-1] + value)
+        result.append([(sums[i] - sums[i - window]) / float(window)
+                       for i in range(window, len(sums))])
+    return result
+
+def utilization(weekly, working_days, capacity):
+    """``weekly`` hours as a share of ``capacity`` hours per full working
+    week, prorated for weeks partly outside the window."""
+    available = [days * (capacity / 5.0) for days in working_days]
+    return [[hours / hours_available if hours_available > 0 else 0.0
+             for hours, hours_available in zip(row, available)]
+            for row in weekly]
+
+def project_analytics(project, capacity=None, window=4, low=0.5, high=1.1, chunk_size=5000):
+    """Weekly hours, utilization and its ``window`` week moving average of
+    the employees with tasks on ``project`` over the project window, who
+    of them is over (mean utilization above ``high``) or under (below
+    ``low``) booked, and the burn-down of the project's hours against the
+    elapsed share of the window. Utilization counts all the hours of an
+    employee, the burn-down only those reported on the project."""
+    if capacity is None:
+        capacity = getattr(settings, 'ACCOUNTS_WEEKLY_CAPACITY', 40)
+    start, end = project.start_date, max(project.end_date, project.start_date)
+    staff = list(models.Task.objects.filter(project=project).order_by('employee__user__username')
+                                    .values_list('employee_id', 'employee__user__username')
+                                    .distinct())
+    employee_ids = [pk for pk, name in staff]
+
+    booked = HoursMatrix(employee_ids, start, end)
+    booked.load(models.EmployeeDayHours.objects.filter(employee__in=employee_ids,
+                                                       date__gte=start, date__lte=end)
+                                              .values_list('id', 'employee_id', 'date', 'hours'),
+                chunk_size)
+    spent = HoursMatrix(employee_ids, start, end)
+    for reports in reporting.report_sources(start, end):
+        spent.load(reports.filter(task__project=project, date__gte=start, date__lte=end)
+                          .values_list('id', 'task__employee_id', 'date', 'elapsed_time_in_hour'),
+                   chunk_size)
+
+    weekly = booked.weekly()
+    shares = utilization(weekly, booked.working_days(), capacity)
+    averages = moving_average(shares, window)
+    mondays = booked.mondays()
+
+    project_weekly = [sum(column) for column in zip(*spent.weekly())] or [0] * len(mondays)
+    burned = []
+    total = 0
+    for hours in project_weekly:
+        total += hours
+        burned.append(total)
+    # days of the window elapsed by the end of each week
+    elapsed = [min(i * 7 - start.weekday(), booked.days) / float(booked.days)
+               for i in range(1, len(mondays) + 1)]
+
+    employees = []
+    for (pk, name), hours, row, average in zip(staff, weekly, shares, averages):
+        employees.append({
+            'name': name,
+            'hours': hours,
+            'utilization': [round(share, 3) for share in row],
+            'moving_average': [round(share, 3) for share in average],
+            'mean_utilization': round(sum(row) / len(row), 3),
+        })
+    return {
+        'capacity': capacity,
+        'window': window,
+        'weeks': mondays,
+        # the weeks the moving averages end at
+        'average_weeks': mondays[window - 1:],
+        'employees': employees,
+        'over_booked': [row['name'] for row in employees if row['mean_utilization'] > high],
+        'under_booked': [row['name'] for row in employees if row['mean_utilization'] < low],
+        'burndown': [{'week': monday, 'hours': hours, 'remaining': total - done,
+                      'burned': round(float(done) / total, 3) if total else 0.0,
+                      'elapsed': round(share, 3)}
+                     for monday, hours, done, share in zip(mondays, project_weekly, burned, elapsed)],
+        'total_hours': total,
+    }
@@ -0,0 +1,62 @@
+"""Moves the reports of long resolved projects to the ArchivedReport table.
+
+The hot Report table then only holds the reports that are still being
+written and read. Rollups and counters are totals over both tables and
+do not change when reports move; ``reporting.report_sources`` adds the
+archive to a query only when its date range reaches back into it.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Max
+
+import bulk
+import models
+
+# every table holding reports, for totals over the whole history
+TABLES = (models.Report, models.ArchivedReport)
+
+
+def id_field(table):
+    """Column of ``table`` holding the id a row is known by."""
+    return 'report_id' if table is models.ArchivedReport else 'pk'
+
+
+def archivable(days=None, today=None):
+    """Reports of the projects resolved and ended more than ``days`` ago
+    (``ACCOUNTS_ARCHIVE_AFTER_DAYS`` by default)."""
+    if days is None:
+        days = getattr(settings, 'ACCOUNTS_ARCHIVE_AFTER_DAYS', 365)
+    limit = (today or datetime.date.today()) - datetime.timedelta(days=days)
+    return models.Report.objects.filter(task__project__resolved=True,
+                                        task__project__end_date__lt=limit)
+
+def archive(reports, chunk_size=500):
+    """Moves the ``reports`` queryset to the archive, ``chunk_size`` rows
+    per transaction so the tables are never locked for long. No signals
+    are sent: the hours stay in the rollups. The report with the highest
+    id stays: SQLite and MySQL before 8.0 hand out ids from the highest one
+    in the table on, and would go back to the archived ones. Returns the
+    number moved."""
+    moved = 0
+    using = router.db_for_write(models.Report)
+    highest = models.Report.objects.using(using).aggregate(id=Max('id'))['id']
+    if highest is not None:
+        reports = reports.exclude(id=highest)
+    while True:
+        with transaction.atomic(using=using):
+            rows = list(reports.using(using).order_by('id')[:chunk_size]
+                               .values_list('id', 'task_id', 'date', 'elapsed_time_in_hour'))
+            if not rows:
+                return moved
+            models.ArchivedReport.objects.using(using).bulk_create([
+                models.ArchivedReport(report_id=pk, task_id=task_id, date=date,
+                                      elapsed_time_in_hour=hours)
+                for pk, task_id, date, hours in rows])
+            bulk.delete_pks(models.Report, [row[0] for row in rows], using)
+        moved += len(rows)
+
+def archived_until():
+    """Latest date in the archive, or None when it is empty."""
+    return models.ArchivedReport.objects.aggregate(date=Max('date'))['date']
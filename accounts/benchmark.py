@@ -0,0 +1,248 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth.models import Group, User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+import caching
+import middleware
+import models
+import reporting
+import rollups
+import tree
+
+
+def departments_tree(rnd, count, depth):
+    """Creates ``count`` departments in one tree at most ``depth`` levels
+    deep, rebuilding the nested sets once at the end."""
+    with tree.batch():
+        created = [(models.Department.objects.create(name='bench-dep-0'), 0)]
+        for i in range(1, count):
+            parent, level = rnd.choice([(dep, level) for dep, level in created[-50:]
+                                        if level < depth - 1] or created[:1])
+            created.append((models.Department.objects.create(name='bench-dep-{0}'.format(i),
+                                                             parent=parent), level + 1))
+    return [dep for dep, level in created]
+
+def seed(departments=5, employees=50, projects=10, tasks_per_employee=5, days=250,
+         depth=3, start=datetime.date(2013, 1, 1), random_seed=0):
+    """Fills the database with a synthetic company: a department tree of
+    ``depth`` levels, employees, projects, their tasks and a report for
+    every task on each working day of the ``days`` long period. A manager
+    "bench-manager" (password "bench") is added for driving the views."""
+    rnd = random.Random(random_seed)
+    with transaction.atomic():
+        deps = departments_tree(rnd, departments, depth)
+        manager = User.objects.create_user('bench-manager', password='bench')
+        manager.groups.add(Group.objects.get_or_create(name='manager')[0])
+        models.Employee.objects.create(user=manager, department=deps[0])
+        User.objects.bulk_create([User(username='bench-user-{0}'.format(i))
+                                  for i in range(employees)])
+        users = User.objects.filter(username__startswith='bench-user-').order_by('id')
+        models.Employee.objects.bulk_create([models.Employee(user=user, department=rnd.choice(deps))
+                                             for user in users])
+        staff = list(models.Employee.objects.filter(user__in=users))
+        models.Project.objects.bulk_create([
+            models.Project(name='bench-project-{0}'.format(i), description='',
+                           start_date=start, end_date=start + datetime.timedelta(days=days),
+                           resolved=rnd.random() < 0.3)
+            for i in range(projects)])
+        prjs = list(models.Project.objects.filter(name__startswith='bench-project-'))
+        models.Task.objects.bulk_create([
+            models.Task(task_name='bench-task-{0}-{1}'.format(employee.id, i),
+                        employee=employee, project=rnd.choice(prjs),
+                        resolved=rnd.random() < 0.5)
+            for employee in staff for i in range(tasks_per_employee)])
+        tasks = list(models.Task.objects.filter(employee__in=staff).values_list('id', flat=True))
+        reports = []
+        for day in range(days):
+            date = start + datetime.timedelta(days=day)
+            if date.weekday() >= 5:
+                continue
+            for task_id in tasks:
+                reports.append(models.Report(task_id=task_id, date=date,
+                                             elapsed_time_in_hour=rnd.randint(0, 4)))
+            if len(reports) > 5000:
+                models.Report.objects.bulk_create(reports)
+                reports = []
+        models.Report.objects.bulk_create(reports)
+    rollups.rebuild()
+    # bulk_create sends no signals
+    caching.bump('department', 'employee', 'project', 'task')
+
+def query_paths():
+    """``(label, queryset)`` pairs for the queries behind the report views,
+    picked on the seeded data."""
+    employee = models.Employee.objects.order_by('id')[0]
+    project = models.Project.objects.order_by('id')[0]
+    first = models.Report.objects.order_by('date')[0].date
+    start, end = first + datetime.timedelta(days=30), first + datetime.timedelta(days=60)
+    return (
+        ('project_report (task rollup)',
+         models.Task.objects.filter(project=project).values_list('task_name', 'taskhours__hours')),
+        ('project_report (reports)',
+         reporting.hours_by(models.Report.objects.filter(task__project=project), 'task')),
+        ('employee_statistics',
+         models.Report.objects.filter(task__employee=employee, date__gte=start, date__lte=end)),
+        ('report_all_for_employee page',
+         models.Report.objects.filter(task__employee=employee).order_by('date', 'id')[:50]),
+        ('reports in date range',
+         models.Report.objects.filter(date__gte=start, date__lte=end).order_by('id')[:1000]),
+        ('open tasks of employee',
+         models.Task.objects.filter(employee=employee, resolved=False)),
+        ('open tasks of project',
+         models.Task.objects.filter(project=project, resolved=False)),
+        ('unresolved projects',
+         models.Project.objects.filter(resolved=False)),
+    )
+
+def explain(queryset):
+    """Query plan of ``queryset`` as a list of text rows."""
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' | '.join(str(value) for value in row) for row in cursor.fetchall()]
+
+def timing(queryset, repeat=5):
+    """Median wall time in milliseconds of evaluating ``queryset``."""
+    results = []
+    for i in range(repeat):
+        started = time.time()
+        list(queryset._clone())
+        results.append((time.time() - started) * 1000)
+    results.sort()
+    return results[len(results) // 2]
+
+def view_requests():
+    """``(url_name, method, path, data)`` for the views of accounts.urls,
+    with arguments picked on the seeded data. Deletes, login and logout
+    are left out."""
+    employee = models.Employee.objects.filter(task__isnull=False).order_by('id')[0]
+    project = models.Project.objects.order_by('id')[0]
+    task = models.Task.objects.order_by('id')[0]
+    department = models.Department.objects.order_by('id')[0]
+    first = models.Report.objects.order_by('date')[0].date
+    end = first + datetime.timedelta(days=90)
+    statistics = {
+        'employee': employee.id,
+        'start_date_day': first.day, 'start_date_month': first.month,
+        'start_date_year': first.year,
+        'end_date_day': end.day, 'end_date_month': end.month, 'end_date_year': end.year,
+    }
+    # the tail of the change feed a consumer polling it would read
+    latest = models.ChangeLogEntry.objects.aggregate(seq=Max('id'))['seq'] or 0
+    requests = [
+        ('index', 'get', reverse('index'), None),
+        ('profile', 'get', reverse('profile'), None),
+        ('employees_list', 'get', reverse('employees_list'), None),
+        ('employee_add', 'get', reverse('employee_add'), None),
+        ('employee_detail', 'get', reverse('employee_detail', kwargs={'usr_id': employee.user_id}), None),
+        ('projects_list', 'get', reverse('projects_list'), None),
+        ('project_add', 'get', reverse('project_add'), None),
+        ('project_detail', 'get', reverse('project_detail', kwargs={'prj_id': project.id}), None),
+        ('project_report', 'get', reverse('project_report', kwargs={'prj_id': project.id}), None),
+        ('project_analytics', 'get', reverse('project_analytics', kwargs={'prj_id': project.id}),
+         None),
+        ('departments_list', 'get', reverse('departments_list'), None),
+        ('add_dep', 'get', reverse('add_dep'), None),
+        ('detail_dep', 'get', reverse('detail_dep', kwargs={'dep_id': department.id}), None),
+        ('department_report', 'get', reverse('department_report', kwargs={'dep_id': department.id}),
+         None),
+        ('task_list', 'get', reverse('task_list'), None),
+        ('task_add', 'get', reverse('task_add'), None),
+        ('task_assign', 'get', reverse('task_assign'), None),
+        ('task_detail', 'get', reverse('task_detail', kwargs={'task_id': task.id}), None),
+        ('report_add', 'get', reverse('report_add'), None),
+        ('timesheet', 'get', reverse('timesheet'), {'week': first}),
+        ('report_all_for_employee', 'get', reverse('report_all_for_employee'), None),
+        ('employee_statistics', 'get', reverse('employee_statistics'), None),
+        ('employee_statistics (post)', 'post', reverse('employee_statistics'), statistics),
+        ('employee_statistics (month)', 'post', reverse('employee_statistics'),
+         dict(statistics, group_by='month')),
+        ('report_export', 'get', reverse('report_export', kwargs={'fmt': 'csv'}),
+         {'project': project.id, 'start_date': first, 'end_date': end}),
+        ('autocomplete', 'get', reverse('autocomplete', kwargs={'kind': 'employee'}),
+         {'q': 'bench-user-1'}),
+        ('change_feed', 'get', reverse('change_feed'), {'since': max(latest - 1000, 0)}),
+    ]
+    return requests
+
+# the fixtures were just written, serve them from the change feed anyway
+@override_settings(ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS=0)
+def run_views(client, repeat=10):
+    """Drives every view of ``view_requests()`` ``repeat`` times and returns
+    ``{name: {'status', 'queries', 'p50_ms', 'p95_ms', 'rss_growth_kb'}}``.
+    The first request of each view is included, so cold caches count.
+    Memory is measured like ``middleware.ViewMetricsMiddleware`` does."""
+    results = {}
+    for name, method, path, data in view_requests():
+        times, queries, growths = [], [], []
+        for i in range(repeat):
+            rss = middleware.rss_mark()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.time()
+                response = getattr(client, method)(path, data or {})
+                if response.streaming:
+                    for chunk in response.streaming_content:
+                        pass
+                times.append((time.time() - started) * 1000)
+            queries.append(len(captured))
+            growth = middleware.rss_growth_kb(rss)
+            if growth is not None:
+                growths.append(growth)
+        results[name] = {
+            'status': response.status_code,
+            'queries': max(queries),
+            'p50_ms': middleware.percentile(times, 0.5),
+            'p95_ms': middleware.percentile(times, 0.95),
+            'rss_growth_kb': max(growths) if growths else None,
+        }
+    return results
+
+def regressions(results, baseline, tolerance=0.25):
+    """Lists what got worse than ``baseline``: more queries, or a p95
+    latency or maximum RSS growth more than ``tolerance`` above it."""
+    found = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            found.append('{0}: {1} queries, baseline {2}'.format(
+                         name, result['queries'], base['queries']))
+        for field in ('p95_ms', 'rss_growth_kb'):
+            # most growths are 0, the high-water mark did not move
+            if result.get(field) is None or not base.get(field):
+                continue
+            if result[field] > base[field] * (1 + tolerance):
+                found.append('{0}: {1} {2:.1f}, baseline {3:.1f}'.format(
+                             name, field, result[field], base[field]))
+    return found
+
+def requests_per_second(path, count, cookie='', max_age=0):
+    """Serves ``count`` GET requests of ``path`` through the WSGI handler,
+    so connections are opened and closed as under a server, with
+    ``CONN_MAX_AGE`` set to ``max_age``. Returns the requests per second."""
+    handler = WSGIHandler()
+    factory = RequestFactory()
+    saved = dict((conn.alias, conn.settings_dict['CONN_MAX_AGE']) for conn in connections.all())
+    for conn in connections.all():
+        conn.close()
+        conn.settings_dict['CONN_MAX_AGE'] = max_age
+    try:
+        started = time.time()
+        for i in range(count):
+            response = handler(factory.get(path, HTTP_COOKIE=cookie).environ, lambda *args: None)
+            response.close()
+        return count / (time.time() - started)
+    finally:
+        for conn in connections.all():
+            conn.close()
+            conn.settings_dict['CONN_MAX_AGE'] = saved[conn.alias]
@@ -0,0 +1,190 @@
+from collections import defaultdict, OrderedDict
+
+from django.db import connections, router, transaction
+
+import archive
+import caching
+import changes
+import counters
+import models
+import reporting
+import rollups
+
+
+def upsert_reports(rows):
+    """Writes ``(task_id, date, hours)`` rows honouring the unique
+    ``(task, date)`` key: new pairs are inserted with one ``bulk_create``,
+    existing ones are updated with one UPDATE per table and distinct hour
+    value, in the archive when the pair was archived. The last row wins
+    when a pair repeats. Runs in one transaction and keeps the rollups in
+    step. Returns ``(created, updated)``.
+    """
+    wanted = OrderedDict(((task_id, date), hours) for task_id, date, hours in rows)
+    if not wanted:
+        return 0, 0
+    task_ids = set(task_id for task_id, date in wanted)
+    dates = set(date for task_id, date in wanted)
+    with transaction.atomic():
+        existing = {}
+        for reports in reporting.report_sources(min(dates), max(dates)):
+            reports = reports.filter(task_id__in=task_ids, date__in=dates)
+            for pk, object_id, task_id, date, hours in reports.values_list(
+                    'id', archive.id_field(reports.model), 'task_id', 'date',
+                    'elapsed_time_in_hour'):
+                if (task_id, date) in wanted:
+                    existing[(task_id, date)] = (reports.model, pk, object_id, hours)
+
+        new = []
+        updates = defaultdict(list)
+        deltas = []
+        for (task_id, date), hours in wanted.items():
+            if (task_id, date) not in existing:
+                new.append(models.Report(task_id=task_id, date=date, elapsed_time_in_hour=hours))
+                deltas.append((task_id, date, hours))
+                continue
+            table, pk, object_id, old_hours = existing[(task_id, date)]
+            if old_hours != hours:
+                updates[(table, hours)].append((pk, object_id))
+                deltas.append((task_id, date, hours - old_hours))
+
+        models.Report.objects.bulk_create(new)
+        for (table, hours), ids in updates.items():
+            table.objects.filter(id__in=[pk for pk, object_id in ids]) \
+                         .update(elapsed_time_in_hour=hours)
+        rollups.apply_deltas(deltas)
+        logged = [('report', object_id, models.ChangeLogEntry.UPDATE)
+                  for ids in updates.values() for pk, object_id in ids]
+        if new:
+            # bulk_create does not return the ids
+            inserted = set((report.task_id, report.date) for report in new)
+            reports = models.Report.objects.filter(task_id__in=task_ids, date__in=dates)
+            for pk, task_id, date in reports.values_list('id', 'task_id', 'date'):
+                if (task_id, date) in inserted:
+                    logged.append(('report', pk, models.ChangeLogEntry.CREATE))
+        changes.record(logged)
+    return len(new), sum(len(ids) for ids in updates.values())
+
+def delete_pks(model, pks, using=None, chunk_size=500):
+    """Deletes the ``model`` rows of the primary keys ``pks`` with one
+    ``DELETE ... WHERE pk IN (...)`` per ``chunk_size`` of them. Unlike
+    ``QuerySet.delete`` nothing is loaded or collected and no signal is
+    sent: the rows referring to them must be gone already. Returns the
+    number of rows deleted."""
+    connection = connections[using or router.db_for_write(model)]
+    sql = 'DELETE FROM {0} WHERE {1} IN ({{0}})'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(model._meta.pk.column))
+    pks = list(pks)
+    count = 0
+    cursor = connection.cursor()
+    for start in range(0, len(pks), chunk_size):
+        chunk = pks[start:start + chunk_size]
+        cursor.execute(sql.format(', '.join(['%s'] * len(chunk))), chunk)
+        count += cursor.rowcount
+    return count
+
+def delete_reports(reports):
+    """Deletes the ``reports`` queryset by primary key (``delete_pks``),
+    without loading the rows as objects or sending per-row signals, and
+    takes their hours out of the rollups. Returns the number of deleted
+    reports."""
+    with transaction.atomic():
+        rows = list(reports.select_for_update()
+                           .values_list('pk', archive.id_field(reports.model), 'task_id', 'date',
+                                        'elapsed_time_in_hour'))
+        if not rows:
+            return 0
+        delete_pks(reports.model, [row[0] for row in rows])
+        rollups.apply_deltas((task_id, date, -hours)
+                             for pk, object_id, task_id, date, hours in rows)
+        changes.record(('report', row[1], models.ChangeLogEntry.DELETE) for row in rows)
+    return len(rows)
+
+
+def _delete_chunks(queryset, fields=(), chunk_size=1000, progress=None, deleted=None):
+    """Deletes the ``queryset`` rows in primary key order, ``chunk_size``
+    per DELETE and transaction, so memory and lock time stay bounded.
+    ``deleted(rows)`` gets the ``fields`` values of each chunk inside its
+    transaction, the deletions go to the change feed of logged models,
+    and ``progress(table, count)`` gets the running total after each
+    chunk. Returns the number of deleted rows."""
+    model = queryset.model
+    using = router.db_for_write(model)
+    count = 0
+    while True:
+        with transaction.atomic(using=using):
+            # locked: a concurrent delete of the same rows waits, then finds
+            # them gone, so the deltas are applied once
+            rows = list(queryset.using(using).select_for_update().order_by('pk')
+                                .values_list('pk', archive.id_field(model), *fields)[:chunk_size])
+            if not rows:
+                return count
+            delete_pks(model, [row[0] for row in rows], using)
+            if deleted is not None:
+                deleted([row[2:] for row in rows])
+            if model in changes.NAMES:
+                changes.record((changes.NAMES[model], row[1], models.ChangeLogEntry.DELETE)
+                               for row in rows)
+        count += len(rows)
+        if progress is not None:
+            progress(model._meta.db_table, count)
+
+def _reports_deleted(rows):
+    rollups.apply_deltas((task_id, date, -hours) for task_id, date, hours in rows)
+
+def _tasks_deleted(rows):
+    counters.add({'open_tasks': -sum(1 for row in rows if not row[0])})
+
+def _employees_deleted(rows):
+    changes = defaultdict(int)
+    for row in rows:
+        changes[counters.employees_name(row[0])] -= 1
+    counters.add(changes)
+
+def delete_tasks(tasks, chunk_size=1000, progress=None):
+    """Deletes the ``tasks`` queryset with their reports, archived ones
+    included, chunk by chunk and without loading objects or sending
+    signals; the rollups and counters are kept in step."""
+    for table in archive.TABLES:
+        _delete_chunks(table.objects.filter(task__in=tasks),
+                       ('task_id', 'date', 'elapsed_time_in_hour'),
+                       chunk_size, progress, _reports_deleted)
+    _delete_chunks(models.TaskHours.objects.filter(task__in=tasks), (), chunk_size, progress)
+    count = _delete_chunks(tasks, ('resolved',), chunk_size, progress, _tasks_deleted)
+    caching.bump('task')
+    return count
+
+def delete_project(project, chunk_size=1000, progress=None):
+    """Deletes ``project`` and everything depending on it in chunks."""
+    delete_tasks(models.Task.objects.filter(project=project), chunk_size, progress)
+    _delete_chunks(models.ProjectMonthHours.objects.filter(project=project), (),
+                   chunk_size, progress)
+    # nothing refers to the project anymore, the collector has no rows to walk
+    project.delete()
+
+def delete_employee(employee, chunk_size=1000, progress=None):
+    """Deletes ``employee`` and everything depending on it in chunks.
+    The user account is left alone."""
+    delete_tasks(models.Task.objects.filter(employee=employee), chunk_size, progress)
+    _delete_chunks(models.EmployeeDayHours.objects.filter(employee=employee), (),
+                   chunk_size, progress)
+    employee.delete()
+
+def delete_department(department, chunk_size=1000, progress=None):
+    """Deletes ``department`` with its subdepartments, their employees
+    and everything depending on them in chunks. The user accounts of the
+    employees are left alone, as with ``department.delete()``."""
+    employees = models.Employee.objects.filter(**reporting.subtree(department, 'department__'))
+    delete_tasks(models.Task.objects.filter(employee__in=employees), chunk_size, progress)
+    _delete_chunks(models.EmployeeDayHours.objects.filter(employee__in=employees), (),
+                   chunk_size, progress)
+    _delete_chunks(employees, ('department_id',), chunk_size, progress, _employees_deleted)
+    caching.bump('employee')
+    department.delete()
+
+# name -> (model, delete function), for ``manage.py delete_cascade``
+CASCADES = {
+    'project': (models.Project, delete_project),
+    'employee': (models.Employee, delete_employee),
+    'department': (models.Department, delete_department),
+}
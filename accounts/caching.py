@@ -0,0 +1,113 @@
+"""Version counters of the cached data.
+
+Cached output is stored under the current values of the counters of the
+models it shows, and every write bumps them, orphaning it. The counters
+are CacheVersion rows, so every web worker and management command sees
+the bumps and the cache backend itself may be local to each process.
+
+Bumping a counter row locks it until the transaction ends, so bumps made
+inside writers' transactions would serialize all the writers of a model.
+Requests (``middleware.CacheVersionMiddleware``) and report jobs collect
+their bumps with ``deferred`` instead and bump each counter once after
+their writes committed. Output cached from the new data under the old
+values in between is orphaned by the bump like any other. Writes outside
+of these, in management commands or the shell, bump in place.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+import models
+
+
+def _initial():
+    # a counter row rolled back with its transaction is created again from
+    # the clock, so it does not go back to a value cached data was stored under
+    return int(time.time() * 1000000)
+
+def versions(*names):
+    """Current values of the ``names`` version counters, as a dict."""
+    found = dict(models.CacheVersion.objects.filter(name__in=names).values_list('name', 'value'))
+    return dict((name, found.get(name, 0)) for name in names)
+
+def version(name):
+    """Current value of the ``name`` version counter."""
+    return versions(name)[name]
+
+def _cache_key(name):
+    return 'accounts:version:{0}'.format(name)
+
+def cached_version(name):
+    """Value of the ``name`` version counter read through the cache
+    backend, from the database only on a miss. A bump drops it from the
+    cache of the bumping process; with a backend local to each process,
+    the others see the bump after ACCOUNTS_VERSION_CACHE_TIMEOUT seconds
+    at most."""
+    key = _cache_key(name)
+    value = cache.get(key)
+    if value is None:
+        value = version(name)
+        cache.set(key, value, getattr(settings, 'ACCOUNTS_VERSION_CACHE_TIMEOUT', 30))
+    return value
+
+def bump(*names):
+    """Increments the ``names`` version counters, orphaning everything
+    cached under their previous values. Within ``deferred`` the names are
+    collected and bumped when it flushes."""
+    pending = getattr(_deferred, 'names', None)
+    if pending is not None:
+        pending.update(names)
+    else:
+        _bump(names)
+
+def _bump(names):
+    # always in the same order, so concurrent bumps do not deadlock
+    for name in sorted(names):
+        if models.CacheVersion.objects.filter(name=name).update(value=F('value') + 1):
+            continue
+        try:
+            with transaction.atomic():
+                models.CacheVersion.objects.create(name=name, value=_initial())
+        except IntegrityError:
+            # created concurrently by another writer
+            models.CacheVersion.objects.filter(name=name).update(value=F('value') + 1)
+    cache.delete_many([_cache_key(name) for name in names])
+
+_deferred = threading.local()
+
+def begin_deferred():
+    """Collects the bumps of this thread until ``end_deferred``, bumping
+    whatever an earlier unfinished collection left."""
+    end_deferred()
+    _deferred.names = set()
+
+def flush():
+    """Bumps the counters collected so far; call it once the writes that
+    bumped them committed."""
+    names = getattr(_deferred, 'names', None)
+    if names:
+        _deferred.names = set()
+        _bump(names)
+
+def end_deferred():
+    """Bumps the counters collected and stops collecting."""
+    flush()
+    _deferred.names = None
+
+@contextmanager
+def deferred():
+    """Collects the bumps made inside it and bumps each counter once at
+    the end. Nested in another collection, the outer one bumps them."""
+    if getattr(_deferred, 'names', None) is not None:
+        yield
+        return
+    begin_deferred()
+    try:
+        yield
+    finally:
+        end_deferred()
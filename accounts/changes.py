@@ -0,0 +1,116 @@
+"""Feed of the changes to reports, tasks and projects.
+
+Every save and delete of one of them, through the signals or the bulk
+paths, appends a ChangeLogEntry. Its id is the sequence number: a
+consumer remembers the last one it processed and asks for the entries
+``since`` it. Archiving reports is not a change, the archived ones keep
+their ids as ``report_id``.
+
+Ids are handed out at INSERT but become visible at COMMIT, so a
+transaction still open could later reveal an id below one already
+served, and a consumer past it would never see it. The feed therefore
+holds entries back until they are ``ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS``
+old, and stops before the first one that is not: it serves exactly the
+entries below the lowest id created within the settle window. An entry
+is missed only by a writer whose transaction commits more than the
+settle window after it was written, which is what the setting must
+outlast.
+"""
+import datetime
+from operator import itemgetter
+
+from django.conf import settings
+from django.utils import timezone
+
+import archive
+import models
+import pagination
+
+# name in the feed -> (tables holding the rows, the later ones winning an
+# id both have, fields sent with the entries)
+MODELS = {
+    'report': ((models.ArchivedReport, models.Report),
+               ('id', 'task_id', 'date', 'elapsed_time_in_hour')),
+    'task': ((models.Task,),
+             ('id', 'task_name', 'employee_id', 'project_id', 'description', 'resolved')),
+    'project': ((models.Project,),
+                ('id', 'name', 'description', 'start_date', 'end_date', 'resolved')),
+}
+
+NAMES = {
+    models.Report: 'report',
+    models.ArchivedReport: 'report',
+    models.Task: 'task',
+    models.Project: 'project',
+}
+
+
+def record(entries):
+    """Appends ``(model name, object id, operation)`` entries with one INSERT."""
+    entries = [models.ChangeLogEntry(model=name, object_id=object_id, operation=operation)
+               for name, object_id, operation in entries]
+    if entries:
+        models.ChangeLogEntry.objects.bulk_create(entries)
+
+def object_id(instance):
+    """Id of ``instance`` in the feed."""
+    return getattr(instance, archive.id_field(type(instance)))
+
+def _current(name, ids):
+    """``{id: fields}`` of the ``name`` rows with ``ids`` still existing.
+    A hot report wins over an archived one of the same id: once the Report
+    table hands an archived id out again, the new report is the live one."""
+    tables, fields = MODELS[name]
+    result = {}
+    for table in tables:
+        field = archive.id_field(table)
+        for row in table.objects.filter(**{field + '__in': ids}).values(field, *fields[1:]):
+            row['id'] = row.pop(field)
+            result[row['id']] = row
+    return result
+
+def settled(settle=None):
+    """Entries old enough to be served: those below the lowest id created
+    in the last ``settle`` seconds (ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS if
+    None)."""
+    if settle is None:
+        settle = getattr(settings, 'ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS', 10)
+    entries = models.ChangeLogEntry.objects.all()
+    cutoff = timezone.now() - datetime.timedelta(seconds=settle)
+    recent = entries.filter(created__gt=cutoff).order_by('id').values_list('id', flat=True)[:1]
+    if recent:
+        entries = entries.filter(id__lt=recent[0])
+    return entries
+
+def feed(since=0, chunk_size=1000, settle=None):
+    """Settled entries (see ``settled``) after the ``since`` sequence
+    number, as dicts with ``seq``, ``model``, ``id``, ``operation``,
+    ``created`` and the current ``data`` of the object (None once
+    deleted). Reads ``chunk_size`` entries and one query per model and
+    chunk at a time."""
+    entries = settled(settle).filter(id__gt=since).values_list(
+        'id', 'model', 'object_id', 'operation', 'created')
+    chunk = []
+    for entry in pagination.iterate(entries, chunk_size, key=itemgetter(0)):
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            for change in _with_data(chunk):
+                yield change
+            chunk = []
+    for change in _with_data(chunk):
+        yield change
+
+def _with_data(chunk):
+    ids = {}
+    for seq, name, object_id, operation, created in chunk:
+        ids.setdefault(name, set()).add(object_id)
+    current = dict((name, _current(name, object_ids)) for name, object_ids in ids.items())
+    for seq, name, object_id, operation, created in chunk:
+        yield {
+            'seq': seq,
+            'model': name,
+            'id': object_id,
+            'operation': operation,
+            'created': created,
+            'data': current[name].get(object_id),
+        }
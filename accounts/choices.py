@@ -0,0 +1,196 @@
+"""Choice fields whose options come from the shared cache.
+
+A plain ModelChoiceField renders one option per row and calls ``__str__``
+on every instance, which for employees is a query per option. The fields
+here read ``(pk, label)`` pairs with one ``values_list`` query, keep them
+in the cache under the version counters of the models they show, and
+switch to an autocomplete input once there are too many to list.
+"""
+import hashlib
+import json
+
+from django import forms
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.html import escapejs, format_html
+from django.utils.safestring import mark_safe
+
+import caching
+import models
+import tree
+
+# kind -> (queryset, label field, version counters); the label field is
+# indexed, autocomplete searches it by prefix
+SOURCES = {
+    'employee': (models.Employee.objects.select_related('user'), 'user__username',
+                 ('employee',)),
+    'project': (models.Project.objects.all(), 'name', ('project',)),
+    'task': (models.Task.objects.all(), 'task_name', ('task',)),
+}
+
+
+def choices(queryset, label, names):
+    """``(pk, label)`` pairs of ``queryset`` ordered by label, cached until
+    one of the ``names`` version counters moves."""
+    versions = caching.versions(*names)
+    key = 'accounts:choices:{0}:{1}'.format(
+        '.'.join(str(versions[name]) for name in names),
+        hashlib.md5(u'{0}:{1}'.format(label, queryset.query).encode('utf-8')).hexdigest())
+    result = cache.get(key)
+    if result is None:
+        result = list(queryset.order_by(label).values_list('pk', label))
+        cache.set(key, result, settings.ACCOUNTS_FRAGMENT_CACHE_TIMEOUT)
+    return result
+
+def search(kind, prefix, limit=20):
+    """At most ``limit`` ``(pk, label)`` pairs of ``kind`` whose label starts
+    with ``prefix``."""
+    queryset, label, names = SOURCES[kind]
+    return list(queryset.filter(**{label + '__startswith': prefix})
+                        .order_by(label).values_list('pk', label)[:limit])
+
+
+class AutocompleteInput(forms.TextInput):
+    """Text input for the primary key with a ``<datalist>`` of suggestions
+    fetched from the autocomplete view while typing."""
+
+    script = ('(function(input){{var list=document.getElementById("{0}");'
+              'input.addEventListener("input",function(){{'
+              'var r=new XMLHttpRequest();r.open("GET","{1}?q="+encodeURIComponent(input.value));'
+              'r.onload=function(){{list.innerHTML="";JSON.parse(r.responseText).forEach(function(o){{'
+              'var e=document.createElement("option");e.value=o.id;e.textContent=o.label;'
+              'list.appendChild(e);}});}};r.send();}});}})(document.getElementById("{2}"));')
+
+    def __init__(self, kind, attrs=None):
+        super(AutocompleteInput, self).__init__(attrs)
+        self.kind = kind
+
+    def render(self, name, value, attrs=None):
+        attrs = dict(attrs or {})
+        input_id = attrs.setdefault('id', 'id_' + name)
+        list_id = input_id + '_options'
+        attrs['list'] = list_id
+        url = reverse('autocomplete', kwargs={'kind': self.kind})
+        # the script is JavaScript, not HTML: its strings are escaped for JS
+        script = self.script.format(escapejs(list_id), escapejs(url), escapejs(input_id))
+        return format_html('{0}<datalist id="{1}"></datalist><script>{2}</script>',
+                           super(AutocompleteInput, self).render(name, value, attrs),
+                           list_id, mark_safe(script))
+
+
+class ChoicesOrAutocomplete(forms.Select):
+    """Select that renders as an ``AutocompleteInput`` once it has more
+    than ``ACCOUNTS_CHOICES_LIMIT`` options."""
+
+    def __init__(self, kind, attrs=None, choices=()):
+        super(ChoicesOrAutocomplete, self).__init__(attrs, choices)
+        self.kind = kind
+
+    def render(self, name, value, attrs=None, choices=()):
+        if len(self.choices) > getattr(settings, 'ACCOUNTS_CHOICES_LIMIT', 1000):
+            return AutocompleteInput(self.kind, self.attrs).render(name, value, attrs)
+        return super(ChoicesOrAutocomplete, self).render(name, value, attrs, choices)
+
+
+class CachedChoiceIterator(object):
+    """Options of a ``CachedModelChoiceField``, fetched on first use."""
+
+    def __init__(self, field):
+        self.field = field
+        self.pairs = None
+
+    def _pairs(self):
+        if self.pairs is None:
+            self.pairs = choices(self.field.queryset, self.field.label_field, self.field.names)
+        return self.pairs
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for pair in self._pairs():
+            yield pair
+
+    def __len__(self):
+        return len(self._pairs()) + (self.field.empty_label is not None)
+
+
+class CachedModelChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField over one of the ``SOURCES`` whose options come from
+    the cached ``choices`` and are only looked up when rendered."""
+
+    def __init__(self, kind, queryset=None, *args, **kwargs):
+        self.kind = kind
+        source, self.label_field, self.names = SOURCES[kind]
+        kwargs.setdefault('widget', ChoicesOrAutocomplete(kind))
+        super(CachedModelChoiceField, self).__init__(
+            source if queryset is None else queryset, *args, **kwargs)
+
+    def _get_choices(self):
+        return CachedChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+
+class ParentChoiceIterator(object):
+    """Options of a ``DepartmentParentField``, read when rendered so that
+    the field's ``department_id`` can be set after the form is built."""
+
+    def __init__(self, field):
+        self.field = field
+
+    def _pairs(self):
+        return tree.snapshot().parent_choices(self.field.department_id)
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for pair in self._pairs():
+            yield pair
+
+    def __len__(self):
+        return len(self._pairs()) + (self.field.empty_label is not None)
+
+
+class DepartmentParentField(forms.ModelChoiceField):
+    """Parent of a department: lists the valid parents of the department
+    ``department_id`` (None for a new one) from the ``tree`` snapshot and
+    refuses the department itself and its descendants."""
+
+    default_error_messages = {
+        'invalid_choice': 'A department cannot be moved under itself or its descendants.',
+    }
+
+    def __init__(self, department_id=None, *args, **kwargs):
+        self.department_id = department_id
+        super(DepartmentParentField, self).__init__(models.Department.objects.all(),
+                                                    *args, **kwargs)
+
+    def _get_choices(self):
+        return ParentChoiceIterator(self)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            parent_id = int(value)
+        except (TypeError, ValueError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'],
+                                        code='invalid_choice')
+        if self.department_id is not None:
+            snapshot = tree.snapshot()
+            if self.department_id not in snapshot or parent_id not in snapshot:
+                # created or moved since the snapshot was read: never skip the check
+                snapshot = tree.snapshot(refresh=True)
+            if (self.department_id not in snapshot
+                    or parent_id in snapshot.subtree_ids(self.department_id)):
+                raise forms.ValidationError(self.error_messages['invalid_choice'],
+                                            code='invalid_choice')
+        # the instance itself is read fresh, mptt moves the node by its bounds
+        return super(DepartmentParentField, self).to_python(parent_id)
+
+
+def as_json(pairs):
+    return json.dumps([{'id': pk, 'label': label} for pk, label in pairs])
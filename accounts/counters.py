@@ -0,0 +1,86 @@
+"""Denormalized counters behind the index dashboard.
+
+Each counter is a Counter row changed with ``UPDATE ... value + n``, so
+concurrent writers never lose an increment and the dashboard reads a
+handful of rows instead of counting the task, project and report tables.
+The names are:
+
+``open_tasks``, ``unresolved_projects``
+    tasks and projects not resolved yet
+``hours:<monday>``
+    hours reported in the week starting on that day
+``employees:<department id>``
+    employees of the department (not of its subtree)
+"""
+import datetime
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+
+import archive
+import models
+
+
+def week_of(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+def hours_name(date):
+    return 'hours:{0}'.format(week_of(date).isoformat())
+
+def employees_name(department_id):
+    return 'employees:{0}'.format(department_id)
+
+def add(changes):
+    """Adds ``changes``, ``{name: n}``, to the counters."""
+    with transaction.atomic():
+        for name, value in changes.items():
+            if not value:
+                continue
+            if models.Counter.objects.filter(name=name).update(value=F('value') + value):
+                continue
+            try:
+                with transaction.atomic():
+                    models.Counter.objects.create(name=name, value=value)
+            except IntegrityError:
+                # created concurrently by another writer
+                models.Counter.objects.filter(name=name).update(value=F('value') + value)
+
+def expected():
+    """The counters computed from scratch, as ``{name: value}``."""
+    result = defaultdict(int)
+    result['open_tasks'] = models.Task.objects.filter(resolved=False).count()
+    result['unresolved_projects'] = models.Project.objects.filter(resolved=False).count()
+    for table in archive.TABLES:
+        for row in table.objects.values('date').annotate(
+                hours=Sum('elapsed_time_in_hour')).order_by():
+            result[hours_name(row['date'])] += row['hours']
+    for row in models.Employee.objects.values('department').annotate(
+            count=Count('id')).order_by():
+        result[employees_name(row['department'])] = row['count']
+    return dict(result)
+
+def stored():
+    return dict(models.Counter.objects.values_list('name', 'value'))
+
+def rebuild():
+    counters = expected()
+    with transaction.atomic():
+        models.Counter.objects.all().delete()
+        models.Counter.objects.bulk_create([models.Counter(name=name, value=value)
+                                            for name, value in counters.items()])
+
+def dashboard(today=None):
+    """Dashboard figures, read from the counters and the department names."""
+    week = hours_name(today or datetime.date.today())
+    names = Q(name__in=('open_tasks', 'unresolved_projects', week)) | \
+        Q(name__startswith='employees:')
+    values = dict(models.Counter.objects.filter(names).values_list('name', 'value'))
+    departments = [(name, values.get(employees_name(department_id), 0)) for department_id, name
+                   in models.Department.objects.values_list('id', 'name')]
+    return {
+        'open_tasks': values.get('open_tasks', 0),
+        'unresolved_projects': values.get('unresolved_projects', 0),
+        'week_hours': values.get(week, 0),
+        'department_employees': departments,
+    }
@@ -0,0 +1,10 @@
+"""JSON encoding shared by the job queue, the change feed and the exports."""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def dumps(value):
+    """``value`` as JSON with dates, datetimes and decimals as strings and
+    sorted keys, so equal values encode to equal strings."""
+    return json.dumps(value, cls=DjangoJSONEncoder, sort_keys=True)
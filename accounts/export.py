@@ -0,0 +1,43 @@
+import csv
+from operator import itemgetter
+
+from django.utils.encoding import force_bytes
+
+import archive
+import encoding
+import pagination
+
+COLUMNS = ('id', 'date', 'task', 'employee', 'project', 'elapsed_time_in_hour')
+
+FIELDS = ('id', 'date', 'task__task_name', 'task__employee__user__username',
+          'task__project__name', 'elapsed_time_in_hour')
+
+
+def rows(reports, chunk_size=1000):
+    """Report rows as tuples of ``COLUMNS``, read in primary key chunks.
+    Archived reports show the id they had in the Report table."""
+    fields = (archive.id_field(reports.model),) + FIELDS[1:]
+    chunks = pagination.iterate(reports.values_list('pk', *fields), chunk_size,
+                                key=itemgetter(0))
+    return (row[1:] for row in chunks)
+
+class Echo(object):
+    """File-like object that hands back what is written to it,
+    so csv.writer can format one line at a time."""
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow([force_bytes(value) for value in row])
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield encoding.dumps(dict(zip(COLUMNS, row))) + '\n'
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+}
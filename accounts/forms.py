@@ -1,13 +1,52 @@
+import datetime
+import operator
+from functools import reduce
+
 from django import forms
+from django.db import transaction
+from django.db.models import Q
+from django.forms.formsets import BaseFormSet, formset_factory
+import bulk
+import caching
+import changes
+import choices
+import counters
 import models
+import reporting
 from django.forms.extras import widgets
 from django.contrib.auth.models import User
 
 
 class SelectEmployeeAndDateForm(forms.Form):
-    employee = forms.ModelChoiceField(models.Employee.objects.all()) 
+    employee = choices.CachedModelChoiceField('employee')
     start_date = forms.DateField(widget=widgets.SelectDateWidget())
     end_date = forms.DateField(widget=widgets.SelectDateWidget())
+    group_by = forms.ChoiceField(choices=(('', 'No grouping'),
+                                          ('day', 'Day'),
+                                          ('week', 'Week'),
+                                          ('month', 'Month')), required=False)
+    in_background = forms.BooleanField(required=False)
+
+class DateRangeForm(forms.Form):
+    start_date = forms.DateField(required=False)
+    end_date = forms.DateField(required=False)
+
+class ReportFilterForm(DateRangeForm):
+    employee = choices.CachedModelChoiceField('employee', required=False)
+    project = choices.CachedModelChoiceField('project', required=False)
+
+    def filter(self, reports):
+        """Narrows the ``reports`` queryset down to the cleaned filters."""
+        data = self.cleaned_data
+        if data['employee']:
+            reports = reports.filter(task__employee=data['employee'])
+        if data['project']:
+            reports = reports.filter(task__project=data['project'])
+        if data['start_date']:
+            reports = reports.filter(date__gte=data['start_date'])
+        if data['end_date']:
+            reports = reports.filter(date__lte=data['end_date'])
+        return reports
 
 class EmployeeProfileForm(forms.ModelForm):
    class Meta:
@@ -41,10 +80,151 @@ class EmployeeForm(forms.ModelForm):
         model = models.Employee
 
 class TaskForm(forms.ModelForm):
+    employee = choices.CachedModelChoiceField('employee')
+    project = choices.CachedModelChoiceField('project')
+
     class Meta:
         model = models.Task
 
+class TaskAssignForm(forms.Form):
+    """One row of the bulk assignment screen. Employees and projects are
+    plain choices shared by all rows, so rendering and validating the
+    formset costs no query per row."""
+    task_name = forms.CharField(max_length=100)
+    employee = forms.TypedChoiceField(coerce=int)
+    project = forms.TypedChoiceField(coerce=int)
+    description = forms.CharField(max_length=500, required=False)
+
+    def __init__(self, *args, **kwargs):
+        employees = kwargs.pop('employees', ())
+        projects = kwargs.pop('projects', ())
+        super(TaskAssignForm, self).__init__(*args, **kwargs)
+        self.fields['employee'].choices = employees
+        self.fields['project'].choices = projects
+
+class BaseTaskAssignFormSet(BaseFormSet):
+    def __init__(self, *args, **kwargs):
+        self.employees = [('', '---------')] + [
+            (employee_id, username) for employee_id, username in
+            models.Employee.objects.order_by('user__username').values_list('id', 'user__username')]
+        self.projects = [('', '---------')] + list(
+            models.Project.objects.filter(resolved=False).order_by('name').values_list('id', 'name'))
+        super(BaseTaskAssignFormSet, self).__init__(*args, **kwargs)
+
+    def _construct_form(self, i, **kwargs):
+        kwargs.update(employees=self.employees, projects=self.projects)
+        return super(BaseTaskAssignFormSet, self)._construct_form(i, **kwargs)
+
+    def rows(self):
+        return [form.cleaned_data for form in self.forms
+                if form.cleaned_data and form.has_changed()]
+
+    def clean(self):
+        if any(self.errors):
+            return
+        names = [row['task_name'] for row in self.rows()]
+        duplicates = set(name for name in names if names.count(name) > 1)
+        if duplicates:
+            raise forms.ValidationError('Task names repeat: {0}.'.format(
+                                        ', '.join(sorted(duplicates))))
+        taken = models.Task.objects.filter(task_name__in=names).values_list('task_name', flat=True)
+        if taken:
+            raise forms.ValidationError('Tasks already exist: {0}.'.format(
+                                        ', '.join(sorted(taken))))
+
+    def save(self):
+        """Creates all filled in rows with one INSERT."""
+        tasks = [models.Task(task_name=row['task_name'], employee_id=row['employee'],
+                             project_id=row['project'], description=row['description'])
+                 for row in self.rows()]
+        with transaction.atomic():
+            models.Task.objects.bulk_create(tasks)
+            # bulk_create sends no signals
+            counters.add({'open_tasks': len(tasks)})
+            created = models.Task.objects.filter(task_name__in=[task.task_name for task in tasks])
+            changes.record(('task', pk, models.ChangeLogEntry.CREATE)
+                           for pk in created.values_list('id', flat=True))
+        caching.bump('task')
+        return len(tasks)
+
+TaskAssignFormSet = formset_factory(TaskAssignForm, formset=BaseTaskAssignFormSet, extra=10)
+
+class TimesheetForm(forms.Form):
+    """Hours of an employee's tasks over the 7 days from ``start``, one
+    field per cell, validated as a whole: no day may exceed 24 hours."""
+
+    def __init__(self, *args, **kwargs):
+        employee = kwargs.pop('employee')
+        self.start = kwargs.pop('start')
+        super(TimesheetForm, self).__init__(*args, **kwargs)
+        self.days = [self.start + datetime.timedelta(days=i) for i in range(7)]
+        # archived reports of the week are shown and edited in place
+        self.sources = reporting.report_sources(self.days[0], self.days[-1])
+        self.existing = {}
+        for reports in self.sources:
+            reports = reports.filter(task__employee=employee, date__gte=self.days[0],
+                                     date__lte=self.days[-1])
+            self.existing.update(((task_id, date), hours) for task_id, date, hours in
+                                 reports.values_list('task_id', 'date', 'elapsed_time_in_hour'))
+        reported = set(task_id for task_id, date in self.existing)
+        self.tasks = list(models.Task.objects.filter(employee=employee)
+                                             .order_by('task_name')
+                                             .values_list('id', 'task_name', 'resolved'))
+        self.tasks = [(task_id, name) for task_id, name, resolved in self.tasks
+                      if not resolved or task_id in reported]
+        for task_id, name in self.tasks:
+            for i, day in enumerate(self.days):
+                self.fields[self._name(task_id, i)] = forms.IntegerField(
+                    required=False, min_value=0, max_value=24,
+                    initial=self.existing.get((task_id, day)),
+                    widget=forms.TextInput(attrs={'size': 2}))
+
+    def _name(self, task_id, day):
+        return 'hours_{0}_{1}'.format(task_id, day)
+
+    def grid(self):
+        """``(task_name, [bound field per day])`` rows for the template."""
+        return [(name, [self[self._name(task_id, i)] for i in range(7)])
+                for task_id, name in self.tasks]
+
+    def cells(self):
+        for task_id, name in self.tasks:
+            for i, day in enumerate(self.days):
+                yield task_id, day, self.cleaned_data.get(self._name(task_id, i))
+
+    def clean(self):
+        totals = [0] * 7
+        for task_id, day, hours in self.cells():
+            totals[(day - self.start).days] += hours or 0
+        for day, total in zip(self.days, totals):
+            if total > 24:
+                raise forms.ValidationError('{0} hours reported on {1}.'.format(total, day))
+        return self.cleaned_data
+
+    def save(self):
+        """Writes the filled cells and deletes the reports of emptied ones,
+        with a number of queries that does not grow with the grid."""
+        filled = []
+        emptied = []
+        for task_id, day, hours in self.cells():
+            if hours is not None:
+                if self.existing.get((task_id, day)) != hours:
+                    filled.append((task_id, day, hours))
+            elif (task_id, day) in self.existing:
+                emptied.append((task_id, day))
+        with transaction.atomic():
+            created, updated = bulk.upsert_reports(filled)
+            deleted = 0
+            if emptied:
+                cells = reduce(operator.or_, [Q(task_id=task_id, date=day)
+                                              for task_id, day in emptied])
+                for reports in self.sources:
+                    deleted += bulk.delete_reports(reports.filter(cells))
+        return created, updated, deleted
+
 class ReportForm(forms.ModelForm):
+    task = choices.CachedModelChoiceField('task')
+
     def __init__(self, *args, **kwargs):
         employee = None
         try:
@@ -56,6 +236,17 @@ class ReportForm(forms.ModelForm):
         if employee:
             self.fields['task'].queryset = models.Task.objects.filter(employee__exact=employee)
 
+    def clean(self):
+        cleaned_data = super(ReportForm, self).clean()
+        task, date = cleaned_data.get('task'), cleaned_data.get('date')
+        if task is not None and date is not None:
+            # the unique check of the model form only sees the Report table
+            for reports in reporting.report_sources(date, date)[1:]:
+                if reports.filter(task=task, date=date).exists():
+                    raise forms.ValidationError(
+                        'Hours of this task on {0} are already reported.'.format(date))
+        return cleaned_data
+
     class Meta:
         model = models.Report
 
@@ -76,6 +267,7 @@ class ProjectForm(forms.ModelForm):
 
     
 class DepartmentForm(forms.ModelForm):
+    parent = choices.DepartmentParentField(required=False)
 
     def __init__(self, *args, **kwargs):
         self_exclude = False
@@ -87,7 +279,8 @@ class DepartmentForm(forms.ModelForm):
 
         super(DepartmentForm, self).__init__(*args, **kwargs)
         if self_exclude:
-            self.fields['parent'].queryset = models.Department.objects.exclude(name=self.instance)
+            # the department's whole subtree, not only itself
+            self.fields['parent'].department_id = self.instance.pk
 
     class Meta:
         model = models.Department
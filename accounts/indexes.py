@@ -0,0 +1,86 @@
+"""Index plan for the report query paths.
+
+syncdb only creates indexes together with new tables, so the indexes
+declared on the models are listed here as well and can be added to an
+existing database with ``manage.py sync_indexes``. Names match the ones
+syncdb generates, so both paths end up with the same schema, and the
+indexes already there are left alone.
+"""
+import re
+
+from django.core.management.color import no_style
+from django.db import connection, DatabaseError
+
+import models
+
+PLAN = (
+    # employee_statistics, exports and archival filter reports by date range
+    (models.Report, ('date',)),
+    # open tasks per employee / per project
+    (models.Task, ('employee', 'resolved')),
+    (models.Task, ('project', 'resolved')),
+    # unresolved projects; resolved projects by age for archival
+    (models.Project, ('resolved', 'end_date')),
+    # prefix search of the project autocomplete
+    (models.Project, ('name',)),
+)
+
+_create_re = re.compile(r'CREATE INDEX (\S+) ON (\S+)')
+
+# vendor -> query of the index names of a table
+_EXISTING = {
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+    'postgresql': 'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+    'mysql': ('SELECT DISTINCT index_name FROM information_schema.statistics '
+              'WHERE table_schema = DATABASE() AND table_name = %s'),
+}
+
+
+def create_sql(model, field_names):
+    fields = [model._meta.get_field(name) for name in field_names]
+    return connection.creation.sql_indexes_for_fields(model, fields, no_style())[0]
+
+def index_name(model, field_names):
+    return _create_re.match(create_sql(model, field_names)).group(1).strip('"`')
+
+def existing(model):
+    """Names of the indexes on the table of ``model``, empty where the
+    database cannot be asked."""
+    if connection.vendor not in _EXISTING:
+        return set()
+    cursor = connection.cursor()
+    cursor.execute(_EXISTING[connection.vendor], [model._meta.db_table])
+    return set(row[0] for row in cursor.fetchall())
+
+def missing(plan=PLAN):
+    """The entries of ``plan`` whose index does not exist."""
+    return [(model, fields) for model, fields in plan
+            if index_name(model, fields) not in existing(model)]
+
+def drop_sql(model, field_names):
+    name, table = _create_re.match(create_sql(model, field_names)).groups()
+    if connection.vendor == 'mysql':
+        return 'DROP INDEX {0} ON {1};'.format(name, table)
+    return 'DROP INDEX {0};'.format(name)
+
+def _execute(statements):
+    """Runs each statement on its own, returning ``(sql, error)`` pairs;
+    ``error`` is None on success (DDL commits implicitly on MySQL, so
+    there is no transaction to roll back)."""
+    result = []
+    cursor = connection.cursor()
+    for sql in statements:
+        try:
+            cursor.execute(sql.rstrip(';'))
+            result.append((sql, None))
+        except DatabaseError as e:
+            result.append((sql, e))
+    return result
+
+def create(plan=PLAN):
+    return _execute([create_sql(model, fields) for model, fields in missing(plan)])
+
+def drop(plan=PLAN):
+    missed = missing(plan)
+    return _execute([drop_sql(model, fields) for model, fields in plan
+                     if (model, fields) not in missed])
@@ -0,0 +1,151 @@
+import datetime
+import hashlib
+import json
+import time
+import traceback
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+
+import bulk
+import caching
+import encoding
+import models
+import reporting
+
+
+class JobError(Exception):
+    """Failure of a job explained by its message, with no traceback."""
+
+def _get(model, pk):
+    # the object may be gone by the time a worker runs the job
+    try:
+        return model.objects.get(pk=pk)
+    except model.DoesNotExist:
+        raise JobError('{0} {1} does not exist anymore.'.format(
+                       model._meta.verbose_name.capitalize(), pk))
+
+
+def project_report(params, progress=None):
+    project = _get(models.Project, params['project'])
+    context = reporting.project_summary(project)
+    context['project'] = {'id': project.id, 'name': project.name}
+    return context
+
+def employee_statistics(params, progress=None):
+    employee = _get(models.Employee, params['employee'])
+    # grouped at least by day: the single rows are too many to store
+    return reporting.employee_statistics(employee, params['start_date'],
+                                         params['end_date'], params['group_by'] or 'day')
+
+def delete_project(params, progress=None):
+    project = _get(models.Project, params['project'])
+    bulk.delete_project(project, progress=progress)
+    return {'name': project.name, 'back': 'projects_list'}
+
+def delete_employee(params, progress=None):
+    """Deletes the employees of a user, then the user account."""
+    user = _get(User, params['user'])
+    for employee in models.Employee.objects.filter(user=user):
+        bulk.delete_employee(employee, progress=progress)
+    user.delete()
+    return {'name': user.username, 'back': 'employees_list'}
+
+def delete_department(params, progress=None):
+    department = _get(models.Department, params['department'])
+    bulk.delete_department(department, progress=progress)
+    return {'name': department.name, 'back': 'departments_list'}
+
+# kind -> (function of the params and a ``progress(table, count)`` callback
+# returning a JSON serializable context, template)
+JOBS = {
+    'project_report': (project_report, 'accounts/project_report.html'),
+    'employee_statistics': (employee_statistics, 'accounts/report_all_for_user.html'),
+    'delete_project': (delete_project, 'accounts/deleted.html'),
+    'delete_employee': (delete_employee, 'accounts/deleted.html'),
+    'delete_department': (delete_department, 'accounts/deleted.html'),
+}
+
+
+def submit(kind, params):
+    """Queues a ``kind`` report for ``params``, or returns the pending or
+    running job that already computes the same one. The unique
+    ``active_key`` makes concurrent identical requests share one job."""
+    params = encoding.dumps(params)
+    key = hashlib.sha1('{0}:{1}'.format(kind, params)).hexdigest()
+    # the primary even when called from a replica routed view
+    db = router.db_for_write(models.ReportJob)
+    jobs = models.ReportJob.objects.using(db)
+    while True:
+        try:
+            with transaction.atomic(using=db):
+                return jobs.create(kind=kind, params=params, key=key, active_key=key)
+        except IntegrityError:
+            for job in jobs.filter(active_key=key):
+                return job
+            # it finished in the meantime, queue a new one
+
+def claim():
+    """Marks the oldest pending job as running and returns it, or None.
+    The conditional UPDATE lets several workers poll the same table."""
+    pending = models.ReportJob.objects.filter(status=models.ReportJob.PENDING)
+    for job_id in pending.order_by('id').values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        if pending.filter(id=job_id).update(status=models.ReportJob.RUNNING,
+                                            started=now, heartbeat=now):
+            return models.ReportJob.objects.get(id=job_id)
+    return None
+
+def run(job):
+    function, template = JOBS[job.kind]
+    done = {}
+
+    def progress(table, count):
+        # rows done per table, for the job page while the job runs, and a
+        # sign of life keeping the job from being requeued; the chunks done
+        # are committed, their cached output can go
+        done[table] = count
+        models.ReportJob.objects.filter(id=job.id).update(progress=encoding.dumps(done),
+                                                          heartbeat=timezone.now())
+        caching.flush()
+
+    try:
+        with caching.deferred():
+            job.result = encoding.dumps(function(json.loads(job.params), progress))
+        job.status = models.ReportJob.DONE
+    except JobError as error:
+        job.error = str(error)
+        job.status = models.ReportJob.FAILED
+    except Exception:
+        job.error = traceback.format_exc()
+        job.status = models.ReportJob.FAILED
+    if done:
+        job.progress = encoding.dumps(done)
+    job.finished = timezone.now()
+    job.active_key = None
+    job.save()
+    return job
+
+def requeue(older_than):
+    """Puts jobs back in the queue whose worker died while running them:
+    running jobs without a heartbeat for ``older_than`` seconds. Jobs
+    reporting their progress beat on every step, the others only when
+    they start."""
+    limit = timezone.now() - datetime.timedelta(seconds=older_than)
+    return models.ReportJob.objects.filter(status=models.ReportJob.RUNNING,
+                                           heartbeat__lt=limit) \
+                                   .update(status=models.ReportJob.PENDING, started=None,
+                                           heartbeat=None)
+
+def work(poll_interval=1.0, requeue_after=600, once=False):
+    """Runs jobs until interrupted, or until the queue is empty if ``once``."""
+    while True:
+        requeue(requeue_after)
+        job = claim()
+        if job is not None:
+            run(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from accounts import archive
+
+
+class Command(BaseCommand):
+    help = ('Moves the reports of projects resolved and ended long ago from the Report '
+            'table to the archive.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+                    help='Days since the project ended (ACCOUNTS_ARCHIVE_AFTER_DAYS if unset).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Reports moved per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count the reports that would be moved.'),
+    )
+
+    def handle(self, *args, **options):
+        reports = archive.archivable(options['days'])
+        if options['dry_run']:
+            self.stdout.write('{0} reports to archive.'.format(reports.count()))
+            return
+        moved = archive.archive(reports, options['chunk_size'])
+        self.stdout.write('{0} reports archived.'.format(moved))
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from accounts import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Measures requests per second of a short view with a new database connection '
+            'per request and with persistent connections, on a database filled by '
+            'generate_company.')
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=500,
+                    help='Requests per mode.'),
+        make_option('--url-name', dest='url_name', default='profile',
+                    help='URL name of the view to request.'),
+        make_option('--max-age', type='int', dest='max_age', default=60,
+                    help='CONN_MAX_AGE of the persistent mode.'),
+    )
+
+    def handle(self, *args, **options):
+        client = Client()
+        if not client.login(username='bench-manager', password='bench'):
+            raise CommandError('No bench-manager user, run generate_company first.')
+        cookie = '{0}={1}'.format(settings.SESSION_COOKIE_NAME,
+                                  client.cookies[settings.SESSION_COOKIE_NAME].value)
+        path = reverse(options['url_name'])
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for label, max_age in (('new connection per request', 0),
+                                   ('persistent connections', options['max_age'])):
+                rate = benchmark.requests_per_second(path, options['requests'], cookie, max_age)
+                self.stdout.write('{0}: {1:.0f} requests/s'.format(label, rate))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from accounts import benchmark, indexes
+
+
+class Command(BaseCommand):
+    help = ('Prints query plans and latencies of the report query paths, '
+            'optionally without and with the planned indexes.')
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', action='store_true', dest='seed', default=False,
+                    help='Generate a synthetic dataset first.'),
+        make_option('--employees', type='int', dest='employees', default=50),
+        make_option('--days', type='int', dest='days', default=250),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Runs per query; the median is reported.'),
+        make_option('--compare', action='store_true', dest='compare', default=False,
+                    help='Measure with the planned indexes dropped, then recreated.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            benchmark.seed(employees=options['employees'], days=options['days'])
+        if options['compare']:
+            indexes.drop()
+            self.report('Without planned indexes', options['repeat'])
+            indexes.create()
+        self.report('With planned indexes' if options['compare'] else 'Current schema',
+                    options['repeat'])
+
+    def report(self, title, repeat):
+        self.stdout.write('== {0}'.format(title))
+        for label, queryset in benchmark.query_paths():
+            self.stdout.write('{0}: {1:.2f} ms'.format(label, benchmark.timing(queryset, repeat)))
+            for row in benchmark.explain(queryset):
+                self.stdout.write('    ' + row)
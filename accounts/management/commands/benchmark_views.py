@@ -0,0 +1,43 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from accounts import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Drives every accounts view with the test client on a database filled by '
+            'generate_company and records queries, p50/p95 latency and memory.')
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=10,
+                    help='Requests per view.'),
+        make_option('--output', dest='output', default='bench.json',
+                    help='JSON file the results are written to.'),
+        make_option('--baseline', dest='baseline',
+                    help='Earlier results to compare with; regressions fail the command.'),
+        make_option('--tolerance', type='float', dest='tolerance', default=0.25,
+                    help='Allowed relative slowdown against the baseline.'),
+    )
+
+    def handle(self, *args, **options):
+        client = Client()
+        if not client.login(username='bench-manager', password='bench'):
+            raise CommandError('No bench-manager user, run generate_company first.')
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            results = benchmark.run_views(client, options['repeat'])
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        for name, result in sorted(results.items()):
+            self.stdout.write('{0}: {1} queries, p50 {2:.1f} ms, p95 {3:.1f} ms'.format(
+                              name, result['queries'], result['p50_ms'], result['p95_ms']))
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                found = benchmark.regressions(results, json.load(f), options['tolerance'])
+            for line in found:
+                self.stderr.write(line)
+            if found:
+                raise CommandError('{0} regressions against {1}.'.format(
+                                   len(found), options['baseline']))
@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import bulk
+
+
+class Command(BaseCommand):
+    args = '<{0}> <id>'.format('|'.join(sorted(bulk.CASCADES)))
+    help = ('Deletes a project, employee or department with all the tasks and reports '
+            'depending on it, in chunks with a transaction each, printing the progress.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Rows deleted per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0] not in bulk.CASCADES:
+            raise CommandError('Usage: delete_cascade {0}'.format(self.args))
+        model, delete = bulk.CASCADES[args[0]]
+        try:
+            instance = model.objects.get(pk=args[1])
+        except (model.DoesNotExist, ValueError):
+            raise CommandError('No {0} with id {1}.'.format(args[0], args[1]))
+        self.started = time.time()
+        delete(instance, options['chunk_size'], self.progress)
+        self.stdout.write('Deleted {0} {1} in {2:.1f}s.'.format(
+                          args[0], args[1], time.time() - self.started))
+
+    def progress(self, table, count):
+        self.stdout.write('{0}: {1} rows deleted, {2:.0f}s'.format(
+                          table, count, time.time() - self.started))
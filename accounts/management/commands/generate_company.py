@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from accounts import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Fills an empty database with a synthetic company for load tests: '
+            'a deep department tree, employees, projects, tasks and daily reports.')
+    option_list = BaseCommand.option_list + (
+        make_option('--departments', type='int', dest='departments', default=30),
+        make_option('--depth', type='int', dest='depth', default=6,
+                    help='Maximum levels of the department tree.'),
+        make_option('--employees', type='int', dest='employees', default=200),
+        make_option('--projects', type='int', dest='projects', default=20),
+        make_option('--tasks-per-employee', type='int', dest='tasks_per_employee', default=5),
+        make_option('--years', type='float', dest='years', default=2,
+                    help='Length of the reported period.'),
+        make_option('--random-seed', type='int', dest='random_seed', default=0),
+    )
+
+    def handle(self, *args, **options):
+        benchmark.seed(departments=options['departments'], depth=options['depth'],
+                       employees=options['employees'], projects=options['projects'],
+                       tasks_per_employee=options['tasks_per_employee'],
+                       days=int(options['years'] * 365), random_seed=options['random_seed'])
+        self.stdout.write('Company generated; log in as bench-manager / bench.')
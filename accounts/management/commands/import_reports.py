@@ -0,0 +1,109 @@
+import csv
+import json
+import time
+from optparse import make_option
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from django.utils.encoding import force_text
+
+from accounts import bulk, models
+
+
+def read_csv(path):
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield dict((force_text(key), force_text(value)) for key, value in row.items())
+
+def read_ndjson(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_json(path):
+    # a JSON array has to be parsed as a whole; prefer ndjson for large files
+    with open(path, 'rb') as f:
+        for row in json.load(f):
+            yield row
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+    'jsonl': read_ndjson,
+    'json': read_json,
+}
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Imports reports from a CSV, JSON or NDJSON file with "task", "date" and '
+            '"hours" (or "elapsed_time_in_hour") columns. Existing reports for the same '
+            'task and date are overwritten.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=sorted(READERS),
+                    help='File format, guessed from the extension by default.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Rows validated and written per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_reports {0}'.format(self.args))
+        path = args[0]
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if fmt not in READERS:
+            raise CommandError('Unknown format "{0}", use --format.'.format(fmt))
+
+        self.tasks = dict(models.Task.objects.values_list('task_name', 'id'))
+        self.date_field = forms.DateField()
+        self.created = self.updated = self.failed = 0
+        self.started = time.time()
+
+        chunk = []
+        for number, row in enumerate(READERS[fmt](path), 1):
+            try:
+                chunk.append(self.clean(row))
+            except ValidationError as e:
+                self.failed += 1
+                self.stderr.write('Row {0}: {1}'.format(number, '; '.join(e.messages)))
+            if len(chunk) >= options['chunk_size']:
+                self.write(chunk)
+                chunk = []
+        self.write(chunk)
+        self.stdout.write('Done: {0} created, {1} updated, {2} rejected, {3:.0f} rows/s.'.format(
+                          self.created, self.updated, self.failed, self.rate()))
+
+    def clean(self, row):
+        task_id = self.tasks.get(row.get('task'))
+        if task_id is None:
+            raise ValidationError('unknown task "{0}"'.format(row.get('task')))
+        date = self.date_field.clean(row.get('date'))
+        hours = row.get('hours', row.get('elapsed_time_in_hour'))
+        try:
+            hours = int(hours)
+        except (TypeError, ValueError):
+            raise ValidationError('hours must be an integer')
+        if hours < 0:
+            raise ValidationError('hours must not be negative')
+        return task_id, date, hours
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        try:
+            created, updated = bulk.upsert_reports(chunk)
+        except IntegrityError as e:
+            # a concurrent writer inserted one of the rows; the chunk was rolled back
+            self.failed += len(chunk)
+            self.stderr.write('Chunk of {0} rows rolled back: {1}'.format(len(chunk), e))
+            return
+        self.created += created
+        self.updated += updated
+        self.stdout.write('{0} rows written, {1:.0f} rows/s'.format(
+                          self.created + self.updated, self.rate()))
+
+    def rate(self):
+        return (self.created + self.updated + self.failed) / max(time.time() - self.started, 1e-6)
@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import analytics, models
+
+
+class Command(BaseCommand):
+    args = '<project id>'
+    help = ('Prints the weekly utilization of the staff of a project, who is over or under '
+            'booked, and the burn-down of its hours.')
+    option_list = BaseCommand.option_list + (
+        make_option('--capacity', type='int', dest='capacity', default=None,
+                    help='Hours of a full working week (ACCOUNTS_WEEKLY_CAPACITY if unset).'),
+        make_option('--window', type='int', dest='window', default=4,
+                    help='Weeks of the moving average.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: project_analytics {0}'.format(self.args))
+        try:
+            project = models.Project.objects.get(pk=args[0])
+        except (models.Project.DoesNotExist, ValueError):
+            raise CommandError('No project with id {0}.'.format(args[0]))
+        result = analytics.project_analytics(project, options['capacity'], options['window'])
+        for employee in result['employees']:
+            self.stdout.write('{0}: mean utilization {1:.0%}, {2} weeks moving average {3}'.format(
+                              employee['name'], employee['mean_utilization'], result['window'],
+                              ' '.join('{0:.0%}'.format(share)
+                                       for share in employee['moving_average']) or '-'))
+        self.stdout.write('Over-booked: {0}'.format(', '.join(result['over_booked']) or '-'))
+        self.stdout.write('Under-booked: {0}'.format(', '.join(result['under_booked']) or '-'))
+        for week in result['burndown']:
+            self.stdout.write('{0}: {1} hours, {2} remaining, {3:.0%} spent, {4:.0%} of the '
+                              'window elapsed'.format(week['week'], week['hours'],
+                                                      week['remaining'], week['burned'],
+                                                      week['elapsed']))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import rollups
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the hour rollup tables and dashboard counters from the reports or '
+            'checks them for drift.')
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help='Only report rows that differ from the reports.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help='Rows per INSERT when rebuilding (backend default if unset).'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            rollups.rebuild(batch_size=options['batch_size'])
+            self.stdout.write('Rollups rebuilt.')
+            return
+        drift = rollups.drift()
+        for table, key, expected, stored in drift:
+            self.stdout.write('{0} {1}: expected {2}, stored {3}'.format(table, key, expected, stored))
+        if drift:
+            raise CommandError('{0} rollup rows drifted.'.format(len(drift)))
+        self.stdout.write('Rollups are in sync.')
@@ -0,0 +1,45 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts import jobs
+
+
+def _work(poll_interval, requeue_after, once):
+    jobs.work(poll_interval=poll_interval, requeue_after=requeue_after, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Runs worker processes running the reports and deletes queued in the background.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=2,
+                    help='Number of worker processes.'),
+        make_option('--poll', type='float', dest='poll', default=1.0,
+                    help='Seconds to wait when the queue is empty.'),
+        make_option('--requeue-after', type='int', dest='requeue_after', default=600,
+                    help='Seconds without a heartbeat after which a running job is '
+                         'considered lost and requeued.'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit once the queue is empty.'),
+    )
+
+    def handle(self, *args, **options):
+        args = (options['poll'], options['requeue_after'], options['once'])
+        if options['processes'] <= 1:
+            _work(*args)
+            return
+        # the children must open their own connections
+        for connection in connections.all():
+            connection.close()
+        workers = [multiprocessing.Process(target=_work, args=args)
+                   for i in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
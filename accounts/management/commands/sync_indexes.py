@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from accounts import indexes
+
+
+class Command(BaseCommand):
+    help = ('Creates the indexes of the report query plan missing on an existing '
+            'database.')
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Print the SQL without running it.'),
+        make_option('--drop', action='store_true', dest='drop', default=False,
+                    help='Drop the planned indexes instead.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            missing = indexes.missing()
+            sql = indexes.drop_sql if options['drop'] else indexes.create_sql
+            for model, fields in indexes.PLAN:
+                # the existing indexes are dropped, the missing ones created
+                if ((model, fields) in missing) != options['drop']:
+                    self.stdout.write(sql(model, fields))
+            return
+        results = indexes.drop() if options['drop'] else indexes.create()
+        if not results:
+            self.stdout.write('Nothing to do.')
+        for sql, error in results:
+            if error is None:
+                self.stdout.write(sql)
+            else:
+                self.stdout.write('Skipped {0} ({1})'.format(sql, error))
@@ -0,0 +1,264 @@
+import logging
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.template.base import Template
+
+import caching
+import routers
+
+logger = logging.getLogger('accounts.metrics')
+
+FIELDS = ('time', 'queries', 'db_time', 'template_time', 'rss_growth_kb')
+
+_state = threading.local()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class ViewMetrics(object):
+    """Rolling window of the last samples recorded per URL name."""
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=size))
+
+    def add(self, name, sample):
+        with self.lock:
+            self.samples[name].append(sample)
+
+    def summary(self):
+        """``{url_name: {'count': n, field: {'p50', 'p95', 'max'}}}``."""
+        with self.lock:
+            samples = dict((name, list(values)) for name, values in self.samples.items())
+        result = {}
+        for name, values in samples.items():
+            result[name] = {'count': len(values)}
+            for field in FIELDS:
+                column = [sample[field] for sample in values if sample[field] is not None]
+                if column:
+                    result[name][field] = {'p50': percentile(column, 0.5),
+                                           'p95': percentile(column, 0.95),
+                                           'max': max(column)}
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+metrics = ViewMetrics(getattr(settings, 'ACCOUNTS_METRICS_WINDOW', 500))
+
+
+def _max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 if sys.platform == 'darwin' else float(rss)
+
+def rss_mark():
+    """Starts a measurement of the growth of the process's maximum resident
+    set size, None where the resource module is missing.
+
+    The high-water mark only moves when the code measured needs more
+    memory than the process ever did before, so the growth catches the
+    views allocating beyond what earlier requests did and reads 0 for
+    the others. It is not the memory a view allocated.
+    """
+    if resource is None:
+        return None
+    return _max_rss_kb()
+
+def rss_growth_kb(mark):
+    """Growth of the maximum RSS in KB since ``rss_mark()`` returned ``mark``."""
+    if mark is None:
+        return None
+    return _max_rss_kb() - mark
+
+
+def _timed_render(render):
+    def wrapper(self, context):
+        if getattr(_state, 'template_depth', None) is None:
+            return render(self, context)
+        # included templates are rendered inside the outer one, count it once
+        _state.template_depth += 1
+        started = time.time()
+        try:
+            return render(self, context)
+        finally:
+            _state.template_depth -= 1
+            if not _state.template_depth:
+                _state.template_time += time.time() - started
+    wrapper.timed = True
+    return wrapper
+
+if not getattr(Template.render, 'timed', False):
+    Template.render = _timed_render(Template.render)
+
+
+class ViewMetricsMiddleware(object):
+    """Measures every resolved view: wall time, SQL query count and time,
+    template render time and the growth of the maximum RSS (see
+    ``rss_mark``). Samples go to ``metrics`` keyed by URL name, are added
+    as X-View-* headers in DEBUG mode, and the SQL is logged when a view
+    exceeds its query threshold.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or not match.url_name:
+            return None
+        debug_cursors = {}
+        for connection in connections.all():
+            debug_cursors[connection.alias] = (connection.use_debug_cursor, len(connection.queries))
+            connection.use_debug_cursor = True
+        request._view_metrics = (match.url_name, time.time(), debug_cursors, rss_mark())
+        _state.template_depth = 0
+        _state.template_time = 0.0
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_view_metrics'):
+            return response
+        name, started, debug_cursors, rss = request._view_metrics
+        del request._view_metrics
+        queries = []
+        for connection in connections.all():
+            if connection.alias not in debug_cursors:
+                continue
+            use_debug_cursor, offset = debug_cursors[connection.alias]
+            queries.extend(connection.queries[offset:])
+            connection.use_debug_cursor = use_debug_cursor
+        sample = {
+            'time': (time.time() - started) * 1000,
+            'queries': len(queries),
+            'db_time': sum(float(query['time']) for query in queries) * 1000,
+            'template_time': getattr(_state, 'template_time', 0.0) * 1000,
+            'rss_growth_kb': rss_growth_kb(rss),
+        }
+        _state.template_depth = None
+        metrics.add(name, sample)
+
+        if settings.DEBUG:
+            response['X-View-Name'] = name
+            response['X-View-Time-Ms'] = '{0:.1f}'.format(sample['time'])
+            response['X-View-Queries'] = str(sample['queries'])
+            response['X-View-DB-Time-Ms'] = '{0:.1f}'.format(sample['db_time'])
+            response['X-View-Template-Time-Ms'] = '{0:.1f}'.format(sample['template_time'])
+            if sample['rss_growth_kb'] is not None:
+                response['X-View-RSS-Growth-Kb'] = '{0:.0f}'.format(sample['rss_growth_kb'])
+
+        thresholds = getattr(settings, 'ACCOUNTS_QUERY_THRESHOLDS', {})
+        threshold = thresholds.get(name, getattr(settings, 'ACCOUNTS_QUERY_THRESHOLD', 50))
+        if sample['queries'] > threshold:
+            logger.warning('{0} ran {1} queries (threshold {2}):\n{3}'.format(
+                           name, sample['queries'], threshold,
+                           '\n'.join(query['sql'] for query in queries)))
+        return response
+
+
+class ReplicaPinningMiddleware(object):
+    """Pins a user to the primary database for a while after one of their
+    requests wrote to it, with a cookie that the ``routers.use_replica``
+    views check through ``request.pinned_to_primary``."""
+
+    cookie = 'pin_primary'
+
+    def process_request(self, request):
+        request.pinned_to_primary = self.cookie in request.COOKIES
+        routers.reset_writes()
+        return None
+
+    def process_response(self, request, response):
+        if routers.wrote():
+            response.set_cookie(self.cookie, '1',
+                                max_age=getattr(settings, 'ACCOUNTS_REPLICA_PIN_SECONDS', 10),
+                                httponly=True)
+        return response
+
+
+class CacheVersionMiddleware(object):
+    """Bumps the version counters written by a request once, when its
+    response is done and its writes committed, rather than in each
+    writer's transaction (see ``caching``)."""
+
+    def process_request(self, request):
+        caching.begin_deferred()
+        return None
+
+    def process_response(self, request, response):
+        caching.end_deferred()
+        return response
+
+
+class ConnectionPoolMiddleware(object):
+    """Manages the persistent connections kept with ``CONN_MAX_AGE``.
+
+    Before a request, an idle connection that was not checked for
+    ``ACCOUNTS_DB_HEALTH_CHECK_INTERVAL`` seconds is pinged and dropped if
+    the server went away. A connection whose request raised a database
+    error is closed rather than reused. At most ``ACCOUNTS_DB_POOL_SIZE``
+    threads of the process keep a connection open between requests; the
+    others close theirs when the response is done. Threads that ended are
+    dropped from the holders once the pool is full.
+    """
+
+    lock = threading.Lock()
+    holders = defaultdict(set)
+
+    def process_request(self, request):
+        interval = getattr(settings, 'ACCOUNTS_DB_HEALTH_CHECK_INTERVAL', 30)
+        now = time.time()
+        for connection in connections.all():
+            if connection.connection is None:
+                self._release(connection)
+            elif now - getattr(connection, 'health_checked', 0) >= interval:
+                connection.health_checked = now
+                if not connection.is_usable():
+                    connection.close()
+                    self._release(connection)
+        return None
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, DatabaseError):
+            for connection in connections.all():
+                if connection.connection is not None:
+                    connection.close()
+                    self._release(connection)
+        return None
+
+    def process_response(self, request, response):
+        size = getattr(settings, 'ACCOUNTS_DB_POOL_SIZE', 10)
+        thread = self._thread()
+        for connection in connections.all():
+            if connection.connection is None or connection.close_at is None:
+                continue
+            with self.lock:
+                holders = self.holders[connection.alias]
+                if thread not in holders and len(holders) >= size:
+                    holders.intersection_update(self._alive())
+                if thread in holders or len(holders) < size:
+                    holders.add(thread)
+                    continue
+            connection.close()
+        return response
+
+    def _thread(self):
+        return threading.current_thread().ident
+
+    def _alive(self):
+        return set(thread.ident for thread in threading.enumerate())
+
+    def _release(self, connection):
+        with self.lock:
+            self.holders[connection.alias].discard(self._thread())
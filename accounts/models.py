@@ -1,3 +1,5 @@
+import json
+
 from django.db import models
 from django.contrib.auth.models import User
 from mptt.models import MPTTModel, TreeForeignKey
@@ -21,12 +23,15 @@ class Employee(models.Model):
         return self.user.username
 
 class Project(models.Model):
-    name = models.CharField(max_length=100)
+    name = models.CharField(max_length=100, db_index=True)
     description = models.CharField(max_length=500)
     start_date = models.DateField()
     end_date = models.DateField()
     resolved = models.BooleanField(default=False)
 
+    class Meta:
+        index_together = [('resolved', 'end_date')]
+
     def __str__(self):
         return self.name
 
@@ -37,13 +42,119 @@ class Task(models.Model):
     description = models.CharField(max_length=500, null=True)
     resolved = models.BooleanField(default=False)
 
+    class Meta:
+        index_together = [('employee', 'resolved'), ('project', 'resolved')]
+
     def __str__(self):
         return self.task_name
 
 class Report(models.Model):
     task = models.ForeignKey(Task)
-    date = models.DateField()
+    date = models.DateField(db_index=True)
     elapsed_time_in_hour = models.PositiveIntegerField()
 
     class Meta:
         unique_together = ('task', 'date')
+
+class ArchivedReport(models.Model):
+    """Report of a long resolved project, moved out of the Report table by
+    ``manage.py archive_reports``. ``report_id`` is its id in the Report
+    table, the one the change feed and the exports show. The archive has
+    a primary key of its own: the Report table may hand an id out again."""
+    report_id = models.IntegerField(db_index=True)
+    task = models.ForeignKey(Task)
+    date = models.DateField(db_index=True)
+    elapsed_time_in_hour = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('task', 'date')
+
+class TaskHours(models.Model):
+    """Total hours reported on a task, maintained by accounts.rollups."""
+    task = models.OneToOneField(Task, primary_key=True)
+    hours = models.IntegerField(default=0)
+
+class EmployeeDayHours(models.Model):
+    """Hours reported by an employee on a calendar day."""
+    employee = models.ForeignKey(Employee)
+    date = models.DateField()
+    hours = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('employee', 'date')
+
+class ProjectMonthHours(models.Model):
+    """Hours reported on a project in a calendar month (first day of month)."""
+    project = models.ForeignKey(Project)
+    month = models.DateField()
+    hours = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('project', 'month')
+
+class Counter(models.Model):
+    """Dashboard counter, maintained by accounts.counters."""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+
+class CacheVersion(models.Model):
+    """Version counter of cached data, maintained by accounts.caching."""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField()
+
+class ChangeLogEntry(models.Model):
+    """A report, task or project was created, updated or deleted; written
+    by accounts.changes. The id is the sequence number of the feed."""
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    OPERATION_CHOICES = (
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    )
+
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
+
+class ReportJob(models.Model):
+    """Report or cascade delete run in the background by
+    ``manage.py run_report_workers``."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=50)
+    params = models.TextField()
+    # identical requests share the key and are computed once
+    key = models.CharField(max_length=40, db_index=True)
+    # the key while pending or running, so only one such job exists per key
+    active_key = models.CharField(max_length=40, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    result = models.TextField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    # JSON {table: rows done} of the jobs reporting their progress
+    progress = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    # refreshed with the progress: a running job without one for long lost its worker
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('status', 'id')]
+
+    def progress_rows(self):
+        """``(table, rows done)`` pairs sorted by table."""
+        return sorted(json.loads(self.progress).items()) if self.progress else []
+
+import signals
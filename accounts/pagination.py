@@ -0,0 +1,123 @@
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+
+
+def page_size(request):
+    """Page size from the ``limit`` parameter, bounded by the settings."""
+    default = getattr(settings, 'ACCOUNTS_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'ACCOUNTS_MAX_PAGE_SIZE', 500)
+    try:
+        size = int(request.GET.get('limit', default))
+    except ValueError:
+        size = default
+    return max(1, min(size, maximum))
+
+def paginate(request, queryset, ordering=('id',)):
+    """Keyset page of ``queryset`` for the ``after``/``before`` cursor of the request."""
+    return KeysetPage(queryset, ordering, size=page_size(request),
+                      after=request.GET.get('after'), before=request.GET.get('before'))
+
+def iterate(queryset, chunk_size=1000, key=attrgetter('pk')):
+    """Iterates over ``queryset`` in primary key order, fetching ``chunk_size``
+    rows per query so memory stays bounded however large the table is.
+    ``key`` extracts the primary key from a row (e.g. ``itemgetter(0)``
+    for a ``values_list`` starting with ``id``)."""
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        last = key(chunk[-1])
+
+
+class KeysetPage(object):
+    """One page of a queryset ordered by ``ordering`` (ascending, ending
+    with a unique field), located by seeking past a cursor instead of an
+    OFFSET so the cost of a page does not depend on its position.
+
+    The queryset is evaluated lazily, on first use of the page.
+    """
+    def __init__(self, queryset, ordering, size, after=None, before=None):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.size = size
+        self.after = after
+        self.before = None if after else before
+        self._objects = None
+
+    def _field(self, name):
+        opts = self.queryset.model._meta
+        return opts.pk if name == 'pk' else opts.get_field(name)
+
+    def _decode(self, cursor):
+        values = cursor.split('.')
+        if len(values) != len(self.ordering):
+            raise Http404
+        try:
+            return [self._field(name).to_python(value)
+                    for name, value in zip(self.ordering, values)]
+        except ValidationError:
+            raise Http404
+
+    def cursor(self, obj):
+        return '.'.join(str(getattr(obj, name)) for name in self.ordering)
+
+    def _seek(self, cursor, lookup):
+        values = self._decode(cursor)
+        condition = Q()
+        for i, name in enumerate(self.ordering):
+            equal = dict(zip(self.ordering[:i], values[:i]))
+            equal['{0}__{1}'.format(name, lookup)] = values[i]
+            condition |= Q(**equal)
+        return self.queryset.filter(condition)
+
+    def _fetch(self):
+        if self._objects is not None:
+            return
+        if self.before:
+            queryset = self._seek(self.before, 'lt').order_by(
+                *['-' + name for name in self.ordering])
+            objects = list(queryset[:self.size + 1])
+            self.has_previous = len(objects) > self.size
+            self.has_next = True
+            objects = objects[:self.size][::-1]
+        else:
+            queryset = self.queryset
+            if self.after:
+                queryset = self._seek(self.after, 'gt')
+            objects = list(queryset.order_by(*self.ordering)[:self.size + 1])
+            self.has_next = len(objects) > self.size
+            self.has_previous = bool(self.after)
+            objects = objects[:self.size]
+        self._objects = objects
+        if not objects:
+            self.has_next = self.has_previous = False
+
+    @property
+    def object_list(self):
+        self._fetch()
+        return self._objects
+
+    @property
+    def next_cursor(self):
+        self._fetch()
+        return self.cursor(self._objects[-1]) if self.has_next else None
+
+    @property
+    def previous_cursor(self):
+        self._fetch()
+        return self.cursor(self._objects[0]) if self.has_previous else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
@@ -0,0 +1,66 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+import caching
+
+
+def _key(user_id, name, version):
+    return 'accounts:auth:{0}:{1}:{2}'.format(version, user_id, name)
+
+def _cached(user, name, compute):
+    """Looks ``name`` up on the user object first (lives for the request),
+    then in the shared cache, and only computes it on a miss. The 'auth'
+    version counter keying it is read through the cache as well."""
+    local = user.__dict__.setdefault('_auth_cache', {})
+    if name not in local:
+        if 'version' not in local:
+            local['version'] = caching.cached_version('auth')
+        key = _key(user.pk, name, local['version'])
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, getattr(settings, 'ACCOUNTS_AUTH_CACHE_TIMEOUT', 600))
+        local[name] = value
+    return local[name]
+
+def group_names(user):
+    """Names of the groups ``user`` belongs to."""
+    return _cached(user, 'groups',
+                   lambda: frozenset(user.groups.values_list('name', flat=True)))
+
+def signature(user):
+    """Short string that differs between users whose accounts permissions
+    differ, for keying cached output that depends on them."""
+    if not user.is_authenticated():
+        return 'anonymous'
+    if not user.is_active:
+        return 'inactive'
+    if user.is_superuser and user.is_active:
+        return 'superuser'
+    perms = sorted(perm for perm in user.get_all_permissions() if perm.startswith('accounts.'))
+    return hashlib.md5(','.join(perms)).hexdigest()
+
+def invalidate(user_ids):
+    """Drops the cached groups and permissions of the given users."""
+    version = caching.cached_version('auth')
+    cache.delete_many([_key(user_id, name, version)
+                       for user_id in user_ids for name in ('groups', 'perms')])
+
+def invalidate_all():
+    caching.bump('auth')
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose permission sets are kept in the shared cache,
+    so the template ``perms`` lookups cost no queries once cached."""
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if user_obj.is_anonymous() or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            compute = lambda: super(CachedModelBackend, self).get_all_permissions(user_obj)
+            user_obj._perm_cache = _cached(user_obj, 'perms', compute)
+        return user_obj._perm_cache
@@ -0,0 +1,168 @@
+import bisect
+import datetime
+import heapq
+
+from django.db.models import Count, Sum
+
+import archive
+import models
+import tree
+
+
+_date_field = models.Report._meta.get_field('date')
+
+def report_sources(start_date=None, end_date=None):
+    """Querysets of the tables holding reports dated between the inclusive
+    bounds: the Report table, plus the archive when the range starts on
+    or before the last archived day."""
+    sources = [models.Report.objects.all()]
+    until = archive.archived_until()
+    if until is not None and (start_date is None or _date_field.to_python(start_date) <= until):
+        sources.append(models.ArchivedReport.objects.all())
+    return sources
+
+def hours_by(reports, *fields):
+    """Sums elapsed hours of the ``reports`` queryset grouped by ``fields``
+    in a single query. Returns a values queryset with an ``hours`` key."""
+    return reports.values(*fields).annotate(
+        hours=Sum('elapsed_time_in_hour')).order_by(*fields)
+
+def total_hours(reports):
+    """Sum of elapsed hours for the ``reports`` queryset."""
+    return reports.aggregate(hours=Sum('elapsed_time_in_hour'))['hours'] or 0
+
+def task_hours(tasks):
+    """Maps task name to total hours for the ``tasks`` queryset.
+    Tasks without reports are included with 0 hours."""
+    rows = tasks.annotate(hours=Sum('report__elapsed_time_in_hour')) \
+                .values_list('task_name', 'hours')
+    return dict((name, hours or 0) for name, hours in rows)
+
+def employee_hours(reports):
+    """Maps employee id to total hours for the ``reports`` queryset."""
+    return dict((row['task__employee'], row['hours'])
+                for row in hours_by(reports, 'task__employee'))
+
+def project_hours(reports):
+    """Maps project id to total hours for the ``reports`` queryset."""
+    return dict((row['task__project'], row['hours'])
+                for row in hours_by(reports, 'task__project'))
+
+def rollup_task_hours(tasks):
+    """Same as ``task_hours`` but read from the TaskHours rollup,
+    one row per task instead of a scan over the reports."""
+    rows = tasks.values_list('task_name', 'taskhours__hours')
+    return dict((name, hours or 0) for name, hours in rows)
+
+def employee_day_hours(employee, start_date=None, end_date=None):
+    """Per-day hours of ``employee`` as ``[(date, hours)]`` read from the
+    EmployeeDayHours rollup. Date bounds are inclusive."""
+    days = models.EmployeeDayHours.objects.filter(employee=employee, hours__gt=0)
+    if start_date:
+        days = days.filter(date__gte=start_date)
+    if end_date:
+        days = days.filter(date__lte=end_date)
+    return list(days.order_by('date').values_list('date', 'hours'))
+
+def project_summary(project):
+    """Context for the project report: hours per task and their sum."""
+    task_reports = rollup_task_hours(models.Task.objects.filter(project=project))
+    return {
+        'task_reports': task_reports,
+        'summary_time': sum(task_reports.values()),
+    }
+
+PERIODS = {
+    'day': lambda date: date,
+    'week': lambda date: date - datetime.timedelta(days=date.weekday()),
+    'month': lambda date: date.replace(day=1),
+}
+
+def period_hours(day_hours, period):
+    """Folds ``[(date, hours)]`` into ``[(period_start, hours)]`` for
+    ``period`` in PERIODS."""
+    start_of = PERIODS[period]
+    result = []
+    for date, hours in day_hours:
+        start = start_of(date)
+        if result and result[-1][0] == start:
+            result[-1] = (start, result[-1][1] + hours)
+        else:
+            result.append((start, hours))
+    return result
+
+def _by_date(reports, source):
+    # ordered by the id in the Report table, which the Report table may
+    # hand out again once archived: the source ends ties before the reports do
+    field = archive.id_field(reports.model)
+    for report in reports.select_related('task').order_by('date', field):
+        yield report.date, getattr(report, field), source, report
+
+def employee_statistics(employee, start_date, end_date, group_by=''):
+    """Hours of ``employee`` between the inclusive dates: per task, per
+    day/week/month (``group_by``, per day by default), and the single
+    reports unless grouped."""
+    sources = [source.filter(task__employee=employee, date__gte=start_date, date__lte=end_date)
+               for source in report_sources(start_date, end_date)]
+    task_hours = {}
+    for reports in sources:
+        for row in hours_by(reports, 'task__task_name'):
+            name = row['task__task_name']
+            task_hours[name] = task_hours.get(name, 0) + row['hours']
+    day_hours = employee_day_hours(employee, start_date, end_date)
+    context = {
+        'group_by': group_by,
+        'task_hours': sorted(task_hours.items()),
+        'periods': period_hours(day_hours, group_by or 'day'),
+        'summary_time': sum(hours for date, hours in day_hours),
+    }
+    if not group_by:
+        if len(sources) == 1:
+            context['reports'] = sources[0].select_related('task').order_by('date', 'id')
+        else:
+            merged = heapq.merge(*[_by_date(reports, i) for i, reports in enumerate(sources)])
+            context['reports'] = [report for date, pk, i, report in merged]
+    return context
+
+def subtree(department, prefix=''):
+    """Filter arguments selecting ``department`` and all its descendants
+    through the ``prefix`` relation, as one nested set range."""
+    return {
+        prefix + 'tree_id': department.tree_id,
+        prefix + 'lft__gte': department.lft,
+        prefix + 'rght__lte': department.rght,
+    }
+
+def department_rollup(department, start_date=None, end_date=None):
+    """Hours (between the inclusive dates) and headcount of ``department``
+    with all its descendants, in total, for the department itself and per
+    child subtree. Takes two queries however deep the tree is, the
+    children come from the ``tree`` snapshot."""
+    children = tree.snapshot().children(department.id)
+    days = models.EmployeeDayHours.objects.filter(**subtree(department, 'employee__department__'))
+    if start_date:
+        days = days.filter(date__gte=start_date)
+    if end_date:
+        days = days.filter(date__lte=end_date)
+    hours = days.values_list('employee__department__lft').annotate(Sum('hours')).order_by()
+    heads = models.Employee.objects.filter(**subtree(department, 'department__')) \
+                          .values_list('department__lft').annotate(Count('id')).order_by()
+
+    own = {'department': department, 'hours': 0, 'headcount': 0}
+    rows = [{'department': child, 'hours': 0, 'headcount': 0} for child in children]
+    lefts = [child.lft for child in children]
+    for field, values in (('hours', hours), ('headcount', heads)):
+        for lft, value in values:
+            # a node's lft falls in the range of the child subtree holding it
+            i = bisect.bisect_right(lefts, lft) - 1
+            if i < 0 or lft > children[i].rght:
+                own[field] += value or 0
+            else:
+                rows[i][field] += value or 0
+    return {
+        'department': department,
+        'own': own,
+        'children': rows,
+        'hours': own['hours'] + sum(row['hours'] for row in rows),
+        'headcount': own['headcount'] + sum(row['headcount'] for row in rows),
+    }
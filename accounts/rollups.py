@@ -0,0 +1,175 @@
+import operator
+from functools import reduce
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+
+import archive
+import caching
+import counters
+import models
+
+_date_field = models.Report._meta.get_field('date')
+
+
+def month_of(date):
+    return date.replace(day=1)
+
+def apply_deltas(deltas):
+    """Adds hour changes to the rollup tables.
+
+    ``deltas`` is an iterable of ``(task_id, date, hours)`` tuples where
+    ``hours`` is the signed change of reported time on that task and day.
+    """
+    deltas = [(task_id, _date_field.to_python(date), hours)
+              for task_id, date, hours in deltas if hours]
+    if not deltas:
+        return
+    task_ids = set(task_id for task_id, date, hours in deltas)
+    owners = dict((task_id, (employee_id, project_id)) for task_id, employee_id, project_id in
+                  models.Task.objects.filter(id__in=task_ids)
+                                     .values_list('id', 'employee_id', 'project_id'))
+    rows = []
+    for task_id, date, hours in deltas:
+        employee_id, project_id = owners[task_id]
+        rows.append((task_id, employee_id, project_id, date, hours))
+    _apply(rows)
+    weeks = defaultdict(int)
+    for task_id, date, hours in deltas:
+        weeks[counters.hours_name(date)] += hours
+    counters.add(weeks)
+
+def move_task(task_id, old_employee_id, old_project_id, employee_id, project_id):
+    """Moves the hours of a reassigned task between employee and project rollups."""
+    rows = []
+    for table in archive.TABLES:
+        days = table.objects.filter(task_id=task_id).values('date') \
+                            .annotate(hours=Sum('elapsed_time_in_hour')).order_by()
+        for day in days:
+            rows.append((None, old_employee_id, old_project_id, day['date'], -day['hours']))
+            rows.append((None, employee_id, project_id, day['date'], day['hours']))
+    _apply(rows)
+
+def _apply(rows):
+    tasks = defaultdict(int)
+    employee_days = defaultdict(int)
+    project_months = defaultdict(int)
+    for task_id, employee_id, project_id, date, hours in rows:
+        if task_id is not None:
+            tasks[task_id] += hours
+        employee_days[(employee_id, date)] += hours
+        project_months[(project_id, month_of(date))] += hours
+
+    with transaction.atomic():
+        _add_all(models.TaskHours, ('task_id',),
+                 dict(((task_id,), hours) for task_id, hours in tasks.items()))
+        _add_all(models.EmployeeDayHours, ('employee_id', 'date'), employee_days)
+        _add_all(models.ProjectMonthHours, ('project_id', 'month'), project_months)
+    # pages showing reported hours are versioned by it
+    caching.bump('report')
+
+def _matching(fields, keys):
+    return reduce(operator.or_, [Q(**dict(zip(fields, key))) for key in keys])
+
+def _add_all(model, fields, changes, chunk_size=100):
+    """Adds ``changes``, ``{key tuple: hours}``, to the ``model`` rows keyed
+    by ``fields``. Per chunk of keys this costs one SELECT, one UPDATE per
+    distinct change and one INSERT for the missing rows, however many rows
+    change."""
+    changes = [(key, hours) for key, hours in changes.items() if hours]
+    for i in range(0, len(changes), chunk_size):
+        chunk = dict(changes[i:i + chunk_size])
+        existing = set(model.objects.filter(_matching(fields, chunk)).values_list(*fields))
+        updates = defaultdict(list)
+        missing = []
+        for key, hours in chunk.items():
+            if key in existing:
+                updates[hours].append(key)
+            elif hours > 0:
+                # see _add about negative changes of missing rows
+                missing.append((key, hours))
+        for hours, keys in updates.items():
+            model.objects.filter(_matching(fields, keys)).update(hours=F('hours') + hours)
+        if not missing:
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([model(hours=hours, **dict(zip(fields, key)))
+                                           for key, hours in missing])
+        except IntegrityError:
+            # some were created concurrently by another writer
+            for key, hours in missing:
+                _add(model, dict(zip(fields, key)), hours)
+
+def _add(model, lookup, hours):
+    if not hours:
+        return
+    if model.objects.filter(**lookup).update(hours=F('hours') + hours) or hours < 0:
+        # a missing row can only be subtracted from while its owner is being
+        # deleted; recreating it would break the cascade
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(hours=hours, **lookup)
+    except IntegrityError:
+        # created concurrently by another writer
+        model.objects.filter(**lookup).update(hours=F('hours') + hours)
+
+def expected():
+    """Computes the rollup contents from scratch out of the Report table
+    and its archive."""
+    tasks = defaultdict(int)
+    employee_days = defaultdict(int)
+    project_months = defaultdict(int)
+    for table in archive.TABLES:
+        for row in table.objects.values('task').annotate(
+                hours=Sum('elapsed_time_in_hour')).order_by():
+            tasks[row['task']] += row['hours']
+        for row in table.objects.values('task__employee', 'date').annotate(
+                hours=Sum('elapsed_time_in_hour')).order_by():
+            employee_days[(row['task__employee'], row['date'])] += row['hours']
+        for row in table.objects.values('task__project', 'date').annotate(
+                hours=Sum('elapsed_time_in_hour')).order_by():
+            project_months[(row['task__project'], month_of(row['date']))] += row['hours']
+    return dict(tasks), dict(employee_days), dict(project_months)
+
+def stored():
+    """Current rollup contents in the same shape as ``expected()``."""
+    tasks = dict(models.TaskHours.objects.values_list('task_id', 'hours'))
+    employee_days = dict(((employee_id, date), hours) for employee_id, date, hours in
+                         models.EmployeeDayHours.objects.values_list('employee_id', 'date', 'hours'))
+    project_months = dict(((project_id, month), hours) for project_id, month, hours in
+                          models.ProjectMonthHours.objects.values_list('project_id', 'month', 'hours'))
+    return tasks, employee_days, project_months
+
+def drift():
+    """Lists ``(table, key, expected, stored)`` for every rollup row that is
+    out of sync with the Report table."""
+    names = ('task', 'employee_day', 'project_month', 'counter')
+    result = []
+    for name, want, have in zip(names, expected() + (counters.expected(),),
+                                stored() + (counters.stored(),)):
+        for key in set(want) | set(have):
+            if want.get(key, 0) != have.get(key, 0):
+                result.append((name, key, want.get(key, 0), have.get(key, 0)))
+    return result
+
+def rebuild(batch_size=None):
+    """Recreates all rollup rows from the Report table, and the counters."""
+    tasks, employee_days, project_months = expected()
+    with transaction.atomic():
+        models.TaskHours.objects.all().delete()
+        models.EmployeeDayHours.objects.all().delete()
+        models.ProjectMonthHours.objects.all().delete()
+        models.TaskHours.objects.bulk_create(
+            [models.TaskHours(task_id=task_id, hours=hours)
+             for task_id, hours in tasks.items()], batch_size=batch_size)
+        models.EmployeeDayHours.objects.bulk_create(
+            [models.EmployeeDayHours(employee_id=employee_id, date=date, hours=hours)
+             for (employee_id, date), hours in employee_days.items()], batch_size=batch_size)
+        models.ProjectMonthHours.objects.bulk_create(
+            [models.ProjectMonthHours(project_id=project_id, month=month, hours=hours)
+             for (project_id, month), hours in project_months.items()], batch_size=batch_size)
+    counters.rebuild()
+    caching.bump('report')
@@ -0,0 +1,62 @@
+"""Sends the reads of reporting views to read replicas.
+
+Views wrapped in ``use_replica`` read from one of the aliases listed in
+``settings.DATABASE_REPLICAS``; every other read and all writes go to
+``default``. ReplicaPinningMiddleware keeps a user on ``default`` for
+``ACCOUNTS_REPLICA_PIN_SECONDS`` after a request of theirs wrote, so they
+see their own changes whatever the replication lag.
+"""
+import random
+import threading
+from functools import wraps
+
+from django.conf import settings
+
+_state = threading.local()
+
+
+def replicas():
+    return tuple(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+def use_replica(view):
+    """Runs ``view`` with its reads on a replica chosen for the request,
+    unless the user is pinned to the primary."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if getattr(request, 'pinned_to_primary', False) or not replicas():
+            return view(request, *args, **kwargs)
+        previous = getattr(_state, 'replica', None)
+        _state.replica = random.choice(replicas())
+        try:
+            response = view(request, *args, **kwargs)
+            # template responses would otherwise be rendered, and their
+            # querysets read, after the replica is switched off
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            return response
+        finally:
+            _state.replica = previous
+    return wrapper
+
+def reset_writes():
+    _state.wrote = False
+
+def wrote():
+    """Whether anything was routed for writing since ``reset_writes``."""
+    return getattr(_state, 'wrote', False)
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db not in replicas()
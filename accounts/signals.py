@@ -0,0 +1,152 @@
+from django.contrib.auth.models import Group, Permission, User
+from django.db.models.signals import m2m_changed, post_init, post_save, post_delete
+from django.dispatch import receiver
+
+import caching
+import changes
+import counters
+import models
+import permissions
+import rollups
+
+
+def _report_state(report):
+    return (report.task_id, report.date, report.elapsed_time_in_hour)
+
+@receiver(post_init, sender=models.Report)
+@receiver(post_init, sender=models.ArchivedReport)
+def remember_report(sender, instance, **kwargs):
+    instance._rollup_state = _report_state(instance) if instance.pk else None
+
+@receiver(post_save, sender=models.Report)
+def report_saved(sender, instance, **kwargs):
+    deltas = [(instance.task_id, instance.date, instance.elapsed_time_in_hour)]
+    if getattr(instance, '_rollup_state', None):
+        task_id, date, hours = instance._rollup_state
+        deltas.append((task_id, date, -hours))
+    rollups.apply_deltas(deltas)
+    instance._rollup_state = _report_state(instance)
+
+@receiver(post_delete, sender=models.Report)
+@receiver(post_delete, sender=models.ArchivedReport)
+def report_deleted(sender, instance, **kwargs):
+    if getattr(instance, '_rollup_state', None):
+        task_id, date, hours = instance._rollup_state
+        rollups.apply_deltas([(task_id, date, -hours)])
+
+
+@receiver(post_init, sender=models.Task)
+def remember_task(sender, instance, **kwargs):
+    instance._rollup_owner = (instance.employee_id, instance.project_id) if instance.pk else None
+
+@receiver(post_save, sender=models.Task)
+def task_saved(sender, instance, **kwargs):
+    owner = (instance.employee_id, instance.project_id)
+    old_owner = getattr(instance, '_rollup_owner', None)
+    if old_owner and old_owner != owner:
+        rollups.move_task(instance.pk, *(old_owner + owner))
+    instance._rollup_owner = owner
+
+
+@receiver(post_init, sender=models.Task)
+@receiver(post_init, sender=models.Project)
+def remember_resolved(sender, instance, **kwargs):
+    instance._counter_resolved = instance.resolved if instance.pk else None
+
+OPEN_COUNTERS = {
+    models.Task: 'open_tasks',
+    models.Project: 'unresolved_projects',
+}
+
+@receiver(post_save, sender=models.Task)
+@receiver(post_save, sender=models.Project)
+def resolved_saved(sender, instance, created, **kwargs):
+    was_open = not created and instance._counter_resolved is False
+    counters.add({OPEN_COUNTERS[sender]: int(not instance.resolved) - int(was_open)})
+    instance._counter_resolved = instance.resolved
+
+@receiver(post_delete, sender=models.Task)
+@receiver(post_delete, sender=models.Project)
+def resolved_deleted(sender, instance, **kwargs):
+    if instance._counter_resolved is False:
+        counters.add({OPEN_COUNTERS[sender]: -1})
+
+@receiver(post_init, sender=models.Employee)
+def remember_department(sender, instance, **kwargs):
+    instance._counter_department = instance.department_id if instance.pk else None
+
+@receiver(post_save, sender=models.Employee)
+def employee_saved(sender, instance, created, **kwargs):
+    old = instance._counter_department
+    if created or old != instance.department_id:
+        changes = {counters.employees_name(instance.department_id): 1}
+        if not created and old is not None:
+            changes[counters.employees_name(old)] = -1
+        counters.add(changes)
+    instance._counter_department = instance.department_id
+
+@receiver(post_delete, sender=models.Employee)
+def employee_deleted(sender, instance, **kwargs):
+    if instance._counter_department is not None:
+        counters.add({counters.employees_name(instance._counter_department): -1})
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_auth_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        permissions.invalidate([instance.pk])
+    elif pk_set is not None and sender is User.groups.through:
+        permissions.invalidate(pk_set)
+    else:
+        permissions.invalidate_all()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        permissions.invalidate_all()
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    permissions.invalidate([instance.pk])
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def auth_changed(sender, **kwargs):
+    permissions.invalidate_all()
+
+
+VERSIONED = {
+    models.Department: ('department',),
+    models.Employee: ('employee',),
+    models.Project: ('project',),
+    models.Task: ('task',),
+    # usernames are shown for employees
+    User: ('employee',),
+}
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_versions(sender, **kwargs):
+    names = VERSIONED.get(sender)
+    if names:
+        caching.bump(*names)
+
+
+@receiver(post_save)
+def log_saved(sender, instance, created, **kwargs):
+    name = changes.NAMES.get(sender)
+    if name:
+        operation = models.ChangeLogEntry.CREATE if created else models.ChangeLogEntry.UPDATE
+        changes.record([(name, changes.object_id(instance), operation)])
+
+@receiver(post_delete)
+def log_deleted(sender, instance, **kwargs):
+    name = changes.NAMES.get(sender)
+    if name:
+        changes.record([(name, changes.object_id(instance), models.ChangeLogEntry.DELETE)])
@@ -1,7 +1,40 @@
-from django.test import TestCase
-from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User, Group
+import datetime
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, connections
+from django.db import router, transaction
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+from django.utils import timezone, unittest
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.test.utils import patch_logger
+from django.core.urlresolvers import resolve, reverse
+from django.contrib.auth.models import User, Group, Permission
+import analytics
+import archive
+import benchmark
+import bulk
+import caching
+import changes
+import counters
+import forms
+import indexes
+import jobs
+import middleware
 import models
+import pagination
+import reporting
+import rollups
+import routers
+import tree
 
 def create_employee(username, password, department, group=None):
     """
@@ -187,6 +220,8 @@ class AccountsTests(TestCase):
         self.client.login(username='user100', password='123')
         response = self.client.post(reverse('delete_dep', kwargs={'dep_id': department.id}),
                                     follow=True)
+        self.assertContains(response, 'pending')
+        jobs.work(once=True)
         departments = models.Department.objects.all()
         self.assertEqual(len(departments), 0)
         response = self.client.get(reverse('detail_dep', kwargs={'dep_id': department.id}))
@@ -199,3 +234,1517 @@ class AccountsTests(TestCase):
         response = self.client.post(reverse('delete_dep', kwargs={'dep_id': 99999}),
                                     follow=True)
         self.assertEqual(response.status_code, 404)
+
+
+class ProjectReportTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.client.login(username='user100', password='123')
+
+    def test_project_report_sums_hours_per_task(self):
+        first = models.Task.objects.create(task_name='first', employee=self.employee,
+                                           project=self.project)
+        models.Task.objects.create(task_name='second', employee=self.employee,
+                                   project=self.project)
+        for day, hours in ((1, 3), (2, 5)):
+            models.Report.objects.create(task=first, date=datetime.date(2014, 2, day),
+                                         elapsed_time_in_hour=hours)
+        response = self.client.get(reverse('project_report',
+                                           kwargs={'prj_id': self.project.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['task_reports'], {'first': 8, 'second': 0})
+        self.assertEqual(response.context['summary_time'], 8)
+
+    def test_report_export_streams_filtered_rows(self):
+        task = models.Task.objects.create(task_name='first', employee=self.employee,
+                                          project=self.project)
+        for day in range(1, 4):
+            models.Report.objects.create(task=task, date=datetime.date(2014, 2, day),
+                                         elapsed_time_in_hour=day)
+        response = self.client.get(reverse('report_export', kwargs={'fmt': 'csv'}),
+                                   {'project': self.project.id, 'start_date': '2014-02-02'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(lines[0], b'id,date,task,employee,project,elapsed_time_in_hour')
+        self.assertEqual([line.split(b',')[1:] for line in lines[1:]],
+                         [[b'2014-02-02', b'first', b'user100', b'Site', b'2'],
+                          [b'2014-02-03', b'first', b'user100', b'Site', b'3']])
+
+        response = self.client.get(reverse('report_export', kwargs={'fmt': 'ndjson'}),
+                                   {'end_date': '2014-02-01'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['date'], '2014-02-01')
+        self.assertEqual(rows[0]['elapsed_time_in_hour'], 1)
+
+    def test_iterate_reads_in_chunks(self):
+        task = models.Task.objects.create(task_name='first', employee=self.employee,
+                                          project=self.project)
+        for day in range(1, 6):
+            models.Report.objects.create(task=task, date=datetime.date(2014, 2, day),
+                                         elapsed_time_in_hour=day)
+        with self.assertNumQueries(3):
+            hours = [report.elapsed_time_in_hour for report in
+                     pagination.iterate(models.Report.objects.all(), chunk_size=2)]
+        self.assertEqual(hours, [1, 2, 3, 4, 5])
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department)
+        self.other = create_employee('user200', '123', department)
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.task = models.Task.objects.create(task_name='first', employee=self.employee,
+                                               project=self.project)
+
+    def test_rollups_follow_report_changes(self):
+        day = datetime.date(2014, 2, 3)
+        report = models.Report.objects.create(task=self.task, date=day, elapsed_time_in_hour=3)
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 4),
+                                     elapsed_time_in_hour=2)
+        self.assertEqual(models.TaskHours.objects.get(task=self.task).hours, 5)
+        self.assertEqual(models.EmployeeDayHours.objects.get(employee=self.employee, date=day).hours, 3)
+        self.assertEqual(models.ProjectMonthHours.objects.get(project=self.project).hours, 5)
+
+        report = models.Report.objects.get(pk=report.pk)
+        report.elapsed_time_in_hour = 7
+        report.save()
+        self.assertEqual(models.TaskHours.objects.get(task=self.task).hours, 9)
+
+        report.delete()
+        self.assertEqual(models.TaskHours.objects.get(task=self.task).hours, 2)
+        self.assertEqual(models.EmployeeDayHours.objects.get(employee=self.employee, date=day).hours, 0)
+        self.assertEqual(rollups.drift(), [])
+
+    def test_rollups_follow_task_reassignment(self):
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 3),
+                                     elapsed_time_in_hour=4)
+        task = models.Task.objects.get(pk=self.task.pk)
+        task.employee = self.other
+        task.save()
+        self.assertEqual(reporting.employee_day_hours(self.employee), [])
+        self.assertEqual(reporting.employee_day_hours(self.other),
+                         [(datetime.date(2014, 2, 3), 4)])
+        self.assertEqual(rollups.drift(), [])
+
+    def test_rebuild_fixes_drift(self):
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 3),
+                                     elapsed_time_in_hour=4)
+        models.TaskHours.objects.update(hours=1)
+        self.assertEqual(len(rollups.drift()), 1)
+        rollups.rebuild()
+        self.assertEqual(rollups.drift(), [])
+
+
+class DepartmentsListTests(TestCase):
+    def test_departments_list_query_count_does_not_grow(self):
+        department = models.Department.objects.create(name='Dev')
+        create_employee('user100', '123', department, group='manager')
+        self.client.login(username='user100', password='123')
+        cache.clear()
+        with CaptureQueriesContext(connection) as small:
+            response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'user100')
+
+        for i in range(3):
+            child = models.Department.objects.create(name='Dev{0}'.format(i), parent=department)
+            for j in range(3):
+                create_employee('user{0}{1}'.format(i, j), '123', child)
+        cache.clear()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'user22')
+        self.assertEqual(len(large), len(small))
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employees = [create_employee('user{0}'.format(i), '123', department)
+                          for i in range(5)]
+        self.client.login(username='user0', password='123')
+
+    def test_employees_list_keyset_pages(self):
+        response = self.client.get(reverse('employees_list'), {'limit': 2})
+        page = response.context['page']
+        self.assertEqual(list(page), self.employees[:2])
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+
+        response = self.client.get(reverse('employees_list'),
+                                   {'limit': 2, 'after': page.next_cursor})
+        page = response.context['page']
+        self.assertEqual(list(page), self.employees[2:4])
+        self.assertTrue(page.has_previous)
+
+        response = self.client.get(reverse('employees_list'),
+                                   {'limit': 2, 'before': page.previous_cursor})
+        self.assertEqual(list(response.context['page']), self.employees[:2])
+
+        response = self.client.get(reverse('employees_list'),
+                                   {'limit': 2, 'after': self.employees[3].id})
+        page = response.context['page']
+        self.assertEqual(list(page), self.employees[4:])
+        self.assertFalse(page.has_next)
+
+    def test_reports_are_paged_by_date(self):
+        project = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        task = models.Task.objects.create(task_name='first', employee=self.employees[0],
+                                          project=project)
+        for day in (5, 1, 3):
+            models.Report.objects.create(task=task, date=datetime.date(2014, 2, day),
+                                         elapsed_time_in_hour=1)
+        response = self.client.get(reverse('report_all_for_employee'), {'limit': 2})
+        page = response.context['page']
+        self.assertEqual([r.date.day for r in page], [1, 3])
+        response = self.client.get(reverse('report_all_for_employee'),
+                                   {'limit': 2, 'after': page.next_cursor})
+        self.assertEqual([r.date.day for r in response.context['page']], [5])
+        self.assertEqual(response.context['summary_time'], 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('task_list'), {'after': 'abc'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_projects_list_is_paged(self):
+        for i in range(3):
+            models.Project.objects.create(name='p{0}'.format(i), description='',
+                                          start_date=datetime.date(2014, 1, 1),
+                                          end_date=datetime.date(2014, 12, 31))
+        response = self.client.get(reverse('projects_list'), {'limit': 2})
+        self.assertEqual([p.name for p in response.context['all_projects']], ['p0', 'p1'])
+        self.assertContains(response, 'after=')
+
+
+class ImportReportsTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        employee = create_employee('user100', '123', department)
+        project = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        self.task = models.Task.objects.create(task_name='first', employee=employee,
+                                               project=project)
+
+    def test_upsert_reports(self):
+        day = datetime.date(2014, 2, 3)
+        models.Report.objects.create(task=self.task, date=day, elapsed_time_in_hour=2)
+        created, updated = bulk.upsert_reports([
+            (self.task.id, day, 5),
+            (self.task.id, datetime.date(2014, 2, 4), 1),
+            (self.task.id, datetime.date(2014, 2, 4), 3),
+        ])
+        self.assertEqual((created, updated), (1, 1))
+        self.assertEqual(dict(models.Report.objects.values_list('date', 'elapsed_time_in_hour')),
+                         {day: 5, datetime.date(2014, 2, 4): 3})
+        self.assertEqual(models.TaskHours.objects.get(task=self.task).hours, 8)
+        self.assertEqual(rollups.drift(), [])
+
+    def test_import_reports_command(self):
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 3),
+                                     elapsed_time_in_hour=2)
+        source = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        source.write(b'task,date,hours\n'
+                     b'first,2014-02-03,6\n'
+                     b'first,2014-02-04,4\n'
+                     b'missing,2014-02-04,4\n'
+                     b'first,not a date,4\n')
+        source.close()
+        out, err = StringIO(), StringIO()
+        try:
+            call_command('import_reports', source.name, chunk_size=1, stdout=out, stderr=err)
+        finally:
+            os.unlink(source.name)
+        self.assertIn('1 created, 1 updated, 2 rejected', out.getvalue())
+        self.assertIn('Row 3: unknown task "missing"', err.getvalue())
+        self.assertEqual(models.TaskHours.objects.get(task=self.task).hours, 10)
+
+
+class PermissionCacheTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        permission = Permission.objects.get(codename='add_department')
+        Group.objects.get(name='manager').permissions.add(permission)
+        self.client.login(username='user100', password='123')
+
+    def auth_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'Add new department')
+        return [q['sql'] for q in queries if 'auth_group' in q['sql'] or 'auth_permission' in q['sql']]
+
+    def test_groups_and_permissions_are_cached(self):
+        self.assertNotEqual(self.auth_queries(), [])
+        self.assertEqual(self.auth_queries(), [])
+        response = self.client.get(reverse('add_dep'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_auth_version_is_read_from_the_cache(self):
+        self.auth_queries()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('add_dep'))
+        self.assertEqual([q['sql'] for q in queries if "'auth'" in q['sql']], [])
+        # a process that has not cached it reads it once
+        cache.delete('accounts:version:auth')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('add_dep'))
+        self.assertEqual(len([q['sql'] for q in queries if "'auth'" in q['sql']]), 1)
+
+    def test_group_change_invalidates_cache(self):
+        response = self.client.get(reverse('add_dep'))
+        self.assertEqual(response.status_code, 200)
+        self.employee.user.groups.clear()
+        response = self.client.get(reverse('add_dep'))
+        self.assertRedirects(response, '/login/?next=/departments/add')
+        response = self.client.get(reverse('departments_list'))
+        self.assertNotContains(response, 'Add new department')
+
+
+class BulkEntryTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.client.login(username='user100', password='123')
+
+    def assign(self, names):
+        data = {'form-TOTAL_FORMS': len(names), 'form-INITIAL_FORMS': 0,
+                'form-MAX_NUM_FORMS': 1000}
+        for i, name in enumerate(names):
+            data.update({'form-{0}-task_name'.format(i): name,
+                         'form-{0}-employee'.format(i): self.employee.id,
+                         'form-{0}-project'.format(i): self.project.id})
+        return self.client.post(reverse('task_assign'), data)
+
+    def test_task_assign_queries_do_not_grow(self):
+        # the open task counter exists from then on
+        models.Task.objects.create(task_name='first', employee=self.employee,
+                                   project=self.project)
+        self.client.get(reverse('task_assign'))
+        with CaptureQueriesContext(connection) as few:
+            response = self.assign(['a{0}'.format(i) for i in range(2)])
+        # captured lazily, before assertRedirects requests the next page
+        few = len(few)
+        self.assertRedirects(response, reverse('task_list'))
+        with CaptureQueriesContext(connection) as many:
+            self.assign(['b{0}'.format(i) for i in range(40)])
+        self.assertEqual(few, len(many))
+        self.assertEqual(models.Task.objects.count(), 43)
+        self.assertEqual(rollups.drift(), [])
+
+    def test_task_assign_validates_names(self):
+        response = self.assign(['a', 'a'])
+        self.assertContains(response, 'Task names repeat: a.')
+        models.Task.objects.create(task_name='b', employee=self.employee, project=self.project)
+        response = self.assign(['b', 'c'])
+        self.assertContains(response, 'Tasks already exist: b.')
+        self.assertEqual(models.Task.objects.count(), 1)
+
+    def test_timesheet(self):
+        tasks = [models.Task.objects.create(task_name='t{0}'.format(i), employee=self.employee,
+                                            project=self.project) for i in range(3)]
+        monday = datetime.date(2014, 2, 3)
+        models.Report.objects.create(task=tasks[0], date=monday, elapsed_time_in_hour=2)
+        models.Report.objects.create(task=tasks[1], date=monday, elapsed_time_in_hour=2)
+        url = reverse('timesheet') + '?week=2014-02-05'
+        response = self.client.get(url)
+        self.assertEqual(response.context['form'].start, monday)
+
+        def cell(task, day):
+            return 'hours_{0}_{1}'.format(task.id, day)
+        data = dict((cell(task, day), 3) for task in tasks for day in range(7))
+        data[cell(tasks[1], 0)] = ''
+        response = self.client.post(url, data)
+        self.assertRedirects(response, reverse('timesheet') + '?week=2014-02-03')
+        self.assertEqual(models.Report.objects.count(), 20)
+        self.assertFalse(models.Report.objects.filter(task=tasks[1], date=monday).exists())
+        self.assertEqual(models.Report.objects.get(task=tasks[0], date=monday)
+                                             .elapsed_time_in_hour, 3)
+        self.assertEqual(rollups.drift(), [])
+
+        data[cell(tasks[1], 0)] = 20
+        response = self.client.post(url, data)
+        self.assertContains(response, '26 hours reported on 2014-02-03.')
+        self.assertEqual(models.Report.objects.count(), 20)
+
+    def test_timesheet_queries_do_not_grow(self):
+        def fill(week, tasks):
+            self.client.get(reverse('timesheet'))
+            with CaptureQueriesContext(connection) as captured:
+                self.client.post(reverse('timesheet') + '?week=' + week,
+                                 dict(('hours_{0}_{1}'.format(task.id, day), 1)
+                                      for task in tasks for day in range(7)))
+            return len(captured)
+        tasks = [models.Task.objects.create(task_name='t{0}'.format(i), employee=self.employee,
+                                            project=self.project) for i in range(20)]
+        # the report version counter exists from then on
+        caching.bump('report')
+        self.assertEqual(fill('2014-02-03', tasks[:1]), fill('2014-03-03', tasks[1:]))
+        self.assertEqual(models.Report.objects.count(), 140)
+        self.assertEqual(rollups.drift(), [])
+
+
+class CascadeDeleteTests(TestCase):
+    def setUp(self):
+        self.company = models.Department.objects.create(name='Company')
+        self.dev = models.Department.objects.create(name='Dev', parent=self.company)
+        self.qa = models.Department.objects.create(name='QA', parent=self.dev)
+        self.manager = create_employee('manager', '123', self.company, group='manager')
+        self.developer = create_employee('developer', '123', self.dev)
+        self.tester = create_employee('tester', '123', self.qa)
+        self.site = models.Project.objects.create(name='Site', description='',
+                                                  start_date=datetime.date(2014, 1, 1),
+                                                  end_date=datetime.date(2014, 12, 31))
+        self.app = models.Project.objects.create(name='App', description='',
+                                                 start_date=datetime.date(2014, 1, 1),
+                                                 end_date=datetime.date(2014, 12, 31))
+        for employee in (self.manager, self.developer, self.tester):
+            for project in (self.site, self.app):
+                task = models.Task.objects.create(
+                    task_name='{0}-{1}'.format(employee, project), employee=employee,
+                    project=project)
+                for day in range(1, 4):
+                    models.Report.objects.create(task=task, date=datetime.date(2014, 2, day),
+                                                 elapsed_time_in_hour=day)
+        archive.archive(models.Report.objects.filter(date=datetime.date(2014, 2, 1)))
+        self.client.login(username='manager', password='123')
+
+    def test_delete_project_in_chunks(self):
+        progress = []
+        bulk.delete_project(self.site, chunk_size=2,
+                            progress=lambda table, count: progress.append((table, count)))
+        self.assertFalse(models.Project.objects.filter(pk=self.site.pk).exists())
+        self.assertFalse(models.Task.objects.filter(project=self.site.pk).exists())
+        self.assertEqual(models.Report.objects.count(), 6)
+        self.assertEqual(models.ArchivedReport.objects.count(), 3)
+        self.assertEqual(rollups.drift(), [])
+        self.assertIn((models.Report._meta.db_table, 6), progress)
+        self.assertEqual([count for table, count in progress
+                          if table == models.Report._meta.db_table], [2, 4, 6])
+
+    def test_delete_pks(self):
+        ids = list(models.Report.objects.filter(task__project=self.app)
+                                        .order_by('id').values_list('id', flat=True))
+        with CaptureQueriesContext(connection) as captured:
+            deleted = bulk.delete_pks(models.Report, ids[:3] + [max(ids) + 1000], chunk_size=2)
+        self.assertEqual(deleted, 3)
+        # one statement per chunk of ids
+        self.assertEqual(len(captured), 2)
+        self.assertTrue(all('DELETE FROM "accounts_report" WHERE' in q['sql'] for q in captured))
+        self.assertEqual(sorted(models.Report.objects.filter(task__project=self.app)
+                                                     .values_list('id', flat=True)), ids[3:])
+        self.assertEqual(bulk.delete_pks(models.Report, []), 0)
+
+    def test_delete_department_subtree(self):
+        response = self.client.post(reverse('delete_dep', kwargs={'dep_id': self.dev.id}))
+        job = models.ReportJob.objects.get()
+        self.assertRedirects(response, reverse('report_job', kwargs={'job_id': job.id}))
+        self.assertTrue(models.Department.objects.filter(pk=self.dev.pk).exists())
+        jobs.work(once=True)
+        response = self.client.get(reverse('report_job', kwargs={'job_id': job.id}))
+        self.assertContains(response, 'Dev was deleted.')
+        self.assertContains(response, 'accounts_report: 8 rows deleted')
+        self.assertContains(response, reverse('departments_list'))
+        self.assertEqual(list(models.Department.objects.values_list('name', flat=True)),
+                         ['Company'])
+        self.assertEqual(list(models.Employee.objects.all()), [self.manager])
+        self.assertTrue(User.objects.filter(username='tester').exists())
+        self.assertEqual(models.Task.objects.count(), 2)
+        self.assertEqual(rollups.drift(), [])
+        self.assertEqual(counters.dashboard()['department_employees'], [('Company', 1)])
+
+    def test_delete_employee_view(self):
+        response = self.client.post(reverse('employee_delete',
+                                            kwargs={'usr_id': self.developer.user_id}))
+        job = models.ReportJob.objects.get()
+        self.assertRedirects(response, reverse('report_job', kwargs={'job_id': job.id}))
+        jobs.work(once=True)
+        self.assertFalse(User.objects.filter(username='developer').exists())
+        self.assertFalse(models.Employee.objects.filter(pk=self.developer.pk).exists())
+        self.assertEqual(models.Task.objects.count(), 4)
+        self.assertEqual(rollups.drift(), [])
+
+    def test_job_progress(self):
+        job = jobs.submit('delete_project', {'project': self.app.id})
+        jobs.run(job)
+        self.assertEqual(job.status, models.ReportJob.DONE)
+        progress = dict(models.ReportJob.objects.get(pk=job.pk).progress_rows())
+        self.assertEqual(progress[models.Report._meta.db_table], 6)
+        self.assertEqual(progress[models.ArchivedReport._meta.db_table], 3)
+        self.assertFalse(models.Project.objects.filter(pk=self.app.pk).exists())
+
+    def test_target_gone_before_the_job_runs(self):
+        project_id = self.app.id
+        job = jobs.submit('delete_project', {'project': project_id})
+        bulk.delete_project(self.app)
+        jobs.work(once=True)
+        job = models.ReportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, models.ReportJob.FAILED)
+        self.assertEqual(job.error, 'Project {0} does not exist anymore.'.format(project_id))
+        response = self.client.get(reverse('report_job', kwargs={'job_id': job.id}))
+        self.assertContains(response, 'does not exist anymore')
+
+    def test_progress_keeps_long_jobs_from_being_requeued(self):
+        jobs.submit('delete_project', {'project': self.app.id})
+        job = jobs.claim()
+        long_ago = job.started - datetime.timedelta(hours=1)
+        running = models.ReportJob.objects.filter(pk=job.pk)
+        running.update(started=long_ago, heartbeat=long_ago)
+        requeued = []
+
+        def delete_project(params, progress=None):
+            bulk.delete_project(models.Project.objects.get(pk=params['project']),
+                                chunk_size=2, progress=progress)
+            # another worker polling while this one is still at it
+            requeued.append(jobs.requeue(600))
+            return {'name': 'App', 'back': 'projects_list'}
+        function, template = jobs.JOBS['delete_project']
+        jobs.JOBS['delete_project'] = (delete_project, template)
+        try:
+            jobs.run(job)
+        finally:
+            jobs.JOBS['delete_project'] = (function, template)
+        self.assertEqual(requeued, [0])
+        self.assertEqual(rollups.drift(), [])
+        # without a heartbeat for long the worker is taken for dead
+        running.update(status=models.ReportJob.RUNNING, heartbeat=long_ago)
+        self.assertEqual(jobs.requeue(600), 1)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('delete_cascade', 'project', str(self.app.id), chunk_size=4, stdout=out)
+        self.assertIn('accounts_report: 6 rows deleted', out.getvalue())
+        self.assertFalse(models.Project.objects.filter(pk=self.app.pk).exists())
+        self.assertEqual(rollups.drift(), [])
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.task = models.Task.objects.create(task_name='first', employee=self.employee,
+                                               project=self.project)
+        self.client.login(username='user100', password='123')
+
+    def log(self, since=0):
+        return [(change['model'], change['id'], change['operation'])
+                for change in changes.feed(since, settle=0)]
+
+    def test_saves_and_deletes_are_logged(self):
+        report = models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 1),
+                                              elapsed_time_in_hour=2)
+        since = models.ChangeLogEntry.objects.latest('id').id
+        report.elapsed_time_in_hour = 3
+        report.save()
+        report_id = report.id
+        report.delete()
+        self.assertEqual(self.log(), [
+            ('project', self.project.id, 'create'),
+            ('task', self.task.id, 'create'),
+            ('report', report_id, 'create'),
+            ('report', report_id, 'update'),
+            ('report', report_id, 'delete'),
+        ])
+        self.assertEqual(len(self.log(since)), 2)
+
+    def test_bulk_paths_are_logged(self):
+        bulk.upsert_reports([(self.task.id, datetime.date(2014, 2, 1), 2),
+                             (self.task.id, datetime.date(2014, 2, 2), 3)])
+        first = models.Report.objects.get(date=datetime.date(2014, 2, 1))
+        since = models.ChangeLogEntry.objects.latest('id').id
+        bulk.upsert_reports([(self.task.id, datetime.date(2014, 2, 1), 4)])
+        bulk.delete_reports(models.Report.objects.filter(id=first.id))
+        self.assertEqual(self.log(since), [('report', first.id, 'update'),
+                                           ('report', first.id, 'delete')])
+        since = models.ChangeLogEntry.objects.latest('id').id
+        bulk.delete_project(self.project, chunk_size=1)
+        self.assertEqual([(name, operation) for name, pk, operation in self.log(since)],
+                         [('report', 'delete'), ('task', 'delete'), ('project', 'delete')])
+
+    @override_settings(ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS=0)
+    def test_feed_view(self):
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 1),
+                                     elapsed_time_in_hour=2)
+        since = models.ChangeLogEntry.objects.get(model='task').id
+        response = self.client.get(reverse('change_feed'), {'since': since})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['seq'], since + 1)
+        self.assertEqual((lines[0]['model'], lines[0]['operation']), ('report', 'create'))
+        self.assertEqual(lines[0]['data']['date'], '2014-02-01')
+        self.assertEqual(lines[0]['data']['elapsed_time_in_hour'], 2)
+        response = self.client.get(reverse('change_feed'), {'since': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_recent_entries_are_held_back(self):
+        report = models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 1),
+                                              elapsed_time_in_hour=2)
+        self.assertEqual(self.log(), [('project', self.project.id, 'create'),
+                                      ('task', self.task.id, 'create'),
+                                      ('report', report.id, 'create')])
+        self.assertEqual(list(changes.feed(settle=60)), [])
+        # an old entry committed after a recent one still waits behind it
+        entries = models.ChangeLogEntry.objects.order_by('id')
+        old = timezone.now() - datetime.timedelta(minutes=5)
+        entries.exclude(model='task').update(created=old)
+        self.assertEqual([change['model'] for change in changes.feed(settle=60)], ['project'])
+        entries.update(created=old)
+        self.assertEqual(len(list(changes.feed(settle=60))), 3)
+        with override_settings(ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS=600):
+            response = self.client.get(reverse('change_feed'))
+            self.assertEqual(b''.join(response.streaming_content), b'')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.task = models.Task.objects.create(task_name='first', employee=self.employee,
+                                               project=self.project)
+        self.client.login(username='user100', password='123')
+
+    def revalidate(self, url):
+        etag = self.client.get(url)['ETag']
+        return etag, self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_pages_are_not_rendered(self):
+        for url in (reverse('projects_list'), reverse('task_list'), reverse('departments_list'),
+                    reverse('project_report', kwargs={'prj_id': self.project.id})):
+            etag, response = self.revalidate(url)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.templates, [])
+            self.assertIn('private', self.client.get(url)['Cache-Control'])
+
+    def test_changes_move_the_etag(self):
+        url = reverse('project_report', kwargs={'prj_id': self.project.id})
+        etag = self.client.get(url)['ETag']
+        models.Report.objects.create(task=self.task, date=datetime.date(2014, 2, 1),
+                                     elapsed_time_in_hour=2)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['summary_time'], 2)
+
+        url = reverse('task_list')
+        etag = self.client.get(url)['ETag']
+        self.assertNotEqual(self.client.get(url, {'limit': 1})['ETag'], etag)
+        self.task.resolved = True
+        self.task.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_writes_of_other_processes_move_the_etag(self):
+        url = reverse('projects_list')
+        etag = self.client.get(url)['ETag']
+        # an import_reports run elsewhere: only the database sees the write
+        models.Project.objects.filter(pk=self.project.pk).update(name='Shop')
+        models.CacheVersion.objects.filter(name='project').update(value=F('value') + 1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Shop')
+
+    def test_etag_moves_only_when_the_write_commits(self):
+        url = reverse('projects_list')
+        etag = self.client.get(url)['ETag']
+        try:
+            with transaction.atomic():
+                bulk.upsert_reports([(self.task.id, datetime.date(2014, 2, 1), 2)])
+                models.Project.objects.filter(pk=self.project.pk).update(name='Shop')
+                caching.bump('project')
+                raise DatabaseError('rolled back')
+        except DatabaseError:
+            pass
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_etag_depends_on_user(self):
+        create_employee('user101', '123', models.Department.objects.get(), group='manager')
+        url = reverse('departments_list')
+        etag = self.client.get(url)['ETag']
+        self.client.login(username='user101', password='123')
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+    def test_redirects_carry_no_etag(self):
+        response = self.client.get(reverse('project_report', kwargs={'prj_id': self.project.id}),
+                                   {'background': 1})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ChoicesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.department = models.Department.objects.create(name='Dev')
+        create_employee('manager', '123', self.department, group='manager')
+        models.Project.objects.create(name='Site', description='',
+                                      start_date=datetime.date(2014, 1, 1),
+                                      end_date=datetime.date(2014, 12, 31))
+        self.client.login(username='manager', password='123')
+
+    def render_task_add(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('task_add'))
+        return response, len(captured)
+
+    def test_choices_are_cached_and_invalidated(self):
+        # logging in cached the auth version counter
+        cache.clear()
+        response, cold = self.render_task_add()
+        response, warm = self.render_task_add()
+        self.assertLess(warm, cold)
+        for i in range(20):
+            create_employee('user{0}'.format(i), '123', self.department)
+        response, queries = self.render_task_add()
+        # only the employee choices are read again
+        self.assertEqual(queries, warm + 1)
+        self.assertContains(response, '>user19</option>')
+        cache.clear()
+        response, queries = self.render_task_add()
+        self.assertEqual(queries, cold)
+
+    def test_autocomplete(self):
+        for name in ('alice', 'alfred', 'bob'):
+            create_employee(name, '123', self.department)
+        response = self.client.get(reverse('autocomplete', kwargs={'kind': 'employee'}),
+                                   {'q': 'al'})
+        self.assertEqual([row['label'] for row in json.loads(response.content)],
+                         ['alfred', 'alice'])
+        with self.settings(ACCOUNTS_CHOICES_LIMIT=3):
+            response, queries = self.render_task_add()
+        self.assertContains(response, reverse('autocomplete', kwargs={'kind': 'employee'}))
+        self.assertNotContains(response, '>alice</option>')
+        self.assertContains(response, '>Site</option>')
+        script = response.content.split('<script>', 1)[1].split('</script>', 1)[0]
+        self.assertIn('document.getElementById("id_employee_options")', script)
+        self.assertNotIn('&quot;', script)
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        create_employee('user100', '123', department, group='manager')
+        self.client.login(username='user100', password='123')
+
+    @override_settings(DATABASE_REPLICAS=('replica',))
+    def test_use_replica(self):
+        seen = []
+
+        @routers.use_replica
+        def view(request):
+            seen.append(router.db_for_read(models.Report))
+            return HttpResponse()
+        request = RequestFactory().get('/')
+        view(request)
+        request.pinned_to_primary = True
+        view(request)
+        self.assertEqual(seen, ['replica', 'default'])
+        self.assertEqual(router.db_for_read(models.Report), 'default')
+        self.assertEqual(router.db_for_write(models.Report), 'default')
+
+    def test_writes_pin_to_primary(self):
+        response = self.client.get(reverse('task_list'))
+        self.assertNotIn('pin_primary', response.cookies)
+        response = self.client.post(reverse('profile'), {'first_name': 'Ann', 'last_name': '',
+                                                         'email': ''})
+        self.assertIn('pin_primary', response.cookies)
+        with override_settings(DATABASE_REPLICAS=('replica',)):
+            # would fail if task_list read from the unconfigured alias
+            response = self.client.get(reverse('task_list'))
+        self.assertEqual(response.status_code, 200)
+
+
+@unittest.skipUnless('replica' in settings.DATABASES,
+                     'needs a DATABASES["replica"] mirroring default')
+class ReplicaDatabaseTests(TransactionTestCase):
+    """Run on its own with a settings module that adds a second SQLite
+    database ``replica`` with ``TEST_MIRROR = 'default'`` (and a file
+    ``TEST_NAME`` for default) and lists it in DATABASE_REPLICAS. The
+    TestCase based tests cannot run that way: their rows stay in a
+    transaction the replica connection does not see."""
+
+    def test_reports_read_from_replica(self):
+        department = models.Department.objects.create(name='Dev')
+        create_employee('user100', '123', department, group='manager')
+        self.client.login(username='user100', password='123')
+        with CaptureQueriesContext(connections['replica']) as replica:
+            with CaptureQueriesContext(connections['default']) as primary:
+                self.client.get(reverse('task_list'))
+        self.assertTrue(any('accounts_task' in query['sql'] for query in replica))
+        self.assertFalse(any('accounts_task' in query['sql'] for query in primary))
+
+
+class FakeConnection(object):
+    def __init__(self, usable=True):
+        self.alias = 'fake'
+        self.connection = object()
+        self.close_at = 0
+        self.usable = usable
+
+    def is_usable(self):
+        return self.usable
+
+    def close(self):
+        self.connection = None
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.connections = middleware.connections
+        middleware.ConnectionPoolMiddleware.holders.clear()
+
+    def tearDown(self):
+        middleware.connections = self.connections
+        middleware.ConnectionPoolMiddleware.holders.clear()
+
+    def serve(self, connection, thread, exception=None, alive=(1, 2, 3)):
+        """Passes a request through the middleware as if served by
+        ``thread`` while the ``alive`` threads run, with ``connection`` as
+        its only connection."""
+        pool = middleware.ConnectionPoolMiddleware()
+        pool._thread = lambda: thread
+        pool._alive = lambda: set(alive)
+        middleware.connections = type('Connections', (), {'all': lambda self: [connection]})()
+        pool.process_request(self.request)
+        if exception is not None:
+            pool.process_exception(self.request, exception)
+        pool.process_response(self.request, HttpResponse())
+        return connection.connection is not None
+
+    @override_settings(ACCOUNTS_DB_POOL_SIZE=2)
+    def test_pool_size(self):
+        self.assertEqual([self.serve(FakeConnection(), thread) for thread in (1, 2, 3)],
+                         [True, True, False])
+        # the threads holding a connection keep it
+        self.assertTrue(self.serve(FakeConnection(), 1))
+        # a thread that ended leaves its place to another
+        self.assertTrue(self.serve(FakeConnection(), 3, alive=(1, 3)))
+        self.assertEqual(middleware.ConnectionPoolMiddleware.holders['fake'], set([1, 3]))
+
+    def test_unusable_and_failed_connections_are_closed(self):
+        self.assertFalse(self.serve(FakeConnection(usable=False), 1))
+        self.assertFalse(self.serve(FakeConnection(), 1, DatabaseError()))
+        self.assertTrue(self.serve(FakeConnection(), 1))
+
+
+class SyncIndexesTests(TestCase):
+    def sync(self, **options):
+        out = StringIO()
+        call_command('sync_indexes', stdout=out, **options)
+        return out.getvalue()
+
+    def test_missing_indexes_are_created_once(self):
+        # syncdb created them with the tables
+        self.assertEqual(indexes.missing(), [])
+        self.assertEqual(self.sync(), 'Nothing to do.\n')
+        indexes.drop(indexes.PLAN[:2])
+        self.assertEqual(indexes.missing(), list(indexes.PLAN[:2]))
+        self.assertEqual(self.sync(dry_run=True),
+                         ''.join(indexes.create_sql(model, fields) + '\n'
+                                 for model, fields in indexes.PLAN[:2]))
+        # a dry run changes nothing
+        self.assertEqual(indexes.missing(), list(indexes.PLAN[:2]))
+        self.assertEqual(len(self.sync().splitlines()), 2)
+        for model, fields in indexes.PLAN:
+            self.assertIn(indexes.index_name(model, fields), indexes.existing(model))
+        self.assertEqual(self.sync(), 'Nothing to do.\n')
+
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        self.dev = models.Department.objects.create(name='Dev')
+        self.ops = models.Department.objects.create(name='Ops')
+        self.manager = create_employee('manager', '123', self.dev, group='manager')
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 1, 1),
+                                                     end_date=datetime.date(2014, 12, 31))
+        self.client.login(username='manager', password='123')
+
+    def test_counters_follow_changes(self):
+        tasks = [models.Task.objects.create(task_name='t{0}'.format(i), employee=self.manager,
+                                            project=self.project) for i in range(3)]
+        tasks[0].resolved = True
+        tasks[0].save()
+        tasks[1].delete()
+        models.Project.objects.create(name='Done', description='', resolved=True,
+                                      start_date=datetime.date(2014, 1, 1),
+                                      end_date=datetime.date(2014, 12, 31))
+        employee = create_employee('user1', '123', self.dev)
+        employee.department = self.ops
+        employee.save()
+        today = datetime.date.today()
+        report = models.Report.objects.create(task=tasks[2], date=today, elapsed_time_in_hour=3)
+        models.Report.objects.create(task=tasks[2], date=today - datetime.timedelta(days=7),
+                                     elapsed_time_in_hour=2)
+        report.elapsed_time_in_hour = 5
+        report.save()
+        self.assertEqual(counters.dashboard(), {
+            'open_tasks': 1,
+            'unresolved_projects': 1,
+            'week_hours': 5,
+            'department_employees': [('Dev', 1), ('Ops', 1)],
+        })
+        self.assertEqual(rollups.drift(), [])
+
+    def test_index_reads_counters_only(self):
+        models.Task.objects.create(task_name='t', employee=self.manager, project=self.project)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['dashboard']['open_tasks'], 1)
+        for query in captured:
+            self.assertNotIn('COUNT(', query['sql'])
+            self.assertNotIn('SUM(', query['sql'])
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        self.old = models.Project.objects.create(name='Old', description='', resolved=True,
+                                                 start_date=datetime.date(2012, 1, 1),
+                                                 end_date=datetime.date(2012, 12, 31))
+        current = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        old_task = models.Task.objects.create(task_name='old', employee=self.employee,
+                                              project=self.old)
+        task = models.Task.objects.create(task_name='new', employee=self.employee,
+                                          project=current)
+        for task, date, hours in ((old_task, datetime.date(2012, 12, 30), 1),
+                                  (old_task, datetime.date(2012, 12, 31), 2),
+                                  (task, datetime.date(2014, 2, 1), 3)):
+            models.Report.objects.create(task=task, date=date, elapsed_time_in_hour=hours)
+        self.client.login(username='user100', password='123')
+
+    def archive(self):
+        return archive.archive(archive.archivable(today=datetime.date(2014, 6, 1)), chunk_size=1)
+
+    def test_archive_moves_reports_of_old_resolved_projects(self):
+        self.assertEqual(archive.archivable(days=600, today=datetime.date(2014, 6, 1)).count(), 0)
+        self.assertEqual(self.archive(), 2)
+        self.assertEqual(list(models.Report.objects.values_list('date', flat=True)),
+                         [datetime.date(2014, 2, 1)])
+        self.assertEqual(sorted(models.ArchivedReport.objects.values_list('date', 'elapsed_time_in_hour')),
+                         [(datetime.date(2012, 12, 30), 1), (datetime.date(2012, 12, 31), 2)])
+        self.assertEqual(archive.archived_until(), datetime.date(2012, 12, 31))
+        self.assertEqual(rollups.drift(), [])
+        self.assertEqual(self.archive(), 0)
+
+    def test_archived_reports_stay_in_rollups(self):
+        self.archive()
+        self.assertEqual(models.TaskHours.objects.get(task__project=self.old).hours, 3)
+        models.ArchivedReport.objects.filter(date=datetime.date(2012, 12, 31)).delete()
+        self.assertEqual(models.TaskHours.objects.get(task__project=self.old).hours, 1)
+        self.assertEqual(rollups.drift(), [])
+        rollups.rebuild()
+        self.assertEqual(models.TaskHours.objects.get(task__project=self.old).hours, 1)
+
+    def test_archived_pairs_are_written_in_place(self):
+        self.archive()
+        old_task = models.Task.objects.get(task_name='old')
+        self.assertEqual(bulk.upsert_reports([(old_task.id, datetime.date(2012, 12, 31), 5)]),
+                         (0, 1))
+        self.assertFalse(models.Report.objects.filter(task=old_task).exists())
+        self.assertEqual(models.ArchivedReport.objects.get(date=datetime.date(2012, 12, 31))
+                                                      .elapsed_time_in_hour, 5)
+        self.assertEqual(models.TaskHours.objects.get(task=old_task).hours, 6)
+        self.assertEqual(rollups.drift(), [])
+
+        url = reverse('timesheet') + '?week=2012-12-31'
+        response = self.client.get(url)
+        self.assertEqual(response.context['form'].existing,
+                         {(old_task.id, datetime.date(2012, 12, 31)): 5})
+        # the week's only cell emptied deletes the archived report
+        response = self.client.post(url, {})
+        self.assertFalse(models.ArchivedReport.objects.filter(
+                         date=datetime.date(2012, 12, 31)).exists())
+        self.assertFalse(models.Report.objects.filter(task=old_task).exists())
+        self.assertEqual(models.TaskHours.objects.get(task=old_task).hours, 1)
+        self.assertEqual(rollups.drift(), [])
+
+    def test_single_report_of_archived_pair_is_refused(self):
+        self.archive()
+        old_task = models.Task.objects.get(task_name='old')
+        response = self.client.post(reverse('report_add'), {
+            'task': old_task.id, 'elapsed_time_in_hour': 4,
+            'date_day': 31, 'date_month': 12, 'date_year': 2012})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertFalse(models.Report.objects.filter(task=old_task).exists())
+        self.assertEqual(models.TaskHours.objects.get(task=old_task).hours, 3)
+
+        response = self.client.post(reverse('report_add'), {
+            'task': old_task.id, 'elapsed_time_in_hour': 4,
+            'date_day': 29, 'date_month': 12, 'date_year': 2012})
+        self.assertRedirects(response, reverse('profile'))
+        self.assertEqual(models.TaskHours.objects.get(task=old_task).hours, 7)
+
+    def test_ids_handed_out_again_do_not_mix_with_archived_ones(self):
+        self.archive()
+        archived = models.ArchivedReport.objects.get(date=datetime.date(2012, 12, 31))
+        task = models.Task.objects.get(task_name='new')
+        # what SQLite hands out once the highest ids were archived
+        report = models.Report(task=task, date=datetime.date(2014, 2, 2), elapsed_time_in_hour=4)
+        report.id = archived.report_id
+        report.save()
+        entries = [entry for entry in changes.feed(settle=0)
+                   if entry['model'] == 'report' and entry['id'] == report.id]
+        self.assertEqual(entries[-1]['data']['elapsed_time_in_hour'], 4)
+        context = reporting.employee_statistics(self.employee, datetime.date(2012, 1, 1),
+                                                datetime.date(2014, 12, 31))
+        self.assertEqual([(r.date.day, r.elapsed_time_in_hour) for r in context['reports']],
+                         [(30, 1), (31, 2), (1, 3), (2, 4)])
+
+        task.project.resolved = True
+        task.project.save()
+        self.assertEqual(archive.archive(archive.archivable(today=datetime.date(2016, 1, 1))), 1)
+        self.assertEqual(models.ArchivedReport.objects.filter(report_id=report.id).count(), 2)
+        # the highest id stays, so ids are not handed out again from below it
+        self.assertEqual(list(models.Report.objects.values_list('date', flat=True)),
+                         [datetime.date(2014, 2, 1)])
+        self.assertEqual(rollups.drift(), [])
+
+    def test_own_reports_list_archived_ones_apart(self):
+        self.archive()
+        response = self.client.get(reverse('report_all_for_employee'))
+        self.assertEqual([r.date for r in response.context['page']], [datetime.date(2014, 2, 1)])
+        self.assertEqual(response.context['summary_time'], 3)
+        self.assertEqual(response.context['archived_time'], 3)
+        self.assertContains(response, '?archived=1')
+        response = self.client.get(reverse('report_all_for_employee'),
+                                   {'archived': 1, 'limit': 1})
+        page = response.context['page']
+        self.assertEqual([r.date.day for r in page], [30])
+        self.assertEqual(response.context['summary_time'], 3)
+        self.assertContains(response, '?archived=1&amp;after=')
+        response = self.client.get(reverse('report_all_for_employee'),
+                                   {'archived': 1, 'after': page.next_cursor})
+        self.assertEqual([r.date.day for r in response.context['page']], [31])
+
+    def test_report_sources_read_archive_only_when_needed(self):
+        self.archive()
+        self.assertEqual(len(reporting.report_sources(datetime.date(2014, 1, 1))), 1)
+        self.assertEqual(len(reporting.report_sources('2012-12-31')), 2)
+        self.assertEqual(len(reporting.report_sources()), 2)
+
+        context = reporting.employee_statistics(self.employee, datetime.date(2014, 1, 1),
+                                                datetime.date(2014, 12, 31))
+        self.assertEqual(context['task_hours'], [('new', 3)])
+        context = reporting.employee_statistics(self.employee, datetime.date(2012, 12, 31),
+                                                datetime.date(2014, 12, 31))
+        self.assertEqual(context['task_hours'], [('new', 3), ('old', 2)])
+        self.assertEqual(context['summary_time'], 5)
+        self.assertEqual([report.date for report in context['reports']],
+                         [datetime.date(2012, 12, 31), datetime.date(2014, 2, 1)])
+
+    def test_export_includes_archived_reports(self):
+        self.archive()
+        response = self.client.get(reverse('report_export', kwargs={'fmt': 'ndjson'}))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(sorted((row['date'], row['project']) for row in rows),
+                         [('2012-12-30', 'Old'), ('2012-12-31', 'Old'), ('2014-02-01', 'Site')])
+
+    def test_command_dry_run(self):
+        out = StringIO()
+        call_command('archive_reports', dry_run=True, days=30, stdout=out)
+        self.assertEqual(out.getvalue().strip(), '2 reports to archive.')
+        self.assertEqual(models.ArchivedReport.objects.count(), 0)
+
+
+class ProjectAnalyticsTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.manager = create_employee('manager', '123', department, group='manager')
+        self.developer = create_employee('developer', '123', department)
+        # Monday to Sunday two weeks later
+        self.project = models.Project.objects.create(name='Site', description='',
+                                                     start_date=datetime.date(2014, 2, 3),
+                                                     end_date=datetime.date(2014, 2, 16))
+        other = models.Project.objects.create(name='Other', description='',
+                                              start_date=datetime.date(2014, 1, 1),
+                                              end_date=datetime.date(2014, 12, 31))
+        tasks = {
+            'manager': models.Task.objects.create(task_name='lead', employee=self.manager,
+                                                  project=self.project),
+            'developer': models.Task.objects.create(task_name='code', employee=self.developer,
+                                                    project=self.project),
+            'other': models.Task.objects.create(task_name='other', employee=self.manager,
+                                                project=other),
+        }
+        for day in range(14):
+            date = self.project.start_date + datetime.timedelta(days=day)
+            if date.weekday() >= 5:
+                continue
+            models.Report.objects.create(task=tasks['developer'], date=date,
+                                         elapsed_time_in_hour=8)
+            if day < 7:
+                models.Report.objects.create(task=tasks['manager'], date=date,
+                                             elapsed_time_in_hour=2)
+        # outside the project window, not counted
+        models.Report.objects.create(task=tasks['other'], date=datetime.date(2014, 3, 3),
+                                     elapsed_time_in_hour=8)
+        models.Report.objects.create(task=tasks['other'], date=datetime.date(2014, 2, 3),
+                                     elapsed_time_in_hour=8)
+        self.client.login(username='manager', password='123')
+
+    def backends(self):
+        """Runs the loop body with NumPy if installed and with plain lists."""
+        numpy = analytics.numpy
+        try:
+            for backend in ([numpy] if numpy is not None else []) + [None]:
+                analytics.numpy = backend
+                yield backend
+        finally:
+            analytics.numpy = numpy
+
+    def test_utilization_and_burndown(self):
+        for backend in self.backends():
+            result = analytics.project_analytics(self.project, capacity=40, window=2, chunk_size=3)
+            self.assertEqual(result['weeks'], [datetime.date(2014, 2, 3), datetime.date(2014, 2, 10)])
+            self.assertEqual(result['average_weeks'], [datetime.date(2014, 2, 10)])
+            self.assertEqual(result['employees'], [
+                {'name': 'developer', 'hours': [40, 40], 'utilization': [1.0, 1.0],
+                 'moving_average': [1.0], 'mean_utilization': 1.0},
+                {'name': 'manager', 'hours': [18, 0], 'utilization': [0.45, 0.0],
+                 'moving_average': [0.225], 'mean_utilization': 0.225},
+            ])
+            self.assertEqual(result['under_booked'], ['manager'])
+            self.assertEqual(result['over_booked'], [])
+            self.assertEqual(result['total_hours'], 90)
+            self.assertEqual([(week['hours'], week['remaining'], week['burned'], week['elapsed'])
+                              for week in result['burndown']],
+                             [(50, 40, 0.556, 0.5), (40, 0, 1.0, 1.0)])
+
+    def test_window_longer_than_the_project(self):
+        for backend in self.backends():
+            result = analytics.project_analytics(self.project, capacity=40, window=3)
+            self.assertEqual(result['average_weeks'], [])
+            self.assertEqual([row['moving_average'] for row in result['employees']], [[], []])
+            self.assertEqual([row['mean_utilization'] for row in result['employees']],
+                             [1.0, 0.225])
+
+    def test_partial_weeks_are_prorated(self):
+        for backend in self.backends():
+            # Wednesday to the Tuesday after
+            matrix = analytics.HoursMatrix([1], datetime.date(2014, 2, 5), datetime.date(2014, 2, 11))
+            matrix.add([(1, datetime.date(2014, 2, day), 8) for day in (5, 6, 7, 10, 11)])
+            matrix.add([(1, datetime.date(2014, 2, 10), 8)])
+            self.assertEqual(matrix.mondays(), [datetime.date(2014, 2, 3), datetime.date(2014, 2, 10)])
+            self.assertEqual(matrix.weekly(), [[24, 24]])
+            self.assertEqual(matrix.working_days(), [3, 2])
+            self.assertEqual(analytics.utilization(matrix.weekly(), matrix.working_days(), 40),
+                             [[1.0, 1.5]])
+
+    def test_days_on_the_week_edges(self):
+        for backend in self.backends():
+            # a Sunday and the Monday after fall in different weeks
+            matrix = analytics.HoursMatrix([1, 2], datetime.date(2014, 2, 9), datetime.date(2014, 2, 10))
+            matrix.add([(1, datetime.date(2014, 2, 9), 3), (2, datetime.date(2014, 2, 10), 5)])
+            self.assertEqual(matrix.mondays(), [datetime.date(2014, 2, 3), datetime.date(2014, 2, 10)])
+            self.assertEqual(matrix.weekly(), [[3, 0], [0, 5]])
+            self.assertEqual(matrix.working_days(), [0, 1])
+            self.assertEqual(analytics.utilization(matrix.weekly(), matrix.working_days(), 40),
+                             [[0.0, 0.0], [0.0, 0.625]])
+
+    def test_moving_average(self):
+        self.assertEqual(analytics.moving_average([[1, 2, 3, 6]], 2), [[1.5, 2.5, 4.5]])
+        self.assertEqual(analytics.moving_average([[1, 2, 3, 6]], 4), [[3.0]])
+        self.assertEqual(analytics.moving_average([[1, 2, 3, 6]], 5), [[]])
+
+    def test_view_and_command(self):
+        for backend in self.backends():
+            response = self.client.get(reverse('project_analytics',
+                                               kwargs={'prj_id': self.project.id}))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Under-booked: manager')
+            self.assertContains(response, 'The project is shorter than 4 weeks.')
+            out = StringIO()
+            call_command('project_analytics', str(self.project.id), window=2, stdout=out)
+            self.assertIn('developer: mean utilization 100%, 2 weeks moving average 100%',
+                          out.getvalue())
+            self.assertIn('Under-booked: manager', out.getvalue())
+
+    def test_view_renders_the_moving_average(self):
+        self.project.end_date = datetime.date(2014, 3, 2)
+        self.project.save()
+        for backend in self.backends():
+            response = self.client.get(reverse('project_analytics',
+                                               kwargs={'prj_id': self.project.id}))
+            self.assertContains(response, 'Moving average over 4 weeks')
+            self.assertEqual(response.context['average_weeks'], [datetime.date(2014, 2, 24)])
+            # the developer's 80 hours over four 40 hour weeks
+            self.assertEqual([row['moving_average'] for row in response.context['employees']],
+                             [[0.5], [0.113]])
+            self.assertContains(response, '<td>11%</td>')
+
+
+class EmployeeStatisticsTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department, group='manager')
+        project = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        first = models.Task.objects.create(task_name='first', employee=self.employee,
+                                           project=project)
+        second = models.Task.objects.create(task_name='second', employee=self.employee,
+                                            project=project)
+        for task, date, hours in ((first, datetime.date(2014, 1, 31), 1),
+                                  (first, datetime.date(2014, 2, 1), 2),
+                                  (second, datetime.date(2014, 2, 1), 3),
+                                  (second, datetime.date(2014, 2, 28), 4),
+                                  (second, datetime.date(2014, 3, 1), 5)):
+            models.Report.objects.create(task=task, date=date, elapsed_time_in_hour=hours)
+        self.client.login(username='user100', password='123')
+
+    def post(self, group_by='', **extra):
+        return self.client.post(reverse('employee_statistics'), dict({
+                                'employee': self.employee.id,
+                                'start_date_day': 1, 'start_date_month': 2, 'start_date_year': 2014,
+                                'end_date_day': 28, 'end_date_month': 2, 'end_date_year': 2014,
+                                'group_by': group_by,
+                                }, **extra))
+
+    def test_bounds_are_inclusive(self):
+        response = self.post()
+        self.assertEqual([(r.task.task_name, r.date.day) for r in response.context['reports']],
+                         [('first', 1), ('second', 1), ('second', 28)])
+        self.assertEqual(response.context['task_hours'], [('first', 2), ('second', 7)])
+        self.assertEqual(response.context['periods'], [(datetime.date(2014, 2, 1), 5),
+                                                       (datetime.date(2014, 2, 28), 4)])
+        self.assertEqual(response.context['summary_time'], 9)
+
+    def test_grouping(self):
+        response = self.post('week')
+        self.assertNotIn('reports', response.context)
+        self.assertEqual(response.context['periods'], [(datetime.date(2014, 1, 27), 5),
+                                                       (datetime.date(2014, 2, 24), 4)])
+        response = self.post('month')
+        self.assertEqual(response.context['periods'], [(datetime.date(2014, 2, 1), 9)])
+        self.assertContains(response, 'Month starting')
+
+    def test_background_job(self):
+        response = self.post(in_background='on')
+        job = models.ReportJob.objects.get()
+        self.assertRedirects(response, reverse('report_job', kwargs={'job_id': job.id}))
+        # the same report requested again joins the pending job
+        self.post(in_background='on')
+        self.assertEqual(models.ReportJob.objects.count(), 1)
+        response = self.client.get(reverse('report_job', kwargs={'job_id': job.id}))
+        self.assertContains(response, 'pending')
+
+        jobs.work(once=True)
+        job = models.ReportJob.objects.get()
+        self.assertEqual(job.status, models.ReportJob.DONE)
+        response = self.client.get(reverse('report_job', kwargs={'job_id': job.id}))
+        self.assertEqual(response.context['task_hours'], [['first', 2], ['second', 7]])
+        self.assertEqual(response.context['periods'], [['2014-02-01', 5], ['2014-02-28', 4]])
+        self.assertEqual(response.context['summary_time'], 9)
+        response = self.client.get(reverse('report_job', kwargs={'job_id': job.id}),
+                                   {'download': 1})
+        self.assertEqual(json.loads(response.content)['summary_time'], 9)
+
+        # a finished job is not reused
+        self.post(in_background='on')
+        self.assertEqual(models.ReportJob.objects.count(), 2)
+
+    def test_identical_jobs_are_unique(self):
+        job = jobs.submit('project_report', {'project': 1})
+        # what a concurrent request that missed the pending job would insert
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                models.ReportJob.objects.create(kind=job.kind, params=job.params,
+                                                key=job.key, active_key=job.key)
+        self.assertEqual(jobs.submit('project_report', {'project': 1}), job)
+        self.assertEqual(models.ReportJob.objects.count(), 1)
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        self.department = models.Department.objects.create(name='Dev')
+        create_employee('user100', '123', self.department, group='manager')
+        self.client.login(username='user100', password='123')
+
+    def test_cached_departments_skip_queries(self):
+        self.client.get(reverse('departments_list'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'user100')
+        # only the version counters are read
+        self.assertFalse([q for q in queries if 'accounts_' in q['sql'] and
+                          'accounts_cacheversion' not in q['sql']])
+
+    def test_writes_invalidate_cached_fragments(self):
+        response = self.client.get(reverse('departments_list'))
+        self.assertNotContains(response, 'QA')
+        models.Department.objects.create(name='QA', parent=self.department)
+        response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'QA')
+
+        project = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        response = self.client.get(reverse('projects_list'))
+        self.assertContains(response, 'Site')
+        project.name = 'Portal'
+        project.save()
+        response = self.client.get(reverse('projects_list'))
+        self.assertContains(response, 'Portal')
+
+        user = User.objects.get(username='user100')
+        user.username = 'user101'
+        user.save()
+        self.client.login(username='user101', password='123')
+        response = self.client.get(reverse('employees_list'))
+        self.assertContains(response, 'user101')
+
+    def test_writes_of_other_processes_invalidate_cached_fragments(self):
+        self.client.get(reverse('departments_list'))
+        # what a write in another worker or a management command leaves
+        # behind: the database changed, this process's cache did not
+        models.Department.objects.filter(pk=self.department.pk).update(name='Research')
+        models.CacheVersion.objects.filter(name='department').update(value=F('value') + 1)
+        response = self.client.get(reverse('departments_list'))
+        self.assertContains(response, 'Research')
+
+    def test_requests_bump_once_after_their_writes(self):
+        caching.bump('project')
+        before = caching.version('project')
+        request = RequestFactory().post('/')
+        versions = middleware.CacheVersionMiddleware()
+        versions.process_request(request)
+        for name in ('Site', 'Portal'):
+            models.Project.objects.create(name=name, description='',
+                                          start_date=datetime.date(2014, 1, 1),
+                                          end_date=datetime.date(2014, 12, 31))
+        self.assertEqual(caching.version('project'), before)
+        versions.process_response(request, HttpResponse())
+        self.assertEqual(caching.version('project'), before + 1)
+        # outside of a request, in place
+        models.Project.objects.get(name='Site').save()
+        self.assertEqual(caching.version('project'), before + 2)
+
+    def test_nested_collections_bump_at_the_outer_end(self):
+        caching.bump('department', 'employee')
+        before = caching.versions('department', 'employee')
+        with caching.deferred():
+            with caching.deferred():
+                caching.bump('department', 'employee')
+            caching.bump('department')
+            self.assertEqual(caching.versions('department', 'employee'), before)
+        self.assertEqual(caching.versions('department', 'employee'),
+                         {'department': before['department'] + 1,
+                          'employee': before['employee'] + 1})
+
+
+class ViewMetricsTests(TestCase):
+    def setUp(self):
+        department = models.Department.objects.create(name='Dev')
+        self.employee = create_employee('user100', '123', department)
+        self.client.login(username='user100', password='123')
+        middleware.metrics.clear()
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.client.get(reverse('profile'))
+        self.assertEqual(response['X-View-Name'], 'profile')
+        self.assertTrue(int(response['X-View-Queries']) > 0)
+        self.assertIn('X-View-Template-Time-Ms', response)
+        self.assertIn('X-View-RSS-Growth-Kb', response)
+
+    @unittest.skipIf(middleware.resource is None, 'needs the resource module')
+    def test_rss_growth_of_an_allocating_view(self):
+        def allocating(request):
+            # more than the process ever held, so the high-water mark moves
+            block = bytearray(int(middleware._max_rss_kb() * 1024) + size)
+            return HttpResponse(str(len(block)))
+
+        size = 32 * 1024 * 1024
+        request = RequestFactory().get(reverse('profile'))
+        request.resolver_match = resolve(reverse('profile'))
+        metrics = middleware.ViewMetricsMiddleware()
+        metrics.process_view(request, allocating, (), {})
+        metrics.process_response(request, allocating(request))
+        growth = middleware.metrics.samples['profile'][-1]['rss_growth_kb']
+        self.assertTrue(growth >= size / 1024, growth)
+        # nothing allocated, the high-water mark stays
+        mark = middleware.rss_mark()
+        self.assertEqual(middleware.rss_growth_kb(mark), 0)
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.client.get(reverse('profile'))
+        self.client.get(reverse('profile'))
+        response = self.client.get(reverse('view_metrics'))
+        self.assertEqual(response.status_code, 302)
+
+        user = self.employee.user
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse('view_metrics'))
+        summary = json.loads(response.content)
+        self.assertEqual(summary['profile']['count'], 2)
+        self.assertIn('p95', summary['profile']['queries'])
+
+    @override_settings(ACCOUNTS_QUERY_THRESHOLDS={'profile': 0})
+    def test_threshold_logs_queries(self):
+        with patch_logger('accounts.metrics', 'warning') as messages:
+            self.client.get(reverse('profile'))
+        self.assertEqual(len(messages), 1)
+        self.assertIn('profile ran', messages[0])
+
+
+class BenchmarkTests(TestCase):
+    def test_generated_company_serves_every_view(self):
+        benchmark.seed(departments=8, depth=4, employees=4, projects=2,
+                       tasks_per_employee=2, days=10)
+        levels = models.Department.objects.values_list('level', flat=True)
+        self.assertEqual(len(levels), 8)
+        self.assertTrue(max(levels) <= 3)
+        self.assertEqual(rollups.drift(), [])
+
+        self.client.login(username='bench-manager', password='bench')
+        results = benchmark.run_views(self.client, repeat=1)
+        self.assertEqual(dict((name, result['status']) for name, result in results.items()),
+                         dict((name, 200) for name, method, path, data in benchmark.view_requests()))
+        self.assertTrue(all(result['rss_growth_kb'] is not None for result in results.values()))
+        self.assertEqual(benchmark.regressions(results, results), [])
+
+
+class DepartmentRollupTests(TestCase):
+    def setUp(self):
+        self.engineering = models.Department.objects.create(name='Engineering')
+        self.backend = models.Department.objects.create(name='Backend', parent=self.engineering)
+        self.api = models.Department.objects.create(name='API', parent=self.backend)
+        self.frontend = models.Department.objects.create(name='Frontend', parent=self.engineering)
+        models.Department.objects.create(name='Sales')
+        project = models.Project.objects.create(name='Site', description='',
+                                                start_date=datetime.date(2014, 1, 1),
+                                                end_date=datetime.date(2014, 12, 31))
+        for name, department, hours in (('lead', self.engineering, 1), ('db', self.backend, 2),
+                                        ('rest', self.api, 4), ('ui', self.frontend, 8)):
+            employee = create_employee(name, '123', department,
+                                       group='manager' if name == 'lead' else None)
+            task = models.Task.objects.create(task_name=name, employee=employee, project=project)
+            models.Report.objects.create(task=task, date=datetime.date(2014, 2, 1),
+                                         elapsed_time_in_hour=hours)
+            models.Report.objects.create(task=task, date=datetime.date(2014, 3, 1),
+                                         elapsed_time_in_hour=hours)
+        self.engineering = models.Department.objects.get(pk=self.engineering.pk)
+
+    def test_rollup_of_subtree(self):
+        tree.snapshot()
+        # the department version counter, hours and headcount
+        with self.assertNumQueries(3):
+            rollup = reporting.department_rollup(self.engineering)
+        self.assertEqual((rollup['hours'], rollup['headcount']), (30, 4))
+        self.assertEqual((rollup['own']['hours'], rollup['own']['headcount']), (2, 1))
+        self.assertEqual([(row['department'].name, row['hours'], row['headcount'])
+                          for row in rollup['children']],
+                         [('Backend', 12, 2), ('Frontend', 16, 1)])
+
+    def test_department_report_view(self):
+        self.client.login(username='lead', password='123')
+        response = self.client.get(reverse('department_report',
+                                           kwargs={'dep_id': self.backend.id}),
+                                   {'start_date': '2014-03-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['hours'], 6)
+        self.assertEqual(response.context['children'][0]['hours'], 4)
+
+
+class DepartmentTreeTests(TestCase):
+    def setUp(self):
+        self.engineering = models.Department.objects.create(name='Engineering')
+        self.backend = models.Department.objects.create(name='Backend', parent=self.engineering)
+        self.api = models.Department.objects.create(name='API', parent=self.backend)
+        self.frontend = models.Department.objects.create(name='Frontend', parent=self.engineering)
+        self.sales = models.Department.objects.create(name='Sales')
+
+    def test_lookups_without_queries(self):
+        tree.snapshot()
+        # only the department version counter is read
+        with self.assertNumQueries(1):
+            departments = tree.snapshot()
+            self.assertEqual([node.name for node in departments.ancestors(self.api.id)],
+                             ['Engineering', 'Backend'])
+            self.assertEqual([node.name for node in departments.descendants(self.engineering.id)],
+                             ['Backend', 'API', 'Frontend'])
+            self.assertEqual([node.name for node in departments.children(self.engineering.id)],
+                             ['Backend', 'Frontend'])
+            self.assertEqual(departments.depth(self.api.id), 2)
+            self.assertTrue(departments.is_descendant(self.api.id, self.engineering.id))
+            self.assertFalse(departments.is_descendant(self.sales.id, self.engineering.id))
+            self.assertEqual(departments.parent_choices(self.backend.id),
+                             [(self.engineering.id, ' Engineering'),
+                              (self.frontend.id, '--- Frontend'),
+                              (self.sales.id, ' Sales')])
+
+    def test_snapshot_follows_changes(self):
+        self.assertEqual(len(tree.snapshot()), 5)
+        models.Department.objects.create(name='Support', parent=self.sales)
+        self.assertEqual([node.name for node in tree.snapshot().children(self.sales.id)],
+                         ['Support'])
+        self.api.delete()
+        self.assertNotIn(self.api.id, tree.snapshot())
+
+    def test_form_refuses_moving_under_descendant(self):
+        form = forms.DepartmentForm({'name': 'Backend', 'parent': self.api.id},
+                                    instance=self.backend, self_exclude=True)
+        self.assertFalse(form.is_valid())
+        self.assertIn('parent', form.errors)
+        self.assertNotIn('API', form.as_table())
+        form = forms.DepartmentForm({'name': 'Backend', 'parent': self.sales.id},
+                                    instance=self.backend, self_exclude=True)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual([node.name for node in tree.snapshot().ancestors(self.api.id)],
+                         ['Sales', 'Backend'])
+
+    def test_stale_snapshot_is_read_again(self):
+        stale = tree.snapshot()
+        support = models.Department.objects.create(name='Support', parent=self.sales)
+        team = models.Department.objects.create(name='Team', parent=support)
+        # a process that kept the snapshot from before Support was created
+        tree._snapshot = (caching.version('department'), stale)
+        form = forms.DepartmentForm({'name': 'Support', 'parent': team.id},
+                                    instance=support, self_exclude=True)
+        self.assertFalse(form.is_valid())
+        self.assertIn('parent', form.errors)
+
+    def test_move_under_descendant_after_validation(self):
+        create_employee('user100', '123', self.sales, group='manager')
+        self.client.login(username='user100', password='123')
+        # a snapshot from before API was moved under Frontend validates the move
+        stale = tree.snapshot()
+        self.api.move_to(self.frontend)
+        tree._snapshot = (caching.version('department'), stale)
+        response = self.client.post(reverse('detail_dep', kwargs={'dep_id': self.frontend.id}),
+                                    {'name': 'Frontend', 'parent': self.api.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('parent', response.context['form'].errors)
+        self.assertEqual(models.Department.objects.get(pk=self.frontend.pk).parent_id,
+                         self.engineering.id)
+
+    def test_batch_rebuilds_once(self):
+        with tree.batch():
+            for i in range(3):
+                models.Department.objects.create(name='Team {0}'.format(i), parent=self.sales)
+        self.assertEqual([node.name for node in tree.snapshot().children(self.sales.id)],
+                         ['Team 0', 'Team 1', 'Team 2'])
+        self.assertEqual(models.Department.objects.get(pk=self.sales.pk).get_descendant_count(), 3)
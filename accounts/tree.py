@@ -0,0 +1,115 @@
+"""In-process snapshot of the department tree.
+
+The snapshot is read with one query and kept by each process until the
+'department' version counter moves, that is until a department is saved
+or deleted by any process: the counter is kept in the database (see
+``caching``), so a read of it is the only query of a lookup. Callers
+about to write can ``refresh`` it to close the window between that read
+and a concurrent change. It answers ancestors, descendants, depth and the
+valid parents of a department without further queries: the nodes are
+kept in mptt tree order, so every subtree is a contiguous slice.
+"""
+import copy
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+import caching
+import models
+
+# (version of the 'department' counter, DepartmentTree)
+_snapshot = None
+
+
+class DepartmentTree(object):
+    """Departments in tree order. The nodes are shared by the requests of
+    the process: the methods hand out copies."""
+
+    def __init__(self, departments):
+        self.nodes = list(departments)
+        self.index = dict((node.id, i) for i, node in enumerate(self.nodes))
+        # the subtree of nodes[i] is nodes[i:ends[i]]
+        self.ends = [i + 1 + (node.rght - node.lft - 1) // 2
+                     for i, node in enumerate(self.nodes)]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, department_id):
+        return department_id in self.index
+
+    def get(self, department_id):
+        return copy.copy(self.nodes[self.index[department_id]])
+
+    def all(self):
+        return [copy.copy(node) for node in self.nodes]
+
+    def depth(self, department_id):
+        return self.nodes[self.index[department_id]].level
+
+    def ancestors(self, department_id):
+        """Ancestors of the department, root first."""
+        result = []
+        parent_id = self.nodes[self.index[department_id]].parent_id
+        while parent_id is not None:
+            node = self.nodes[self.index[parent_id]]
+            result.append(copy.copy(node))
+            parent_id = node.parent_id
+        result.reverse()
+        return result
+
+    def subtree_ids(self, department_id):
+        """Ids of the department and all its descendants."""
+        i = self.index[department_id]
+        return set(node.id for node in self.nodes[i:self.ends[i]])
+
+    def children(self, department_id):
+        i = self.index[department_id]
+        level = self.nodes[i].level + 1
+        return [copy.copy(node) for node in self.nodes[i + 1:self.ends[i]] if node.level == level]
+
+    def descendants(self, department_id):
+        """Descendants of the department in tree order."""
+        i = self.index[department_id]
+        return [copy.copy(node) for node in self.nodes[i + 1:self.ends[i]]]
+
+    def is_descendant(self, department_id, ancestor_id):
+        i = self.index[ancestor_id]
+        return i < self.index[department_id] < self.ends[i]
+
+    def valid_parents(self, department_id=None):
+        """Departments that ``department_id`` can be moved under: all but
+        its own subtree. All of them for a new department (None)."""
+        if department_id is None or department_id not in self.index:
+            return list(self.nodes)
+        i = self.index[department_id]
+        return self.nodes[:i] + self.nodes[self.ends[i]:]
+
+    def parent_choices(self, department_id=None):
+        """``(pk, label)`` pairs of ``valid_parents``, the labels indented
+        by depth like mptt's TreeNodeChoiceField."""
+        return [(node.id, u'{0} {1}'.format('---' * node.level, node.name))
+                for node in self.valid_parents(department_id)]
+
+
+def snapshot(refresh=False):
+    """The current DepartmentTree, read again once a department changed
+    or when ``refresh`` is set."""
+    global _snapshot
+    version = caching.version('department')
+    current = _snapshot
+    if refresh or current is None or current[0] != version:
+        # from the primary: a lagging replica would be cached until the next change
+        departments = models.Department.objects.using(DEFAULT_DB_ALIAS).order_by('tree_id', 'lft')
+        current = _snapshot = (version, DepartmentTree(departments))
+    return current[1]
+
+@contextmanager
+def batch():
+    """Runs bulk department changes with mptt's per save bookkeeping (and
+    insertion reordering) switched off, then rebuilds the tree once."""
+    with transaction.atomic():
+        with models.Department.objects.disable_mptt_updates():
+            yield
+        models.Department.objects.rebuild()
+    caching.bump('department')
@@ -19,11 +19,21 @@ urlpatterns = patterns('',
     url(r'^departments/add$', views.department_add, name='add_dep'),
     url(r'^departments/(?P<dep_id>\d+)/$', views.department_detail, name='detail_dep'),
     url(r'^departments/delete/(?P<dep_id>\d+)/$', views.department_delete, name='delete_dep'),
+    url(r'^departments/report/(?P<dep_id>\d+)/$', views.department_report, name='department_report'),
     url(r'^tasks/$', views.task_list, name='task_list'),
     url(r'^task/add$', views.task_add, name='task_add'),
+    url(r'^task/assign$', views.task_assign, name='task_assign'),
     url(r'^task/detail/(?P<task_id>\d+)/$', views.task_detail, name='task_detail'),
     url(r'^profile/report/add$', views.report_add, name='report_add'),
+    url(r'^profile/timesheet$', views.timesheet, name='timesheet'),
     url(r'^profile/report/all$', views.report_all_for_employee, name='report_all_for_employee'),
     url(r'^employee/statistics$', views.employee_statistics, name='employee_statistics'),
     url(r'^projects/report/(?P<prj_id>\d+)/$', views.project_report, name='project_report'),
+    url(r'^projects/analytics/(?P<prj_id>\d+)/$', views.project_analytics,
+        name='project_analytics'),
+    url(r'^reports/export\.(?P<fmt>csv|ndjson)$', views.report_export, name='report_export'),
+    url(r'^reports/jobs/(?P<job_id>\d+)/$', views.report_job, name='report_job'),
+    url(r'^autocomplete/(?P<kind>employee|project|task)/$', views.autocomplete, name='autocomplete'),
+    url(r'^changes/$', views.change_feed, name='change_feed'),
+    url(r'^metrics/$', views.view_metrics, name='view_metrics'),
 )
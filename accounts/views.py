@@ -1,24 +1,97 @@
+import datetime
+import hashlib
+import itertools
+import json
+from functools import wraps
+
 from django.shortcuts import render, redirect, render_to_response
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.forms.models import inlineformset_factory
 from django.contrib.auth.models import User
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.views import generic
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.conf import settings
+from django.db import transaction
+from django.core.urlresolvers import reverse
+from mptt.exceptions import InvalidMove
+import analytics
+import caching
+import changes
+import choices
+import counters
+import encoding
+import export
+import middleware
 import forms
+import jobs
 import models
+import pagination
+import permissions
+import reporting
+import routers
+import tree
+
+def in_groups(u, group_names):
+    if u.is_authenticated():
+        if u.is_superuser or permissions.group_names(u).intersection(group_names):
+            return True
+    return False
 
 def group_required(*group_names):
     """Requires user membership in at least one of the groups passed in."""
-    def in_groups(u):
-        if u.is_authenticated():
-            if bool(u.groups.filter(name__in=group_names)) | u.is_superuser:
-                return True
-        return False
-    return user_passes_test(in_groups)
+    return user_passes_test(lambda u: in_groups(u, group_names))
+
+def fragment(request, *names):
+    """Context for a ``{% cache %}`` block that stays valid while the
+    ``names`` version counters, the query string and the user's
+    permissions are unchanged."""
+    versions = caching.versions(*names)
+    return {
+        'fragment_timeout': settings.ACCOUNTS_FRAGMENT_CACHE_TIMEOUT,
+        'fragment_key': '{0}:{1}:{2}'.format('.'.join(str(versions[name]) for name in names),
+                                             permissions.signature(request.user),
+                                             request.GET.urlencode()),
+    }
+
+def conditional(*names):
+    """Answers a GET with 304 Not Modified before the view runs while the
+    ``names`` version counters, the user, their permissions and the query
+    string are the same as when the client got its copy. The counters are
+    shared database rows bumped after the writes commit (see ``caching``):
+    goes inside ``routers.use_replica`` so they are read from the same
+    database as the page."""
+    def etag(request, *args, **kwargs):
+        versions = caching.versions(*names)
+        return hashlib.md5('{0}:{1}:{2}:{3}'.format(
+            '.'.join(str(versions[name]) for name in names), request.user.pk,
+            permissions.signature(request.user), request.get_full_path()).encode('utf-8')).hexdigest()
+
+    def decorator(view):
+        view = condition(etag_func=etag)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                # a redirect or error is not the versioned page
+                del response['ETag']
+            elif not response.has_header('Cache-Control'):
+                # per user, and to be revalidated on every use
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
 
 def index(request):
-    return render(request, 'accounts/index.html') 
+    context = {}
+    if in_groups(request.user, ('manager',)):
+        context['dashboard'] = counters.dashboard()
+    return render(request, 'accounts/index.html', context)
 
 @login_required
 def profile(request):
@@ -62,8 +135,15 @@ def department_detail(request, dep_id):
     if request.method == 'POST':
         form = forms.DepartmentForm(request.POST, instance=department, self_exclude=True)
         if form.is_valid():
-            form.save()
-            return redirect('departments_list')
+            try:
+                with transaction.atomic():
+                    form.save()
+            except InvalidMove:
+                # the tree changed between the validation and the move
+                form._errors['parent'] = form.error_class([
+                    form.fields['parent'].error_messages['invalid_choice']])
+            else:
+                return redirect('departments_list')
     return render(request, 'accounts/detail_department.html', {
                            "form":form,
                            "dep_id": dep_id,
@@ -73,24 +153,53 @@ def department_detail(request, dep_id):
 @group_required('manager')
 def department_delete(request, dep_id):
     department = get_object_or_404(models.Department, pk=dep_id)
-    department.delete()
-    return redirect('departments_list')
+    # the cascade can take long, a worker runs it and the job page follows it
+    job = jobs.submit('delete_department', {'department': department.id})
+    return redirect('report_job', job_id=job.id)
+
+def department_nodes():
+    """All departments in tree order, each with its ``employee_list``."""
+    employees = {}
+    for employee in models.Employee.objects.select_related('user'):
+        employees.setdefault(employee.department_id, []).append(employee)
+    nodes = tree.snapshot().all()
+    for node in nodes:
+        node.employee_list = employees.get(node.id, [])
+    return nodes
 
 @login_required
+@group_required('manager')
+def department_report(request, dep_id):
+    departments = tree.snapshot()
+    if int(dep_id) not in departments:
+        raise Http404
+    department = departments.get(int(dep_id))
+    form = forms.DateRangeForm(request.GET)
+    dates = form.cleaned_data if form.is_valid() else {}
+    context = reporting.department_rollup(department, dates.get('start_date'),
+                                          dates.get('end_date'))
+    context.update(form=form, query=request.GET.urlencode())
+    return render(request, 'accounts/department_report.html', context)
+
+@login_required
+@routers.use_replica
+@conditional('department', 'employee')
 def departments_list(request):
-    return render(request, 'accounts/departments.html', {
-                           'nodes': models.Department.objects.all(),
-                           'employees': models.Employee.objects.all()
-                           })
+    context = fragment(request, 'department', 'employee')
+    # passed uncalled: the template only builds the tree on a cache miss
+    context['nodes'] = department_nodes
+    return render(request, 'accounts/departments.html', context)
 
 
 ### Employee
 @login_required
+@routers.use_replica
 def employees_list(request):
-    employees = models.Employee.objects.all()
-    return render(request, 'accounts/employee_list.html',{
-                  'employees': employees
-                  })
+    employees = pagination.paginate(request,
+                                    models.Employee.objects.select_related('user'))
+    context = fragment(request, 'employee')
+    context.update(employees=employees, page=employees)
+    return render(request, 'accounts/employee_list.html', context)
 
 @login_required
 @group_required('manager')
@@ -141,36 +250,49 @@ def employee_detail(request, usr_id=None):
 @group_required('manager')
 def employee_delete(request, usr_id):
     user = get_object_or_404(User, pk=usr_id)
-    user.delete()
-    try:
-        employee = models.Employee.objects.get(user=user)
-        employee.delete()
-    except:
-        pass
-    return redirect('employees_list')
+    job = jobs.submit('delete_employee', {'user': user.id})
+    return redirect('report_job', job_id=job.id)
 
 
 ### Task 
 @login_required
+@routers.use_replica
+@conditional('task', 'employee', 'project')
 def task_list(request):
-    tasks = models.Task.objects.all()
-    return render(request, 'accounts/task_list.html', {
-                  "tasks": tasks,
-                  })
+    tasks = pagination.paginate(request,
+                                models.Task.objects.select_related('employee__user', 'project'))
+    context = fragment(request, 'task', 'employee', 'project')
+    context.update(tasks=tasks, page=tasks)
+    return render(request, 'accounts/task_list.html', context)
 
 @login_required
 @group_required('manager')
 def task_add(request):
     if request.method == 'POST':
         form = forms.TaskForm(request.POST)
-        form.save()
-        return redirect('task_list')
+        if form.is_valid():
+            form.save()
+            return redirect('task_list')
     else:
         task = models.Task()
         form = forms.TaskForm(instance=task)
-        return render(request, 'accounts/task.html', {
-                      "form": form
-                      })
+    return render(request, 'accounts/task.html', {
+                  "form": form
+                  })
+
+@login_required
+@group_required('manager')
+def task_assign(request):
+    if request.method == 'POST':
+        formset = forms.TaskAssignFormSet(request.POST)
+        if formset.is_valid():
+            formset.save()
+            return redirect('task_list')
+    else:
+        formset = forms.TaskAssignFormSet()
+    return render(request, 'accounts/task_assign.html', {
+                  "formset": formset,
+                  })
 
 @login_required
 @group_required('manager')
@@ -178,13 +300,14 @@ def task_detail(request, task_id):
     task = get_object_or_404(models.Task, pk=task_id)
     if request.method == 'POST':
         form = forms.TaskForm(request.POST, instance=task)
-        form.save()
-        return redirect('task_list')
+        if form.is_valid():
+            form.save()
+            return redirect('task_list')
     else:
         form = forms.TaskForm(instance=task)
-        return render(request, 'accounts/task.html', {
-                      "form": form,
-                      })
+    return render(request, 'accounts/task.html', {
+                  "form": form,
+                  })
 
 ###Report
 @login_required
@@ -204,28 +327,68 @@ def report_add(request):
                   })
 
 @login_required
+def timesheet(request):
+    employee = get_object_or_404(models.Employee, user=request.user.id)
+    try:
+        start = datetime.datetime.strptime(request.GET.get('week', ''), '%Y-%m-%d').date()
+    except ValueError:
+        start = datetime.date.today()
+    start -= datetime.timedelta(days=start.weekday())
+    if request.method == 'POST':
+        form = forms.TimesheetForm(request.POST, employee=employee, start=start)
+        if form.is_valid():
+            form.save()
+            return redirect('{0}?week={1}'.format(reverse('timesheet'), start))
+    else:
+        form = forms.TimesheetForm(employee=employee, start=start)
+    return render(request, 'accounts/timesheet.html', {
+                  "form": form,
+                  "previous": start - datetime.timedelta(days=7),
+                  "next": start + datetime.timedelta(days=7),
+                  })
+
+@login_required
+@routers.use_replica
 def report_all_for_employee(request):
     user = get_object_or_404(User, pk=request.user.id)
     employee = get_object_or_404(models.Employee, user=user)
-    tasks = models.Task.objects.filter(employee__exact=employee)
-    reports = models.Report.objects.filter(task__exact=tasks)
+    # the archived reports are listed on their own, with their own total
+    sources = [reports.filter(task__employee=employee) for reports in reporting.report_sources()]
+    archived = len(sources) > 1 and bool(request.GET.get('archived'))
+    reports = pagination.paginate(request, sources[-1 if archived else 0].select_related('task'),
+                                  ordering=('date', 'id'))
+    day_hours = reporting.employee_day_hours(employee)
+    summary_time = sum(hours for date, hours in day_hours)
+    archived_time = reporting.total_hours(sources[1]) if len(sources) > 1 else 0
     return render(request, 'accounts/report_all_for_user.html', {
                   "reports": reports,
+                  "page": reports,
+                  "archived": archived,
+                  "summary_time": archived_time if archived else summary_time - archived_time,
+                  "archived_time": archived_time,
+                  "total_time": summary_time,
+                  "pager_query": 'archived=1&' if archived else '',
                   })
 
 @login_required
 @group_required('manager')
+@routers.use_replica
 def employee_statistics(request):
     if request.method == 'POST':
         form = forms.SelectEmployeeAndDateForm(request.POST)
         if form.is_valid():
-            tasks = models.Task.objects.filter(employee__exact=form.cleaned_data['employee'])
-            reports = models.Report.objects.filter(task__exact=tasks,
-                                                   date__gt=form.cleaned_data['start_date'],
-                                                   date__lt=form.cleaned_data['end_date'])
-            return render(request, 'accounts/report_all_for_user.html', {
-                          "reports": reports,
-                          })
+            data = form.cleaned_data
+            if data['in_background']:
+                job = jobs.submit('employee_statistics', {
+                                  'employee': data['employee'].id,
+                                  'start_date': data['start_date'],
+                                  'end_date': data['end_date'],
+                                  'group_by': data['group_by'],
+                                  })
+                return redirect('report_job', job_id=job.id)
+            return render(request, 'accounts/report_all_for_user.html',
+                          reporting.employee_statistics(data['employee'], data['start_date'],
+                                                        data['end_date'], data['group_by']))
     else:
         form = forms.SelectEmployeeAndDateForm()
     return render(request, 'accounts/employee_statistics.html', {
@@ -234,22 +397,56 @@ def employee_statistics(request):
 
 @login_required
 @group_required('manager')
+@routers.use_replica
+@conditional('project', 'task', 'report')
 def project_report(request, prj_id):
     project = get_object_or_404(models.Project, pk=prj_id)
-    tasks = models.Task.objects.filter(project__exact=project)
-    all_report = {}
-    summary_time = 0
-    for task in tasks:
-        reports= models.Report.objects.filter(task__exact=task)
-        time_on_task = 0
-        for report in reports:
-            time_on_task += report.elapsed_time_in_hour
-        all_report[task.task_name] = time_on_task
-        summary_time += time_on_task
-    return render(request, 'accounts/project_report.html', {
-                  "task_reports": all_report,
-                  "summary_time": summary_time,
-                  })
+    if request.GET.get('background'):
+        job = jobs.submit('project_report', {'project': project.id})
+        return redirect('report_job', job_id=job.id)
+    context = reporting.project_summary(project)
+    context['project'] = project
+    return render(request, 'accounts/project_report.html', context)
+
+@login_required
+@group_required('manager')
+@routers.use_replica
+def project_analytics(request, prj_id):
+    project = get_object_or_404(models.Project, pk=prj_id)
+    context = analytics.project_analytics(project)
+    context['project'] = project
+    return render(request, 'accounts/project_analytics.html', context)
+
+@login_required
+@group_required('manager')
+def report_export(request, fmt):
+    form = forms.ReportFilterForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+    lines, content_type = export.FORMATS[fmt]
+    sources = reporting.report_sources(form.cleaned_data['start_date'],
+                                       form.cleaned_data['end_date'])
+    rows = itertools.chain.from_iterable(export.rows(form.filter(reports)) for reports in sources)
+    response = StreamingHttpResponse(lines(rows), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="reports.{0}"'.format(fmt)
+    return response
+
+@login_required
+@group_required('manager')
+def report_job(request, job_id):
+    job = get_object_or_404(models.ReportJob, pk=job_id)
+    if job.status != models.ReportJob.DONE:
+        return render(request, 'accounts/report_job.html', {
+                      "job": job,
+                      })
+    if request.GET.get('download'):
+        response = HttpResponse(job.result, content_type='application/json')
+        response['Content-Disposition'] = 'attachment; filename="report-{0}.json"'.format(job.id)
+        return response
+    function, template = jobs.JOBS[job.kind]
+    context = json.loads(job.result)
+    context['job'] = job
+    return render(request, template, context)
 
 ### Project
 
@@ -270,8 +467,8 @@ def add_project(request):
 @group_required('manager')
 def project_delete(request, prj_id):
     project = get_object_or_404(models.Project, pk=prj_id)
-    project.delete()
-    return redirect('projects_list')
+    job = jobs.submit('delete_project', {'project': project.id})
+    return redirect('report_job', job_id=job.id)
 
 @login_required
 @group_required('manager')
@@ -292,3 +489,42 @@ class ProjectsView(generic.ListView):
     template_name = 'accounts/projects_list.html'
     context_object_name = 'all_projects'
     model = models.Project
+
+    @method_decorator(routers.use_replica)
+    @method_decorator(conditional('project'))
+    def dispatch(self, *args, **kwargs):
+        return super(ProjectsView, self).dispatch(*args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        page = pagination.paginate(self.request, self.object_list)
+        kwargs.update(fragment(self.request, 'project'))
+        return super(ProjectsView, self).get_context_data(object_list=page,
+                                                          page=page, **kwargs)
+
+### Autocomplete
+
+@login_required
+def autocomplete(request, kind):
+    return HttpResponse(choices.as_json(choices.search(kind, request.GET.get('q', ''))),
+                        content_type='application/json')
+
+### Change feed
+
+@login_required
+@group_required('manager')
+def change_feed(request):
+    """NDJSON of the changes after the ``since`` sequence number."""
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return HttpResponseBadRequest('since must be a sequence number')
+    lines = (encoding.dumps(change) + '\n' for change in changes.feed(since))
+    return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+### Metrics
+
+@user_passes_test(lambda u: u.is_staff)
+def view_metrics(request):
+    """Rolling per-view latency, query and render statistics as JSON."""
+    return HttpResponse(json.dumps(middleware.metrics.summary(), indent=2, sort_keys=True),
+                        content_type='application/json')
@@ -41,6 +41,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'accounts.middleware.ViewMetricsMiddleware',
+    'accounts.middleware.CacheVersionMiddleware',
+    'accounts.middleware.ReplicaPinningMiddleware',
+    'accounts.middleware.ConnectionPoolMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -49,6 +53,18 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+AUTHENTICATION_BACKENDS = (
+    'accounts.permissions.CachedModelBackend',
+)
+
+# Seconds a user's groups and permissions stay in the shared cache
+ACCOUNTS_AUTH_CACHE_TIMEOUT = 600
+
+# Seconds the version counter keying them is cached (accounts.caching):
+# how long other processes may miss a permission change when the cache
+# backend is local to each process
+ACCOUNTS_VERSION_CACHE_TIMEOUT = 30
+
 LOGIN_URL = '/login/'
 
 LOGOUT_URL = '/logout/'
@@ -70,9 +86,31 @@ DATABASES = {
         'OPTIONS': {
             'read_default_file': os.path.join(BASE_DIR, 'mysql.cnf'),
         },
+        # seconds a connection is reused across requests, 0 to close it
+        # after each one (accounts.middleware.ConnectionPoolMiddleware)
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
     }
 }
 
+# Persistent connections kept open per process, and seconds between
+# checks that an idle one is still alive
+ACCOUNTS_DB_POOL_SIZE = 10
+
+ACCOUNTS_DB_HEALTH_CHECK_INTERVAL = 30
+
+# Read replicas: aliases of DATABASES the reporting views read from
+# (accounts.routers), e.g. with
+#     DATABASES['replica'] = {'ENGINE': 'django.db.backends.mysql',
+#                             'OPTIONS': {'read_default_file': ...},
+#                             'TEST_MIRROR': 'default'}
+#     DATABASE_REPLICAS = ('replica',)
+DATABASE_ROUTERS = ('accounts.routers.ReplicaRouter',)
+
+DATABASE_REPLICAS = ()
+
+# Seconds a user reads from the primary after writing to it
+ACCOUNTS_REPLICA_PIN_SECONDS = 10
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 DATE_INPUT_FORMATS = (
@@ -100,3 +138,51 @@ USE_TZ = False
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Keyset pagination of the list views (accounts.pagination)
+ACCOUNTS_PAGE_SIZE = 50
+
+ACCOUNTS_MAX_PAGE_SIZE = 500
+
+# Seconds a change feed entry is held back before it is served
+# (accounts.changes): longer than the longest transaction writing reports,
+# tasks or projects, or a consumer may skip entries committed late
+ACCOUNTS_CHANGE_FEED_SETTLE_SECONDS = 10
+
+# Days after the end of a resolved project before `manage.py archive_reports`
+# moves its reports to the archive table (accounts.archive)
+ACCOUNTS_ARCHIVE_AFTER_DAYS = 365
+
+# Hours of a full working week, the 100% of the utilization analytics
+# (accounts.analytics)
+ACCOUNTS_WEEKLY_CAPACITY = 40
+
+# Cache
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+# Fragment caches are keyed by version counters kept in the database
+# (accounts.caching), so they are never served stale whatever the
+# backend: the local memory one caches per process, a shared one such as
+# 'django.core.cache.backends.memcached.MemcachedCache' with
+# 'LOCATION': '127.0.0.1:11211' lets the processes share the fragments.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds a cached list page fragment is kept (it is never served stale)
+ACCOUNTS_FRAGMENT_CACHE_TIMEOUT = 3600
+
+# Per-view instrumentation (accounts.middleware): samples kept per URL
+# name, and the SQL query count above which a view's queries are logged
+ACCOUNTS_METRICS_WINDOW = 500
+
+ACCOUNTS_QUERY_THRESHOLD = 50
+
+ACCOUNTS_QUERY_THRESHOLDS = {
+    'departments_list': 20,
+    'project_report': 20,
+    # a week of cells in a constant number of batched statements
+    'timesheet': 80,
+}